@@ -0,0 +1,131 @@
+"""
+Nearest neighbour face recognizer over an index of known face encodings.
+
+Adding a person or new faces of a person to the SVM face classifier means
+encoding all the faces again and rerunning train.py's grid search.
+Instead FaceIndex keeps the known face encodings made by encode_faces.py
+in a contiguous float32 matrix and recognizes a face by its k nearest
+known faces, so faces can be enrolled while the servers run and are
+recognized by the next request. The distances of a batch of faces to all
+known faces are one matrix product, so recognition stays fast up to tens
+of thousands of known faces.
+
+The probability of a face being a person is the fraction of its k
+nearest known faces that are of the person and within the tolerance,
+the face distance of face_recognition.compare_faces.
+
+This is part of the smart-zoneminder project.
+See https://github.com/goruck/smart-zoneminder
+
+Copyright (c) 2018 ~ 2020 Lindo St. Angel
+"""
+
+import os
+import pickle
+import tempfile
+import threading
+import numpy as np
+
+def grow(a, size, capacity):
+    # Return a copy of the first size rows of a with room for capacity rows.
+    b = np.zeros((capacity,) + a.shape[1:], dtype=a.dtype)
+    b[:size] = a[:size]
+    return b
+
+class FaceIndex(object):
+    def __init__(self, encodings, names, k, tolerance, dim=128):
+        self.k = k
+        self.tolerance = tolerance
+        # Names of the known persons, a person's class is its index here,
+        # like the classes_ of a label encoder. Names are only appended.
+        self.classes_ = []
+        self._class_ids = {}
+        # Number of known faces of each person.
+        self._counts = []
+        # Known faces are appended to the first size rows of the matrix,
+        # which doubles when full. Rows of the known faces never change,
+        # so a query can use them while faces are enrolled.
+        self.size = 0
+        self._embeddings = np.zeros((max(1024, len(names)), dim), dtype=np.float32)
+        self._sq_norms = np.zeros(len(self._embeddings), dtype=np.float32)
+        self._labels = np.zeros(len(self._embeddings), dtype=np.int32)
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self.add(names, encodings)
+
+    def add(self, names, encodings):
+        # Append the encodings of faces of the persons in names.
+        encodings = np.asarray(encodings, dtype=np.float32).reshape(len(names), -1)
+        with self._lock:
+            labels = []
+            for name in names:
+                if name not in self._class_ids:
+                    self._class_ids[name] = len(self.classes_)
+                    self.classes_.append(name)
+                    self._counts.append(0)
+                labels.append(self._class_ids[name])
+                self._counts[labels[-1]] += 1
+            size = self.size + len(names)
+            if size > len(self._embeddings):
+                capacity = max(size, 2 * len(self._embeddings))
+                (self._embeddings, self._sq_norms, self._labels) = (
+                    grow(a, self.size, capacity)
+                    for a in (self._embeddings, self._sq_norms, self._labels))
+            self._embeddings[self.size:size] = encodings
+            self._sq_norms[self.size:size] = np.einsum('ij,ij->i', encodings, encodings)
+            self._labels[self.size:size] = labels
+            self.size = size
+
+    def _known(self):
+        # Return the known faces so far, their squared norms and classes and
+        # the number of classes.
+        with self._lock:
+            n = self.size
+            return (self._embeddings[:n], self._sq_norms[:n], self._labels[:n],
+                len(self.classes_))
+
+    def predict_proba(self, X):
+        """
+        Return the probability of each known person for each face in X.
+
+        That is the fraction of a face's k nearest known faces that are of
+        the person and not further than the tolerance.
+        """
+        X = np.asarray(X, dtype=np.float32).reshape(-1, self._embeddings.shape[1])
+        (embeddings, sq_norms, labels, num_classes) = self._known()
+        proba = np.zeros((len(X), num_classes))
+        if not len(embeddings):
+            return proba
+        k = min(self.k, len(embeddings))
+        # Squared distances of each face to each known face.
+        sq_dist = np.einsum('ij,ij->i', X, X)[:, None] - 2. * (X @ embeddings.T) + sq_norms
+        nearest = np.argpartition(sq_dist, k - 1, axis=1)[:, :k]
+        rows = np.broadcast_to(np.arange(len(X))[:, None], nearest.shape)
+        close = sq_dist[rows, nearest] <= self.tolerance ** 2
+        np.add.at(proba, (rows[close], labels[nearest[close]]), 1.)
+        return proba / k
+
+    def save(self, path):
+        # Write the known faces to path like encode_faces.py, replacing it at once.
+        with self._save_lock:
+            (embeddings, _, labels, _) = self._known()
+            data = {'encodings': list(embeddings.astype(np.float64)),
+                'names': [self.classes_[label] for label in labels]}
+            (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+            with os.fdopen(fd, 'wb') as fp:
+                pickle.dump(data, fp)
+            os.replace(tmp_path, path)
+
+    def stats(self):
+        # Return the number of known faces of each person.
+        with self._lock:
+            return dict(zip(self.classes_, self._counts))
+
+def load_face_index(path, k, tolerance):
+    # Load the known faces made by encode_faces.py into a FaceIndex.
+    with open(path, 'rb') as fp:
+        data = pickle.load(fp)
+    if not data['names']:
+        raise ValueError('No known faces in {}.'.format(path))
+    return FaceIndex(data['encodings'], data['names'], k=k, tolerance=tolerance,
+        dim=len(data['encodings'][0]))
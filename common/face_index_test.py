@@ -0,0 +1,111 @@
+"""
+Tests of the nearest neighbour face recognizer, run with pytest from this directory.
+
+This is part of the smart-zoneminder project.
+See https://github.com/goruck/smart-zoneminder
+
+Copyright (c) 2018 ~ 2020 Lindo St. Angel
+"""
+
+import pickle
+import numpy as np
+import pytest
+
+from face_index import FaceIndex, load_face_index
+
+NAMES = ['eva_st_angel', 'lindo_st_angel', 'nico_st_angel']
+
+def known_faces(rand, faces_per_name=10, spread=0.02):
+    # Faces of each person around a center of their own.
+    centers = rand.uniform(-0.2, 0.2, (len(NAMES), 128))
+    names = [name for name in NAMES for _ in range(faces_per_name)]
+    encodings = [centers[NAMES.index(name)] + rand.normal(0, spread, 128) for name in names]
+    return centers, names, encodings
+
+def brute_force_proba(names, encodings, faces, k, tolerance, classes):
+    # Reference predict_proba, one face at a time.
+    encodings = np.array(encodings)
+    proba = np.zeros((len(faces), len(classes)))
+    for (i, face) in enumerate(faces):
+        distances = np.linalg.norm(encodings - face, axis=1)
+        for j in np.argsort(distances)[:k]:
+            if distances[j] <= tolerance:
+                proba[i, classes.index(names[j])] += 1. / k
+    return proba
+
+def test_knn_matches_brute_force():
+    rand = np.random.RandomState(0)
+    (centers, names, encodings) = known_faces(rand)
+    index = FaceIndex(encodings, names, k=5, tolerance=0.6)
+    faces = np.concatenate([centers + rand.normal(0, 0.02, centers.shape),
+        rand.uniform(-0.2, 0.2, (5, 128))])
+    proba = index.predict_proba(faces)
+    assert index.classes_ == NAMES
+    assert proba.shape == (len(faces), len(NAMES))
+    np.testing.assert_allclose(proba, brute_force_proba(names, encodings, faces,
+        k=5, tolerance=0.6, classes=NAMES), atol=1e-6)
+    # The faces near a person's center are that person.
+    assert list(np.argmax(proba[:len(NAMES)], axis=1)) == [0, 1, 2]
+    assert np.all(proba[:len(NAMES)].max(axis=1) == 1.)
+
+def test_unknown_face():
+    rand = np.random.RandomState(1)
+    (_, names, encodings) = known_faces(rand)
+    index = FaceIndex(encodings, names, k=5, tolerance=0.6)
+    # No known face is within the tolerance.
+    assert not index.predict_proba(np.full((1, 128), 1.)).any()
+
+def test_enroll():
+    rand = np.random.RandomState(2)
+    (_, names, encodings) = known_faces(rand)
+    index = FaceIndex(encodings, names, k=5, tolerance=0.6)
+    new_center = rand.uniform(-0.2, 0.2, 128)
+    face = new_center + rand.normal(0, 0.02, 128)
+    assert index.predict_proba([face])[0].max() < 1.
+
+    index.add(['nikki_st_angel'] * 5, [new_center + rand.normal(0, 0.02, 128)
+        for _ in range(5)])
+    assert index.classes_ == NAMES + ['nikki_st_angel']
+    assert index.stats()['nikki_st_angel'] == 5
+    proba = index.predict_proba([face])
+    assert proba.shape == (1, len(NAMES) + 1)
+    assert proba[0, -1] == 1.
+
+def test_enroll_past_capacity():
+    rand = np.random.RandomState(3)
+    (_, names, encodings) = known_faces(rand)
+    index = FaceIndex(encodings, names, k=5, tolerance=0.6)
+    more = rand.uniform(-0.2, 0.2, (2000, 128))
+    index.add(['eva_st_angel'] * len(more), more)
+    assert index.size == len(names) + len(more)
+    # Earlier known faces are kept when the matrix grows.
+    np.testing.assert_allclose(index.predict_proba(encodings[:1]),
+        brute_force_proba(names + ['eva_st_angel'] * len(more),
+        list(encodings) + list(more), encodings[:1], k=5, tolerance=0.6,
+        classes=NAMES), atol=1e-6)
+
+def test_save_and_load(tmp_path):
+    rand = np.random.RandomState(4)
+    (centers, names, encodings) = known_faces(rand)
+    index = FaceIndex(encodings, names, k=5, tolerance=0.6)
+    index.add(['nikki_st_angel'], [centers[0]])
+    path = str(tmp_path / 'encodings.pickle')
+    index.save(path)
+
+    # Saved like encode_faces.py does.
+    with open(path, 'rb') as fp:
+        data = pickle.load(fp)
+    assert data['names'] == names + ['nikki_st_angel']
+    assert len(data['encodings']) == len(names) + 1
+
+    loaded = load_face_index(path, k=5, tolerance=0.6)
+    assert loaded.classes_ == index.classes_
+    assert loaded.stats() == index.stats()
+    np.testing.assert_allclose(loaded.predict_proba(centers), index.predict_proba(centers))
+
+def test_load_without_faces(tmp_path):
+    path = str(tmp_path / 'encodings.pickle')
+    with open(path, 'wb') as fp:
+        pickle.dump({'encodings': [], 'names': []}, fp)
+    with pytest.raises(ValueError):
+        load_face_index(path, k=5, tolerance=0.6)
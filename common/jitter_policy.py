@@ -0,0 +1,51 @@
+"""
+Number of times the dlib face encoder resamples (jitters) a face, adapted to the load.
+
+More jitters give slightly more accurate face encodings but the time to
+encode a face grows about linearly with them. A fixed number is either
+too low when the servers are idle or so high that busy bursts of alarms
+make clients time out. Instead the number of jitters is scaled after
+each request that encoded faces by how far its latency was from the
+target, and the jitters of a face are divided among the requests that
+are waiting, within min and max jitters.
+
+This is part of the smart-zoneminder project.
+See https://github.com/goruck/smart-zoneminder
+
+Copyright (c) 2018 ~ 2020 Lindo St. Angel
+"""
+
+class JitterPolicy(object):
+    def __init__(self, min_jitters, max_jitters, target):
+        # target is the request latency in seconds to aim for, with
+        # 0 the max jitters are always used.
+        self.min_jitters = min_jitters
+        self.max_jitters = max_jitters
+        self.target = target
+        # Jitters per face when no other requests are waiting.
+        self.level = float(max_jitters)
+        # Latency of the last request that encoded faces.
+        self.latency = None
+
+    def observe(self, seconds):
+        # Adapt the jitters to the latency of a request that encoded faces.
+        self.latency = seconds
+        if not self.target:
+            return
+        # Halfway (geometrically) to the jitters that would have met the
+        # target, at most doubled or halved, so noisy latencies don't make it swing.
+        ratio = min(2., max(0.5, self.target / max(seconds, 1e-6)))
+        self.level = min(float(self.max_jitters),
+            max(float(self.min_jitters), self.level * ratio ** 0.5))
+
+    def choose(self, backlog):
+        # Return the jitters of a face with backlog other requests waiting.
+        if not self.target:
+            return self.max_jitters
+        return max(self.min_jitters, min(self.max_jitters, int(round(self.level / (1 + backlog)))))
+
+    def stats(self):
+        return {
+            'level': round(self.level, 2),
+            'latency': None if self.latency is None else round(self.latency, 3)
+        }
@@ -0,0 +1,98 @@
+"""
+Decoding of jpeg alarm frames at reduced resolution.
+
+The object detectors only need small inputs, e.g. 300 x 300, so a frame
+can be decoded at 1/2, 1/4 or 1/8 resolution using jpeg DCT scaling,
+which is much faster than a full decode followed by a resize. The frame's
+original size, needed for box coordinates, is read from its jpeg header.
+
+This is part of the smart-zoneminder project.
+See https://github.com/goruck/smart-zoneminder
+
+Copyright (c) 2018 ~ 2020 Lindo St. Angel
+"""
+
+import cv2
+import numpy as np
+
+# Reduced resolution imread flags by DCT scaling factor, largest first.
+REDUCED_COLOR_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2)
+)
+
+def jpeg_size(buf):
+    """
+    Return the (h, w) of a jpeg image from its frame header.
+
+    Only the header is parsed, the image is not decoded.
+    Returns None if buf isn't a jpeg or the header can't be found.
+    """
+    if buf[:2] != b'\xff\xd8':
+        return None
+
+    i = 2
+    while i + 9 <= len(buf):
+        if buf[i] != 0xff:
+            return None
+        marker = buf[i + 1]
+        # Skip fill bytes and markers without a length field.
+        if marker == 0xff:
+            i += 1
+            continue
+        if marker == 0x01 or 0xd0 <= marker <= 0xd8:
+            i += 2
+            continue
+        # Start of frame markers, except DHT, JPG and DAC which share the range.
+        if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            h = int.from_bytes(buf[i + 5:i + 7], 'big')
+            w = int.from_bytes(buf[i + 7:i + 9], 'big')
+            return h, w
+        # Start of scan reached without a frame header.
+        if marker == 0xda:
+            return None
+        i += 2 + int.from_bytes(buf[i + 2:i + 4], 'big')
+
+    return None
+
+def scaled_flags(orig_size, width, height, keep_aspect_ratio=False):
+    """
+    Return the imread flags to decode a color image for a width x height input.
+
+    orig_size is the (h, w) of the jpeg image or None if it isn't a jpeg.
+    The largest DCT scaling that keeps the decoded image at least width x
+    height is used, or with keep_aspect_ratio, at least as large as the
+    image letterboxed into width x height.
+    """
+    if orig_size is None:
+        return cv2.IMREAD_COLOR
+
+    (h, w) = orig_size
+    if keep_aspect_ratio:
+        max_factor = max(h // height, w // width)
+    else:
+        max_factor = min(h // height, w // width)
+    for (factor, flags) in REDUCED_COLOR_FLAGS:
+        if factor <= max_factor:
+            return flags
+
+    return cv2.IMREAD_COLOR
+
+def imdecode_scaled(buf, width, height, keep_aspect_ratio=False):
+    """
+    Decode a color image at reduced resolution and return it and its original (h, w).
+
+    buf holds the encoded image file contents. See scaled_flags for the
+    resolution used, images that aren't jpegs are fully decoded. Returns
+    (None, None) if the image could not be decoded.
+    """
+    orig_size = jpeg_size(buf)
+    flags = scaled_flags(orig_size, width, height, keep_aspect_ratio)
+    img = cv2.imdecode(np.frombuffer(buf, dtype=np.uint8), flags)
+    if img is None:
+        return None, None
+    if orig_size is None:
+        orig_size = img.shape[:2]
+
+    return img, orig_size
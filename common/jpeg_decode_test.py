@@ -0,0 +1,69 @@
+"""
+Tests of the reduced resolution jpeg decode, run with pytest from this directory.
+
+This is part of the smart-zoneminder project.
+See https://github.com/goruck/smart-zoneminder
+
+Copyright (c) 2018 ~ 2020 Lindo St. Angel
+"""
+
+import cv2
+import numpy as np
+
+from jpeg_decode import imdecode_scaled, jpeg_size, scaled_flags
+
+def encode(ext, h=480, w=640, params=()):
+    img = np.random.RandomState(0).randint(0, 255, (h, w, 3), dtype=np.uint8)
+    (_, buf) = cv2.imencode(ext, img, list(params))
+    return buf.tobytes()
+
+def test_jpeg_size_baseline():
+    assert jpeg_size(encode('.jpg')) == (480, 640)
+    assert jpeg_size(encode('.jpg', h=1080, w=1920)) == (1080, 1920)
+
+def test_jpeg_size_progressive():
+    buf = encode('.jpg', params=(cv2.IMWRITE_JPEG_PROGRESSIVE, 1))
+    # Progressive jpegs have a SOF2 frame header.
+    assert b'\xff\xc2' in buf
+    assert jpeg_size(buf) == (480, 640)
+
+def test_jpeg_size_truncated():
+    for params in ((), (cv2.IMWRITE_JPEG_PROGRESSIVE, 1)):
+        buf = encode('.jpg', params=params)
+        # The frame header is before the scan data.
+        assert jpeg_size(buf[:len(buf) // 2]) == (480, 640)
+        # No frame header.
+        sof = buf.index(b'\xff\xc2' if params else b'\xff\xc0')
+        assert jpeg_size(buf[:sof]) is None
+        assert jpeg_size(buf[:sof + 5]) is None
+        assert jpeg_size(buf[:2]) is None
+
+def test_jpeg_size_not_jpeg():
+    assert jpeg_size(encode('.png')) is None
+    assert jpeg_size(b'') is None
+    assert jpeg_size(b'\xff\xd8\x00\x00' + bytes(16)) is None
+
+def test_scaled_flags():
+    assert scaled_flags(None, 300, 300) == cv2.IMREAD_COLOR
+    assert scaled_flags((480, 640), 300, 200) == cv2.IMREAD_REDUCED_COLOR_2
+    assert scaled_flags((1080, 1920), 300, 200) == cv2.IMREAD_REDUCED_COLOR_4
+    assert scaled_flags((2400, 3200), 300, 300) == cv2.IMREAD_REDUCED_COLOR_8
+    assert scaled_flags((480, 640), 640, 480) == cv2.IMREAD_COLOR
+    # Letterboxed, only the long side has to stay at least the input size.
+    assert scaled_flags((480, 640), 300, 300) == cv2.IMREAD_COLOR
+    assert scaled_flags((480, 640), 300, 300, keep_aspect_ratio=True) == \
+        cv2.IMREAD_REDUCED_COLOR_2
+
+def test_imdecode_scaled():
+    (img, orig_size) = imdecode_scaled(encode('.jpg',
+        params=(cv2.IMWRITE_JPEG_PROGRESSIVE, 1)), 300, 200)
+    assert img.shape == (240, 320, 3)
+    assert orig_size == (480, 640)
+    # Images that aren't jpegs are fully decoded.
+    (img, orig_size) = imdecode_scaled(encode('.png'), 300, 200)
+    assert img.shape == (480, 640, 3)
+    assert orig_size == (480, 640)
+
+def test_imdecode_scaled_truncated():
+    buf = encode('.jpg')
+    assert imdecode_scaled(buf[:len(buf) // 2], 300, 200) == (None, None)
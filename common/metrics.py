@@ -0,0 +1,173 @@
+"""
+Latency histograms and counters of the detection servers.
+
+Each server times the stages of its pipeline (image read, decode, resize,
+inference etc.) into histograms and counts frames, skipped frames, cache
+hits and errors. The metrics are returned by the servers' get_stats RPC
+and can also be served in the Prometheus text format, to tell if NFS,
+the CPU or the accelerator is the bottleneck.
+
+Histograms have fixed buckets so recording a sample is cheap and their
+percentiles are estimated by interpolating within a bucket.
+
+This is part of the smart-zoneminder project.
+See https://github.com/goruck/smart-zoneminder
+
+Copyright (c) 2018 ~ 2020 Lindo St. Angel
+"""
+
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the latency histogram buckets.
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Prefix of the Prometheus metric names.
+PROMETHEUS_PREFIX = 'smart_zoneminder'
+
+class Histogram(object):
+    def __init__(self):
+        # Number of samples in each bucket, the last one is unbounded.
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        # Estimate the q-th quantile (0 ~ 1) or return None if there are no samples.
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for (i, n) in enumerate(self.buckets):
+            if n and seen + n >= rank:
+                lower = BUCKETS[i - 1] if i > 0 else 0.
+                upper = BUCKETS[i] if i < len(BUCKETS) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / n, self.max)
+            seen += n
+        return self.max
+
+class Metrics(object):
+    def __init__(self, name):
+        # name identifies the server in the Prometheus metrics.
+        self.name = name
+        self.start_time = time.monotonic()
+        self.counters = {}
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        # Record the latency of a stage.
+        with self._lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        # Record the time spent in a with block as the latency of stage.
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.monotonic() - start)
+
+    def count(self, counter, n=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def reset(self):
+        # Forget all samples and counts, e.g. after a warm up.
+        with self._lock:
+            self.start_time = time.monotonic()
+            self.counters.clear()
+            self.stages.clear()
+
+    def stats(self):
+        """
+        Return the counters and the latency stats of each stage in seconds.
+
+        'framesPerSecond' is the number of frames done over the uptime.
+        """
+        uptime = time.monotonic() - self.start_time
+        with self._lock:
+            return {
+                'uptime': round(uptime, 3),
+                'framesPerSecond': round(self.counters.get('frames', 0) / uptime, 3)
+                    if uptime > 0 else 0.,
+                'counters': dict(self.counters),
+                'stages': {stage: {
+                    'count': h.count,
+                    'mean': round(h.sum / h.count, 6),
+                    'p50': round(h.quantile(0.5), 6),
+                    'p95': round(h.quantile(0.95), 6),
+                    'p99': round(h.quantile(0.99), 6),
+                    'max': round(h.max, 6)
+                } for (stage, h) in self.stages.items() if h.count}
+            }
+
+    def prometheus(self):
+        # Return the samples of the metrics in the Prometheus text format, by metric.
+        samples = {}
+        server = 'server="{}"'.format(self.name)
+        with self._lock:
+            for (counter, n) in sorted(self.counters.items()):
+                samples['{}_{}_total'.format(PROMETHEUS_PREFIX, counter)] = [
+                    '{}_{}_total{{{}}} {}'.format(PROMETHEUS_PREFIX, counter, server, n)]
+            name = '{}_stage_seconds'.format(PROMETHEUS_PREFIX)
+            lines = samples.setdefault(name, [])
+            for (stage, h) in sorted(self.stages.items()):
+                labels = '{},stage="{}"'.format(server, stage)
+                cumulative = 0
+                for (upper, n) in zip(BUCKETS + ('+Inf',), h.buckets):
+                    cumulative += n
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels, upper, cumulative))
+                lines.append('{}_sum{{{}}} {}'.format(name, labels, h.sum))
+                lines.append('{}_count{{{}}} {}'.format(name, labels, h.count))
+        return samples
+
+def prometheus_text(metrics):
+    # Return the Prometheus text exposition of a list of Metrics.
+    samples = {}
+    for m in metrics:
+        for (name, lines) in m.prometheus().items():
+            samples.setdefault(name, []).extend(lines)
+    text = []
+    for (name, lines) in sorted(samples.items()):
+        if name.endswith('_stage_seconds'):
+            text.append('# HELP {} Latency of the server processing stages.'.format(name))
+            text.append('# TYPE {} histogram'.format(name))
+        else:
+            text.append('# TYPE {} counter'.format(name))
+        text.extend(lines)
+    return '\n'.join(text) + '\n'
+
+def serve_prometheus(port, metrics):
+    """
+    Serve a list of Metrics in the Prometheus text format on port.
+
+    The endpoint runs on the gevent hub alongside the zerorpc servers.
+    Returns the started server.
+    """
+    # Import here since the endpoint is optional.
+    from gevent.pywsgi import WSGIServer
+
+    def app(environ, start_response):
+        body = prometheus_text(metrics).encode('utf-8')
+        start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4'),
+            ('Content-Length', str(len(body)))])
+        return [body]
+
+    server = WSGIServer(('', port), app, log=None)
+    server.start()
+    return server
@@ -0,0 +1,61 @@
+"""
+Reload of a server's models when their files change.
+
+Retraining writes new model files while the servers run. A watcher polls
+the modification times of the files and reloads the models once they
+have changed and then stayed unchanged for an interval, so half written
+files aren't loaded. A file that is missing is waited for.
+
+This is part of the smart-zoneminder project.
+See https://github.com/goruck/smart-zoneminder
+
+Copyright (c) 2018 ~ 2020 Lindo St. Angel
+"""
+
+import os
+import gevent
+import logging
+
+class ModelWatcher(object):
+    def __init__(self, name, paths, reload):
+        # reload() loads the models and returns False if it could not
+        # start, e.g. because the models are already being loaded.
+        self.name = name
+        self.paths = paths
+        self.reload = reload
+        # Modification times of the files the models were last loaded from.
+        self.mtimes = None
+
+    def _mtimes(self):
+        # Modification times of the model files, None for a missing file.
+        mtimes = []
+        for path in self.paths:
+            try:
+                mtimes.append(os.stat(path).st_mtime)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def update(self):
+        # Take the files as they are now as loaded. Called as each load
+        # starts and after a server writes the files itself.
+        self.mtimes = self._mtimes()
+
+    def watch(self, interval):
+        # Check the files every interval seconds, run in a greenlet.
+        changed = None
+        while True:
+            gevent.sleep(interval)
+            mtimes = self._mtimes()
+            if mtimes == self.mtimes:
+                changed = None
+            elif mtimes == changed and None not in mtimes:
+                logging.info('{} model files changed, reloading.'.format(self.name))
+                try:
+                    if self.reload() is False:
+                        continue
+                except Exception:
+                    logging.exception('Reloading the {} models failed.'.format(self.name))
+                changed = None
+            else:
+                changed = mtimes
@@ -0,0 +1,98 @@
+"""
+Per ZoneMinder monitor state used to skip inference on alarm frames.
+
+Alarm frames closely following the last inferred frame of the same event
+are skipped. The last inferred frame of each monitor is remembered across
+requests, since a client usually sends an event's frames a few at a time.
+
+A frame signature is a small grayscale thumbnail of the scene. A frame
+whose signature is close to that of the last inferred frame of its
+monitor shows the same scene, so its detections can be reused.
+
+This is part of the smart-zoneminder project.
+See https://github.com/goruck/smart-zoneminder
+
+Copyright (c) 2018 ~ 2020 Lindo St. Angel
+"""
+
+import cv2
+import numpy as np
+import time
+from collections import OrderedDict
+
+def parse_image_path(image_path):
+    """
+    Return the ZoneMinder (monitor, event, frame number) of an image or None.
+    
+    Image paths must be in the form of:
+    '/nvr/zoneminder/events/BackPorch/18/06/20/19/20/04/00224-capture.jpg'.
+    The event is identified by its directory, e.g. '18/06/20/19/20/04'.
+    """
+    parts = image_path.split('/')
+    try:
+        return parts[4], '/'.join(parts[5:-1]), int(parts[-1].split('-')[0])
+    except (ValueError, IndexError):
+        return None
+
+def skip_inference(image_info, last_inferred, max_skip):
+    """
+    Check if a frame closely follows the last inferred frame of its monitor.
+
+    image_info is the (monitor, event, frame number) of the frame and
+    last_inferred the (event, frame number) of the last inferred frame of
+    the same monitor or None. Returns True if the frame is in the same
+    event and at most max_skip frames after the last inferred one.
+    """
+    if max_skip == 0 or last_inferred is None:
+        return False
+
+    (_, event, frame_num) = image_info
+    (old_event, old_frame_num) = last_inferred
+    # Only apply skip logic if alarm frames are from the same event.
+    # Intra-event frames are monotonically increasing.
+    frame_diff = frame_num - old_frame_num
+    return event == old_event and 0 < frame_diff <= max_skip
+
+class MonitorStates(object):
+    """
+    Last inferred frame of each ZoneMinder monitor, kept across requests.
+
+    A state expires ttl seconds after it was last updated and at
+    most max_monitors states are kept, oldest dropped first.
+    """
+    def __init__(self, ttl, max_monitors=256):
+        self.ttl = ttl
+        self.max_monitors = max_monitors
+        self._states = OrderedDict()
+
+    def get(self, monitor):
+        # Return the state of a monitor or None if unknown or expired.
+        state = self._states.get(monitor)
+        if state is not None and time.monotonic() - state['time'] > self.ttl:
+            del self._states[monitor]
+            return None
+        return state
+
+    def discard(self, monitor):
+        # Forget the state of a monitor.
+        self._states.pop(monitor, None)
+
+    def update(self, monitor, **state):
+        # Set the state of a monitor and drop old states.
+        now = time.monotonic()
+        state['time'] = now
+        self._states.pop(monitor, None)
+        self._states[monitor] = state
+        while self._states and (len(self._states) > self.max_monitors or
+            now - next(iter(self._states.values()))['time'] > self.ttl):
+            self._states.popitem(last=False)
+
+def frame_signature(img):
+    # Small grayscale thumbnail of the scene used to tell if it changed.
+    # Each pixel is the mean gray level of a region of the scene.
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.int16)
+
+def signature_distance(sig1, sig2):
+    # Largest change of any region between two frame signatures.
+    return int(np.abs(sig1 - sig2).max())
@@ -0,0 +1,219 @@
+"""
+Persistent cache of detection results keyed by image content.
+
+Clients retry whole batches after errors and tools like extract_faces.py
+resend frames that were already processed. Results are stored in a sqlite
+database keyed by a digest of the image file contents, so repeat requests
+for a frame are answered without decoding or inference.
+
+Each cache has its own table and a model id that identifies the model
+files and settings that produced the results. Results of any other model
+id are dropped when the cache is opened or its model is changed by a
+reload, so a changed model file never returns stale results. A cache
+opened without a model id, e.g. by a server whose models are still
+loading, neither returns nor stores results until its model is set.
+
+Results and when they were last used are written by a background thread
+in one transaction per interval, so the servers don't wait for the disk
+on each lookup and store. Results that are not written yet are found
+by lookups all the same.
+
+This is part of the smart-zoneminder project.
+See https://github.com/goruck/smart-zoneminder
+
+Copyright (c) 2018 ~ 2020 Lindo St. Angel
+"""
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import logging
+import threading
+
+def model_id(paths, settings):
+    """
+    Return an id for the model files at paths and their settings.
+
+    The id changes if any file's contents or any setting changes.
+    """
+    h = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    h.update(json.dumps(settings, sort_keys=True).encode())
+    return h.hexdigest()
+
+# Results and last used times are written by a background thread, at
+# most this often in seconds, all in one transaction.
+COMMIT_INTERVAL = 1.0
+
+class ResultCache(object):
+    def __init__(self, db_path, table, model, max_bytes):
+        # Size budget of the cached results in bytes. Zero disables the cache.
+        self.table = table
+        self.model = model
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.cur_bytes = 0
+        self._lock = threading.Lock()
+        # Results and last used times of keys not written yet, and of the
+        # ones being written.
+        self._pending = {}
+        self._touched = {}
+        self._writing = {}
+        self._write_lock = threading.Lock()
+        self._dirty = threading.Event()
+
+        if self.max_bytes == 0:
+            return
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        # Results are written on one connection and read on another, the
+        # reads don't wait for writes to be committed with a write-ahead log.
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, '
+                'model TEXT, value TEXT, size INTEGER, used REAL)'.format(table))
+            self._db.execute('CREATE INDEX IF NOT EXISTS {0}_used ON {0} (used)'
+                .format(table))
+        self._reader = sqlite3.connect(db_path, check_same_thread=False)
+        self._drop_old_models()
+        threading.Thread(target=self._write_loop, name='{}-result-cache'.format(table),
+            daemon=True).start()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _drop_old_models(self):
+        # Drop results of other (old) models.
+        if self.model is not None:
+            with self._db:
+                cur = self._db.execute('DELETE FROM {} WHERE model != ?'
+                    .format(self.table), (self.model,))
+            if cur.rowcount:
+                logging.info('Dropped {} cached {} results of old models.'
+                    .format(cur.rowcount, self.table))
+        (self.cur_bytes,) = self._db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM {}'.format(self.table)).fetchone()
+
+    def set_model(self, model):
+        # Switch to the results of a reloaded model.
+        if model == self.model:
+            return
+        with self._write_lock, self._lock:
+            self.model = model
+            # Results of the old model that aren't written yet are dropped too.
+            self._pending = {}
+            self._touched = {}
+            if self.max_bytes > 0:
+                self._drop_old_models()
+
+    def get(self, key):
+        # Return the cached result for key or None.
+        if self.max_bytes == 0 or self.model is None:
+            return None
+        with self._lock:
+            value = self._pending.get(key) or self._writing.get(key)
+            if value is None:
+                row = self._reader.execute('SELECT value FROM {} WHERE key = ? AND model = ?'
+                    .format(self.table), (key, self.model)).fetchone()
+                value = None if row is None else row[0]
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touched[key] = time.time()
+        self._dirty.set()
+        logging.debug('Result cache hit for {} {}.'.format(self.table, key))
+        return json.loads(value)
+
+    def put(self, key, result, model=None):
+        # Store a result, written with others by the background thread.
+        # Results of a model other than the current one, e.g. of a request
+        # that was still running when the model was reloaded, are not stored.
+        if self.max_bytes == 0:
+            return
+        value = json.dumps(result)
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if self.model is None or (model is not None and model != self.model):
+                return
+            self._pending[key] = value
+            self._touched.pop(key, None)
+        self._dirty.set()
+
+    def _write_loop(self):
+        while True:
+            self._dirty.wait()
+            self._dirty.clear()
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                logging.error('Cannot write {} results to the cache: {}'.format(self.table, e))
+            time.sleep(COMMIT_INTERVAL)
+
+    def flush(self):
+        """
+        Write the stored results and last used times in one transaction.
+
+        Then evict least recently used results until under budget.
+        """
+        if self.max_bytes == 0:
+            return
+        with self._write_lock:
+            with self._lock:
+                (self._writing, pending, touched, model) = (self._pending, self._pending,
+                    self._touched, self.model)
+                (self._pending, self._touched) = ({}, {})
+            try:
+                if not pending and not touched:
+                    return
+                now = time.time()
+                cur_bytes = self.cur_bytes
+                evictions = 0
+                with self._db:
+                    for (key, value) in pending.items():
+                        old = self._db.execute('SELECT size FROM {} WHERE key = ?'
+                            .format(self.table), (key,)).fetchone()
+                        if old is not None:
+                            cur_bytes -= old[0]
+                        self._db.execute('INSERT OR REPLACE INTO {} VALUES (?, ?, ?, ?, ?)'
+                            .format(self.table), (key, model, value, len(value), now))
+                        cur_bytes += len(value)
+                    self._db.executemany('UPDATE {} SET used = ? WHERE key = ?'
+                        .format(self.table), [(used, key) for (key, used) in touched.items()])
+                    while cur_bytes > self.max_bytes:
+                        (old_key, old_size) = self._db.execute('SELECT key, size FROM {} '
+                            'ORDER BY used LIMIT 1'.format(self.table)).fetchone()
+                        self._db.execute('DELETE FROM {} WHERE key = ?'
+                            .format(self.table), (old_key,))
+                        cur_bytes -= old_size
+                        evictions += 1
+                with self._lock:
+                    self.cur_bytes = cur_bytes
+                    self.evictions += evictions
+            finally:
+                with self._lock:
+                    self._writing = {}
+
+    def stats(self):
+        # Return cache counters.
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'bytes': self.cur_bytes,
+                'pending': len(self._pending)
+            }
@@ -0,0 +1,93 @@
+"""
+Tests of the result cache, run with pytest from this directory.
+
+This is part of the smart-zoneminder project.
+See https://github.com/goruck/smart-zoneminder
+
+Copyright (c) 2018 ~ 2020 Lindo St. Angel
+"""
+
+from result_cache import ResultCache, model_id
+
+LABELS = [{'name': 'person', 'score': 0.9}]
+
+def make_cache(tmp_path, model='m1', max_bytes=1 << 20):
+    return ResultCache(db_path=str(tmp_path / 'results.db'), table='objects',
+        model=model, max_bytes=max_bytes)
+
+def test_hit_and_miss(tmp_path):
+    cache = make_cache(tmp_path)
+    assert cache.get('a') is None
+    cache.put('a', LABELS)
+    # Found before and after it is written.
+    assert cache.get('a') == LABELS
+    cache.flush()
+    assert cache.get('a') == LABELS
+    assert cache.get('b') is None
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses']) == (2, 2)
+    # Still there when the cache is opened again.
+    assert make_cache(tmp_path).get('a') == LABELS
+
+def test_disabled(tmp_path):
+    cache = make_cache(tmp_path, max_bytes=0)
+    cache.put('a', LABELS)
+    assert cache.get('a') is None
+    assert not cache.enabled
+
+def test_model_id(tmp_path):
+    path = tmp_path / 'model.tflite'
+    path.write_bytes(b'model 1')
+    first = model_id([str(path)], {'minScore': 0.8})
+    assert model_id([str(path)], {'minScore': 0.8}) == first
+    assert model_id([str(path)], {'minScore': 0.7}) != first
+    path.write_bytes(b'model 2')
+    assert model_id([str(path)], {'minScore': 0.8}) != first
+
+def test_changed_model_drops_results(tmp_path):
+    cache = make_cache(tmp_path, model='m1')
+    cache.put('a', LABELS)
+    cache.flush()
+    # Opened with another model.
+    assert make_cache(tmp_path, model='m2').get('a') is None
+    assert make_cache(tmp_path, model='m1').get('a') is None
+
+    # Reloaded with another model.
+    cache = make_cache(tmp_path, model='m1')
+    cache.put('a', LABELS)
+    cache.put('b', LABELS)
+    cache.flush()
+    cache.put('c', LABELS)
+    cache.set_model('m2')
+    assert cache.get('a') is None
+    assert cache.get('c') is None
+    assert cache.stats()['bytes'] == 0
+    # Results of requests still running on the old model aren't stored.
+    cache.put('d', LABELS, model='m1')
+    assert cache.get('d') is None
+    cache.put('d', LABELS, model='m2')
+    assert cache.get('d') == LABELS
+
+def test_no_model_until_set(tmp_path):
+    cache = make_cache(tmp_path, model='m1')
+    cache.put('a', LABELS)
+    cache.flush()
+    # A cache opened while the models load keeps the results until its
+    # model is known.
+    cache = make_cache(tmp_path, model=None)
+    assert cache.get('a') is None
+    cache.put('b', LABELS)
+    cache.set_model('m1')
+    assert cache.get('a') == LABELS
+    assert cache.get('b') is None
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = make_cache(tmp_path, max_bytes=200)
+    for key in 'abcdef':
+        cache.put(key, LABELS)
+        cache.flush()
+    stats = cache.stats()
+    assert stats['bytes'] <= 200
+    assert stats['evictions'] > 0
+    assert cache.get('a') is None
+    assert cache.get('f') == LABELS
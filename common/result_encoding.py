@@ -0,0 +1,99 @@
+"""
+Encoding of the detection servers' results for their zerorpc clients.
+
+Results are a list with a dict per image of its path ('image') and labels
+('labels'). By default they are returned as a json string. Clients can
+instead ask for 'msgpack', the results as is so they are only serialized
+once by zerorpc's own msgpack encoding, or 'columnar', a compact form
+that stores each distinct labels list once. Streamed results are encoded
+one image at a time.
+
+This is part of the smart-zoneminder project.
+See https://github.com/goruck/smart-zoneminder
+
+Copyright (c) 2018 ~ 2020 Lindo St. Angel
+"""
+
+import json
+
+def columnar_results(results):
+    """
+    Convert results to a compact columnar form.
+
+    Names and faces are replaced by indices into a string table (-1 for None)
+    and each distinct labels list is stored only once, so frames that copied
+    the labels of a previous frame just reference the same label set.
+    """
+    strings = [] # string table
+    string_index = {}
+    def intern(s):
+        if s is None:
+            return -1
+        if s not in string_index:
+            string_index[s] = len(strings)
+            strings.append(s)
+        return string_index[s]
+
+    label_sets = [] # distinct label sets
+    label_set_index = {} # id of labels list -> index in label_sets
+    image_labels = [] # label set index of each image
+    for obj in results:
+        labels = obj['labels']
+        if id(labels) not in label_set_index:
+            label_set = {
+                'id': [label['id'] for label in labels],
+                'name': [intern(label['name']) for label in labels],
+                'score': [label['score'] for label in labels],
+                'box': [[label['box']['xmin'], label['box']['ymin'],
+                    label['box']['xmax'], label['box']['ymax']] for label in labels]
+            }
+            if any('face' in label for label in labels):
+                label_set['face'] = [intern(label.get('face')) for label in labels]
+                label_set['faceProba'] = [label.get('faceProba') for label in labels]
+            if any('track' in label for label in labels):
+                label_set['track'] = [label.get('track') for label in labels]
+            label_set_index[id(labels)] = len(label_sets)
+            label_sets.append(label_set)
+        image_labels.append(label_set_index[id(labels)])
+
+    columnar = {
+        'format': 'columnar',
+        'strings': strings,
+        'images': [obj['image'] for obj in results],
+        'labelSets': label_sets,
+        'imageLabels': image_labels
+    }
+    if any('dedup' in obj for obj in results):
+        columnar['dedup'] = [obj.get('dedup') for obj in results]
+
+    return columnar
+
+def encode_results(results, result_format):
+    """
+    Encode results for return to the zerorpc client.
+
+    'json' returns a json string (default, for compatibility).
+    'msgpack' returns the results as is so they are only serialized once,
+    by zerorpc's own msgpack encoding.
+    'columnar' returns the msgpack'able output of columnar_results().
+    """
+    if result_format == 'json':
+        return json.dumps(results)
+    elif result_format == 'msgpack':
+        return results
+    elif result_format == 'columnar':
+        return columnar_results(results)
+    raise ValueError('Unknown result format {}.'.format(result_format))
+
+def encode_result(result, result_format):
+    """
+    Encode the result of a single image for streaming to the zerorpc client.
+
+    'json' and 'msgpack' are as for encode_results(). Columnar results
+    only make sense for whole batches so they can't be streamed.
+    """
+    if result_format == 'json':
+        return json.dumps(result)
+    elif result_format == 'msgpack':
+        return result
+    raise ValueError('Unknown stream result format {}.'.format(result_format))
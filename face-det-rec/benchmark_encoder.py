@@ -0,0 +1,96 @@
+'''
+Benchmark how face detection and encoding scale with the encoder processes.
+
+Runs detect_faces requests in-process on a directory of jpegs, each
+image a person, e.g. the dataset used by encode_faces.py, with each of
+the given numbers of encoder processes (0 encodes in this process) and
+reports the images done per second and the speedup over the first.
+The number of jitters is fixed so runs are comparable.
+
+Must be run from this directory since it uses config.json like
+face_detect_server.py. The server is not started.
+
+Copyright (c) 2020 Lindo St. Angel
+'''
+
+import argparse
+import logging
+import multiprocessing
+import time
+import cv2
+from glob import glob
+from os import path
+
+import face_detect_server as server
+
+logger = logging.getLogger(__name__)
+
+def person_objects(image_paths):
+    # Fake object detector results with the whole image a person.
+    objects = []
+    for image_path in image_paths:
+        (h, w) = cv2.imread(image_path).shape[:2]
+        objects.append({'image': image_path, 'labels': [{'id': 0, 'name': 'person',
+            'score': 1.0, 'box': {'xmin': 0, 'ymin': 0, 'xmax': w, 'ymax': h}}]})
+    return objects
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--images',
+        required=True,
+        help='directory of jpegs to find faces in, searched recursively')
+    ap.add_argument('--processes',
+        type=int,
+        nargs='+',
+        default=[0, 1, 2, 4, multiprocessing.cpu_count()],
+        help='numbers of encoder processes to benchmark')
+    ap.add_argument('--jitters',
+        type=int,
+        default=server.NUM_JITTERS,
+        help='number of times to re-sample each face')
+    ap.add_argument('--num-images',
+        type=int,
+        default=32,
+        help='number of images per request')
+    ap.add_argument('--repeat',
+        type=int,
+        default=2,
+        help='number of requests to time with each number of processes')
+    args = vars(ap.parse_args())
+
+    logger.setLevel(logging.INFO)
+
+    image_paths = sorted(glob(path.join(args['images'], '**', '*.jpg'),
+        recursive=True))[:args['num_images']]
+    if not image_paths:
+        logger.error('No jpegs found in {}.'.format(args['images']))
+        return
+    images_per_second = []
+    for processes in sorted(set(args['processes'])):
+        server.ENCODER_PROCESSES = processes
+        server.encoder_pool = server.start_encoder_pool(processes)
+        try:
+            rpc = server.DetectRPC()
+            rpc.jitter_policy = server.JitterPolicy(min_jitters=args['jitters'],
+                max_jitters=args['jitters'], target=0)
+            # Warm up the encoder processes.
+            rpc.detect_faces(person_objects(image_paths[:max(1, processes)]), 'msgpack')
+            best = None
+            for _ in range(args['repeat']):
+                objects = person_objects(image_paths)
+                start = time.perf_counter()
+                rpc.detect_faces(objects, 'msgpack')
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            encoded = sum('numJitters' in label for obj in objects for label in obj['labels'])
+        finally:
+            if server.encoder_pool is not None:
+                server.encoder_pool.terminate()
+                server.encoder_pool = None
+        images_per_second.append(len(image_paths) / best)
+        logger.info('{:3d} encoder processes: {:6.2f} s per request, {:6.2f} images/s'
+            ' ({} faces encoded), {:.2f}x'.format(processes, best, images_per_second[-1],
+            encoded, images_per_second[-1] / images_per_second[0]))
+
+if __name__ == '__main__':
+    main()
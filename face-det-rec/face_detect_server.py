@@ -22,6 +22,21 @@ import logging
 import pickle
 import gevent
 import signal
+import time
+import os
+import sys
+import collections
+import multiprocessing
+
+# Modules shared with the other servers.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
+from face_index import load_face_index
+from jitter_policy import JitterPolicy
+from metrics import Metrics, serve_prometheus
+from model_watch import ModelWatcher
+from numpy_svc import NumpySVC
+from result_encoding import encode_result, encode_results
 
 logging.basicConfig(level=logging.ERROR)
 
@@ -37,12 +52,29 @@ ZRPC_HEARTBEAT = config['zerorpcHeartBeat']
 # This must match the zerorpc client config.
 ZRPC_PIPE = config['zerorpcPipe']
 
+# Port of the Prometheus metrics endpoint. Set to 0 to disable it.
+METRICS_PORT = config['metricsPort']
+
 # Settings for face classifier.
 # The model and label encoder need to be generated by 'train.py' first. 
+# A .npz model exported by tpu-servers/export_face_classifier.py has its
+# labels and doesn't need scikit-learn.
 MODEL_PATH = config['modelPath']
 LABEL_PATH = config['labelPath']
 MIN_PROBA = config['minProba']
 
+# Face recognizer, 'svm' for the face classifier or 'knn' for the nearest
+# known faces, which can be added to by the enroll_face RPC.
+RECOGNIZER = config['recognizer']
+# Known face encodings used by the knn recognizer.
+# The pickle file needs to be generated by 'encode_faces.py' first.
+ENCODINGS_PATH = config['encodingsPath']
+# Number of nearest known faces that vote for the name of a face.
+KNN_NEIGHBORS = config['knnNeighbors']
+# Known faces further than this distance from a face don't vote.
+# See https://github.com/ageitgey/face_recognition/wiki/Face-Recognition-Accuracy-Problems.
+KNN_TOLERANCE = config['knnTolerance']
+
 # Images with Variance of Laplacian less than this are declared blurry. 
 FOCUS_MEASURE_THRESHOLD = config['focusMeasureThreshold']
 
@@ -59,35 +91,141 @@ NUMBER_OF_TIMES_TO_UPSAMPLE = config['numFaceImgUpsample']
 # Face detection model to use. Can be either 'cnn' or 'hog'.
 FACE_DET_MODEL = config['faceDetModel']
 
-# How many times to re-sample when calculating face encoding.
+# Max number of times to re-sample when calculating face encoding.
 NUM_JITTERS = config['numJitters']
 
-# Load face recognition model along with the label encoder.
-with open(MODEL_PATH, 'rb') as fp:
-	recognizer = pickle.load(fp)
-with open(LABEL_PATH, 'rb') as fp:
-	le = pickle.load(fp)
-
-def face_classifier(encoding, min_proba):
-	# perform classification to recognize the face based on 128D encoding
-	# note: reshape(1,-1) converts 1D array into 2D
-	preds = recognizer.predict_proba(encoding.reshape(1, -1))[0]
-	j = np.argmax(preds)
-	proba = preds[j]
-	logging.debug('face classifier proba {} name {}'.format(proba, le.classes_[j]))
-	if proba >= min_proba:
-		name = le.classes_[j]
-		logging.debug('face classifier says this is {}'.format(name))
-	else:
-		name = None # prob too low to recog face
-		logging.debug('face classifier cannot recognize face')
-	return name, proba
+# Min number of times to re-sample when busy.
+MIN_JITTERS = config['minJitters']
+
+# Request latency in ms to adapt the number of re-samples to, between
+# the min and max. Set to 0 to always re-sample numJitters times.
+JITTER_LATENCY_TARGET = config['jitterLatencyTarget']
+
+# Number of processes that detect and encode faces in parallel, forked
+# once the dlib models are loaded so they share them. Set to 0 to encode
+# faces in the server process. Use 0 with dlib built with CUDA, which
+# can't be used by forked processes.
+ENCODER_PROCESSES = config['encoderProcesses']
+
+# Seconds between checks for changed face classifier files, which are
+# then reloaded. Set to 0 to only reload them with reload_models.
+MODEL_WATCH_INTERVAL = config['modelWatchInterval']
+
+def load_classifier():
+	# Load face recognition model along with the label encoder.
+	if RECOGNIZER == 'knn':
+		recognizer = load_face_index(ENCODINGS_PATH, KNN_NEIGHBORS, KNN_TOLERANCE)
+		return recognizer, recognizer
+	# An exported .npz classifier has the class names itself, like a label encoder.
+	if MODEL_PATH.endswith('.npz'):
+		recognizer = NumpySVC(MODEL_PATH)
+		return recognizer, recognizer
+	with open(MODEL_PATH, 'rb') as fp:
+		recognizer = pickle.load(fp)
+	with open(LABEL_PATH, 'rb') as fp:
+		le = pickle.load(fp)
+	return recognizer, le
+
+def classifier_paths():
+	# Files the face classifier is loaded from.
+	if RECOGNIZER == 'knn':
+		return [ENCODINGS_PATH]
+	if MODEL_PATH.endswith('.npz'):
+		return [MODEL_PATH]
+	return [MODEL_PATH, LABEL_PATH]
+
+(recognizer, le) = load_classifier()
+
+def face_classifier(encodings, min_proba):
+	# perform classification to recognize the faces based on 128D encodings,
+	# one per row, all in one call
+	preds = recognizer.predict_proba(encodings)
+	j = np.argmax(preds, axis=1)
+	probas = preds[np.arange(len(j)), j]
+	names = []
+	for (k, proba) in zip(j, probas):
+		logging.debug('face classifier proba {} name {}'.format(proba, le.classes_[k]))
+		if proba >= min_proba:
+			names.append(le.classes_[k])
+			logging.debug('face classifier says this is {}'.format(names[-1]))
+		else:
+			names.append(None) # prob too low to recog face
+			logging.debug('face classifier cannot recognize face')
+	return names, probas
 
 def variance_of_laplacian(image):
 	# compute the Laplacian of the image and then return the focus
 	# measure, which is simply the variance of the Laplacian
 	return cv2.Laplacian(image, cv2.CV_64F).var()
 
+def encode_face(roi, num_jitters):
+	# Detect and encode the face in a person roi, re-sampled num_jitters
+	# times. Returns the encoding, or None if no face could be encoded, and
+	# the (stage, seconds) timings of its steps, since this may run in an
+	# encoder process whose metrics the server doesn't see.
+	timings = []
+	# Detect the (x, y)-coordinates of the bounding boxes corresponding
+	# to each face in the input image.
+	rgb = cv2.cvtColor(roi, cv2.COLOR_BGR2RGB)
+	#cv2.imwrite('./rgb.jpg', rgb)
+	start = time.monotonic()
+	detection = face_recognition.face_locations(rgb, NUMBER_OF_TIMES_TO_UPSAMPLE,
+		FACE_DET_MODEL)
+	timings.append(('inference', time.monotonic() - start))
+	if not detection:
+		# No face detected...move on to next image.
+		logging.debug('No face detected.')
+		return None, timings
+
+	# Carve out face roi and check to see if large enough for recognition.
+	start = time.monotonic()
+	face_top, face_right, face_bottom, face_left = detection[0]
+	#cv2.rectangle(rgb, (face_left, face_top), (face_right, face_bottom), (255,0,0), 2)
+	#cv2.imwrite('./face_rgb.jpg', rgb)
+	face_roi = roi[face_top:face_bottom, face_left:face_right]
+	#cv2.imwrite('./face_roi.jpg', face_roi)
+	(f_h, f_w) = face_roi.shape[:2]
+	# If face width or height are not sufficiently large then skip.
+	if f_h < MIN_FACE or f_w < MIN_FACE:
+		logging.debug('Face too small to recognize.')
+		timings.append(('postprocess', time.monotonic() - start))
+		return None, timings
+
+	# Compute the focus measure of the face
+	# using the Variance of Laplacian method.
+	# See https://www.pyimagesearch.com/2015/09/07/blur-detection-with-opencv/
+	gray = cv2.cvtColor(face_roi, cv2.COLOR_BGR2GRAY)
+	fm = variance_of_laplacian(gray)
+	timings.append(('postprocess', time.monotonic() - start))
+	# If fm below a threshold then face probably isn't clear enough
+	# for face recognition to work, so skip it.
+	if fm < FOCUS_MEASURE_THRESHOLD:
+		logging.debug('Face too blurry to recognize.')
+		return None, timings
+
+	# Find the 128-dimension face encoding for face in image.
+	# face_locations in css order (top, right, bottom, left)
+	face_location = (face_top, face_right, face_bottom, face_left)
+	start = time.monotonic()
+	encoding = face_recognition.face_encodings(rgb,
+		known_face_locations=[face_location], num_jitters=num_jitters)[0]
+	timings.append(('encode', time.monotonic() - start))
+	logging.debug('face encoding {}'.format(encoding))
+	return encoding, timings
+
+def start_encoder_pool(processes):
+	# Fork processes that run encode_face(), or return None if processes is 0.
+	# The dlib models were loaded by importing face_recognition, so they are
+	# shared with this process copy-on-write instead of loaded again.
+	if not processes:
+		return None
+	# Ctrl-C stops the server, which then terminates the pool.
+	return multiprocessing.get_context('fork').Pool(processes,
+		initializer=signal.signal, initargs=(signal.SIGINT, signal.SIG_IGN))
+
+# Pool of encoder processes, started with the server.
+encoder_pool = None
+
 def image_resize(image, width=None, height=None, inter=cv2.INTER_AREA):
     # ref: https://stackoverflow.com/questions/44650888/resize-an-image-without-distortion-opencv
 
@@ -123,103 +261,256 @@ def image_resize(image, width=None, height=None, inter=cv2.INTER_AREA):
 
 # Define zerorpc class.
 class DetectRPC(object):
-    def detect_faces(self, test_image_paths):
-        # List that will hold all images with any face detection information. 
-        objects_detected_faces = []
-
-        # Loop over the images paths provided. 
-        for obj in test_image_paths:
-            logging.debug('**********Find Face(s) for {}'.format(obj['image']))
-            for label in obj['labels']:
-                # If the object detected is a person then try to identify face. 
-                if label['name'] == 'person':
-                    # Read image from disk. 
-                    img = cv2.imread(obj['image'])
-                    if img is None:
-                        # Bad image was read.
-                        logging.error('Bad image was read.')
-                        label['face'] = None
-                        continue
-
-                    # First bound the roi using the coord info passed in.
-                    # The roi is area around person(s) detected in image.
-                    # (x1, y1) are the top left roi coordinates.
-                    # (x2, y2) are the bottom right roi coordinates.
-                    y2 = int(label['box']['ymin'])
-                    x1 = int(label['box']['xmin'])
-                    y1 = int(label['box']['ymax'])
-                    x2 = int(label['box']['xmax'])
-                    roi = img[y2:y1, x1:x2]
-                    #cv2.imwrite('./roi.jpg', roi)
-                    if roi.size == 0:
-                        # Bad object roi...move on to next image.
-                        logging.error('Bad object roi.')
-                        label['face'] = None
-                        continue
-
-                    # Detect the (x, y)-coordinates of the bounding boxes corresponding
-                    # to each face in the input image.
-                    rgb = cv2.cvtColor(roi, cv2.COLOR_BGR2RGB)
-                    #cv2.imwrite('./rgb.jpg', rgb)
-                    detection = face_recognition.face_locations(rgb, NUMBER_OF_TIMES_TO_UPSAMPLE,
-                        FACE_DET_MODEL)
-                    if not detection:
-                        # No face detected...move on to next image.
-                        logging.debug('No face detected.')
-                        label['face'] = None
-                        continue
-
-                    # Carve out face roi and check to see if large enough for recognition.
-                    face_top, face_right, face_bottom, face_left = detection[0]
-                    #cv2.rectangle(rgb, (face_left, face_top), (face_right, face_bottom), (255,0,0), 2)
-                    #cv2.imwrite('./face_rgb.jpg', rgb)
-                    face_roi = roi[face_top:face_bottom, face_left:face_right]
-                    #cv2.imwrite('./face_roi.jpg', face_roi)
-                    (f_h, f_w) = face_roi.shape[:2]
-                    # If face width or height are not sufficiently large then skip.
-                    if f_h < MIN_FACE or f_w < MIN_FACE:
-                        logging.debug('Face too small to recognize.')
+    def __init__(self):
+        # Latency and throughput metrics.
+        self.metrics = Metrics('faces')
+        # Number of face encoder re-samples adapted to the load.
+        self.jitter_policy = JitterPolicy(min_jitters=MIN_JITTERS,
+            max_jitters=NUM_JITTERS, target=JITTER_LATENCY_TARGET / 1000.)
+        # Number of requests being processed.
+        self.active = 0
+        # Reloads the face classifier when its files change.
+        self._watcher = ModelWatcher('faces', classifier_paths(), self.reload_models)
+        self._watcher.update()
+        if MODEL_WATCH_INTERVAL:
+            gevent.spawn(self._watcher.watch, MODEL_WATCH_INTERVAL)
+
+    def _imread(self, image_path):
+        # Read and decode an image like cv2.imread, timing each step.
+        try:
+            with self.metrics.timer('read'), open(image_path, 'rb') as f:
+                buf = f.read()
+        except OSError:
+            return None
+        if not buf:
+            return None
+        with self.metrics.timer('decode'):
+            return cv2.imdecode(np.frombuffer(buf, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+    def _submit(self, roi, num_jitters):
+        # Start encoding the face in a person roi on the encoder processes.
+        # Without them it's encoded when gathered.
+        if encoder_pool is None:
+            return (roi, num_jitters)
+        return encoder_pool.apply_async(encode_face, (roi, num_jitters))
+
+    def _gather(self, pending):
+        # Return the encodings of submitted faces in order and record their timings.
+        if encoder_pool is None:
+            outputs = [encode_face(roi, num_jitters) for (roi, num_jitters) in pending]
+        else:
+            # Wait on a native thread so the gevent hub keeps serving.
+            outputs = gevent.get_hub().threadpool.apply(
+                lambda: [result.get() for result in pending])
+        encodings = []
+        for (encoding, timings) in outputs:
+            for (stage, seconds) in timings:
+                self.metrics.observe(stage, seconds)
+            encodings.append(encoding)
+        return encodings
+
+    def _submit_faces(self, obj):
+        # Submit the faces of the persons in an image to the encoder and
+        # return their (label, num_jitters, pending encoding).
+        faces = []
+        logging.debug('**********Find Face(s) for {}'.format(obj['image']))
+        # Read image from disk only once and only if it has a person in it.
+        # All person rois in the image are carved out of this single decode.
+        img = None
+        if any(label['name'] == 'person' for label in obj['labels']):
+            img = self._imread(obj['image'])
+            if img is None:
+                logging.error('Bad image was read.')
+                self.metrics.count('errors')
+        for label in obj['labels']:
+            # If the object detected is a person then try to identify face. 
+            if label['name'] == 'person':
+                if img is None:
+                    # Bad image was read.
+                    label['face'] = None
+                    continue
+
+                # First bound the roi using the coord info passed in.
+                # The roi is area around person(s) detected in image.
+                # (x1, y1) are the top left roi coordinates.
+                # (x2, y2) are the bottom right roi coordinates.
+                y2 = int(label['box']['ymin'])
+                x1 = int(label['box']['xmin'])
+                y1 = int(label['box']['ymax'])
+                x2 = int(label['box']['xmax'])
+                roi = img[y2:y1, x1:x2]
+                #cv2.imwrite('./roi.jpg', roi)
+                if roi.size == 0:
+                    # Bad object roi...move on to next image.
+                    logging.error('Bad object roi.')
+                    self.metrics.count('errors')
+                    label['face'] = None
+                    continue
+
+                # Fewer re-samples if other requests are waiting.
+                num_jitters = self.jitter_policy.choose(self.active - 1)
+                faces.append((label, num_jitters, self._submit(roi, num_jitters)))
+        return faces
+
+    def _detect_faces(self, test_image_paths):
+        # Yield each image with any face detection information as soon as it
+        # is done along with the (label, encoding) of its persons' faces to classify.
+        # The faces of the next images are submitted while waiting for an
+        # image's faces, up to twice the encoder processes, to keep them busy.
+        pending = collections.deque()
+        num_pending = 0
+        images = iter(test_image_paths)
+        while True:
+            obj = next(images, None)
+            if obj is not None:
+                faces = self._submit_faces(obj)
+                pending.append((obj, faces))
+                num_pending += len(faces)
+            while pending and (obj is None or not pending[0][1]
+                or num_pending > 2 * ENCODER_PROCESSES):
+                (done, faces) = pending.popleft()
+                num_pending -= len(faces)
+                encodings = self._gather([job for (_, _, job) in faces])
+                encoded = []
+                for ((label, num_jitters, _), encoding) in zip(faces, encodings):
+                    if encoding is None:
                         label['face'] = None
                         continue
-
-                    # Compute the focus measure of the face
-                    # using the Variance of Laplacian method.
-                    # See https://www.pyimagesearch.com/2015/09/07/blur-detection-with-opencv/
-                    gray = cv2.cvtColor(face_roi, cv2.COLOR_BGR2GRAY)
-                    fm = variance_of_laplacian(gray)
-                    # If fm below a threshold then face probably isn't clear enough
-                    # for face recognition to work, so skip it. 
-                    if fm < FOCUS_MEASURE_THRESHOLD:
-                        logging.debug('Face too blurry to recognize.')
-                        label['face'] = None
-                        continue
-
-                    # Find the 128-dimension face encoding for face in image.
-                    # face_locations in css order (top, right, bottom, left)
-                    face_location = (face_top, face_right, face_bottom, face_left)
-                    encoding = face_recognition.face_encodings(rgb,
-                        known_face_locations=[face_location], num_jitters=NUM_JITTERS)[0]
-                    logging.debug('face encoding {}'.format(encoding))
-                    # Perform classification on the encodings to recognize the face.
-                    (name, proba) = face_classifier(encoding, MIN_PROBA)
-
-                    # Add face name to label metadata.
-                    label['face'] = name
-                    # Add face confidence to label metadata.
-                    # (First convert NumPy value to native Python type for json serialization.)
-                    label['faceProba'] = proba.item()
-
-	        # Add processed image to output list. 
-            objects_detected_faces.append(obj)
-
-        # Convert json to string and return data. 
-        return(json.dumps(objects_detected_faces))
-
-s = zerorpc.Server(DetectRPC(), heartbeat=ZRPC_HEARTBEAT)
-s.bind(ZRPC_PIPE)
-# Register graceful ways to stop server. 
-gevent.signal(signal.SIGINT, s.stop) # Ctrl-C
-gevent.signal(signal.SIGTERM, s.stop) # termination
-# Start server.
-# This will block until a gevent signal is caught
-s.run()
\ No newline at end of file
+                    # Add number of re-samples to label metadata.
+                    label['numJitters'] = num_jitters
+                    encoded.append((label, encoding))
+
+                # Output processed image.
+                self.metrics.count('frames')
+                yield done, encoded
+            if obj is None:
+                return
+
+    def _classify(self, faces):
+        # Perform classification on the encodings of faces in one batch.
+        if not faces:
+            return
+        with self.metrics.timer('classify'):
+            (names, probas) = face_classifier(np.array([encoding for (_, encoding) in faces]),
+                MIN_PROBA)
+        for ((label, _), name, proba) in zip(faces, names, probas):
+            # Add face name to label metadata.
+            label['face'] = name
+            # Add face confidence to label metadata.
+            # (First convert NumPy value to native Python type for json serialization.)
+            label['faceProba'] = proba.item()
+
+    def _run(self, test_image_paths, stream):
+        # Yield the results of _detect_faces() and adapt the face encoder
+        # re-samples to the latency of the request if it encoded faces.
+        # The faces of all images are classified at once, or of each image
+        # as soon as it's done if stream.
+        start = time.monotonic()
+        encoded = False
+        self.active += 1
+        try:
+            images = []
+            faces = []
+            for (obj, obj_faces) in self._detect_faces(test_image_paths):
+                encoded = encoded or bool(obj_faces)
+                images.append(obj)
+                faces.extend(obj_faces)
+                if stream:
+                    self._classify(faces)
+                    faces = []
+                    yield images.pop()
+            self._classify(faces)
+            for obj in images:
+                yield obj
+        finally:
+            self.active -= 1
+        if encoded:
+            self.jitter_policy.observe(time.monotonic() - start)
+
+    def detect_faces(self, test_image_paths, result_format='json'):
+        # List that will hold all images with any face detection information. 
+        objects_detected_faces = list(self._run(test_image_paths, stream=False))
+
+        # Encode results in requested format and return data.
+        with self.metrics.timer('serialize'):
+            return encode_results(objects_detected_faces, result_format)
+
+    @zerorpc.stream
+    def detect_faces_stream(self, test_image_paths, result_format='json'):
+        # Stream the result of each image as soon as it is done.
+        for obj in self._run(test_image_paths, stream=True):
+            with self.metrics.timer('serialize'):
+                data = encode_result(obj, result_format)
+            yield data
+
+    def get_stats(self):
+        # Return the latency and throughput metrics of the server.
+        return dict(self.metrics.stats(), jitters=self.jitter_policy.stats(),
+            knownFaces=recognizer.stats() if RECOGNIZER == 'knn' else None)
+
+    def reload_models(self):
+        # Reload the face classifier, e.g. after retraining with train.py.
+        # It's loaded on a native thread so requests are served meanwhile
+        # and then swapped in as a whole, the old one is kept on errors.
+        global recognizer, le
+        self._watcher.update()
+        (recognizer, le) = gevent.get_hub().threadpool.apply(load_classifier)
+        return True
+
+    def enroll_face(self, name, test_image_paths):
+        """
+        Add the faces of the persons in images to the known faces of name.
+
+        test_image_paths are images with person labels like for detect_faces.
+        Needs the knn face recognizer. The faces are recognized by the next
+        requests without retraining and saved to the known face encodings.
+        Returns the number of faces added.
+        """
+        if RECOGNIZER != 'knn':
+            raise RuntimeError('Enrolling faces needs the knn face recognizer.')
+        pending = []
+        for obj in test_image_paths:
+            persons = [label for label in obj['labels'] if label['name'] == 'person']
+            if not persons:
+                continue
+            img = self._imread(obj['image'])
+            if img is None:
+                logging.error('Bad image was read.')
+                self.metrics.count('errors')
+                continue
+            for label in persons:
+                roi = img[int(label['box']['ymin']):int(label['box']['ymax']),
+                    int(label['box']['xmin']):int(label['box']['xmax'])]
+                if roi.size == 0:
+                    logging.error('Bad object roi.')
+                    self.metrics.count('errors')
+                    continue
+                # Encode the faces as well as possible.
+                pending.append(self._submit(roi, NUM_JITTERS))
+        encodings = [encoding for encoding in self._gather(pending) if encoding is not None]
+        if encodings:
+            index = recognizer
+            index.add([name] * len(encodings), encodings)
+            gevent.get_hub().threadpool.apply(index.save, (ENCODINGS_PATH,))
+            # The file was changed by this server, no need to reload it.
+            self._watcher.update()
+        logging.info('Enrolled {} faces of {}.'.format(len(encodings), name))
+        return len(encodings)
+
+if __name__ == '__main__':
+    # Fork the encoder processes before the server starts any threads.
+    encoder_pool = start_encoder_pool(ENCODER_PROCESSES)
+    zerorpc_obj = DetectRPC()
+    s = zerorpc.Server(zerorpc_obj, heartbeat=ZRPC_HEARTBEAT)
+    s.bind(ZRPC_PIPE)
+    # Serve metrics to Prometheus.
+    if METRICS_PORT:
+        serve_prometheus(METRICS_PORT, [zerorpc_obj.metrics])
+    # Register graceful ways to stop server. 
+    gevent.signal(signal.SIGINT, s.stop) # Ctrl-C
+    gevent.signal(signal.SIGTERM, s.stop) # termination
+    # Start server.
+    # This will block until a gevent signal is caught
+    s.run()
+    if encoder_pool is not None:
+        encoder_pool.terminate()
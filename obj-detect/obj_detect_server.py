@@ -19,6 +19,21 @@ import zerorpc
 import logging
 import gevent
 import signal
+import time
+import os
+import sys
+import hashlib
+
+# Modules shared with the other servers.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
+from jpeg_decode import imdecode_scaled
+from metrics import Metrics, serve_prometheus
+from monitor_state import (MonitorStates, frame_signature, parse_image_path,
+    signature_distance, skip_inference)
+from result_cache import ResultCache, model_id
+from result_encoding import encode_result, encode_results
+
 # Object detection imports.
 from object_detection.utils import label_map_util
 # For tensorrt optimized models...
@@ -44,6 +59,10 @@ NUM_CLASSES = config['numClasses']
 # If consecutive ZoneMinder image frames are found then skip this many after the first.
 CON_IMG_SKIP = config['conseqImagesToSkip']
 
+# Seconds to remember the last inferred frame of a monitor across requests
+# for skipping consecutive (conseqImagesToSkip) and unchanged (dedupThreshold) frames.
+FRAME_STATE_TTL = config['frameStateTTL']
+
 # Minimum score for valid TF object detection. 
 MIN_SCORE_THRESH = config['minScore']
 
@@ -52,6 +71,24 @@ MIN_SCORE_THRESH = config['minScore']
 CROP_IMAGE_WIDTH = config['cropImageWidth']
 CROP_IMAGE_HEIGHT = config['cropImageHeight']
 
+# Decode jpegs at reduced resolution when much larger than the crop size.
+REDUCED_DECODE = config['reducedDecode']
+
+# Reuse the labels of the last inferred frame from the same monitor if no region
+# of the scene has changed by this much (mean gray level, 0 ~ 255) since then.
+# Set to 0 to always run inference.
+DEDUP_THRESHOLD = config['dedupThreshold']
+
+# Path of the sqlite database that caches detection results across requests
+# and restarts, keyed by image contents.
+RESULT_CACHE_PATH = config['resultCachePath']
+
+# Size budget of the result cache in MB. Set to 0 to disable caching.
+RESULT_CACHE_MB = config['resultCacheMBytes']
+
+# Port of the Prometheus metrics endpoint. Set to 0 to disable it.
+METRICS_PORT = config['metricsPort']
+
 # Heartbeat interval for zerorpc client in ms.
 # This must match the zerorpc client config. 
 ZRPC_HEARTBEAT = config['zerorpcHeartBeat']
@@ -80,86 +117,130 @@ categories = label_map_util.convert_label_map_to_categories(label_map,
     max_num_classes=NUM_CLASSES, use_display_name=True)
 category_index = label_map_util.create_category_index(categories)
 
-def skip_inference(frame_num, monitor, labels, image_path, objects_in_image):
-    """
-    If consecutive frames then repeat last label and skip a new inference.
-    
-    Image paths must be in the form of:
-    '/nvr/zoneminder/events/BackPorch/18/06/20/19/20/04/00224-capture.jpg'.
-    """
-
-    old_frame_num = frame_num
-    old_monitor = monitor
-    skip = False
-
-    if CON_IMG_SKIP == 0: return skip, frame_num, monitor
-
-    try:
-        frame_num = int((image_path.split('/')[-1]).split('-')[0])
-        monitor = image_path.split('/')[4]
-    except (ValueError, IndexError):
-        logger.error('Could not derive information from image path.')
-        objects_in_image.append({'image': image_path, 'labels': []})
-        skip = True
-        return skip, frame_num, monitor
-                    
-    # Only apply skip logic if frames are from the same monitor. 
-    if monitor == old_monitor:
-        # Only apply skip logic if alarm frames are from the same event.
-        # Intra-event frames are monotonically increasing.
-        frame_diff = frame_num - old_frame_num
-        if frame_diff > 0:
-            # Skip CON_IMG_SKIP frames after the first one. 
-            if frame_diff <= CON_IMG_SKIP:
-                objects_in_image.append({'image': image_path, 'labels': labels})
-                logger.debug('monitor {} old_monitor {} frame_num {} old_frame_num {}'
-                    .format(monitor,old_monitor,frame_num,old_frame_num))
-                logger.debug('Consecutive frame {}, skipping detect and copying previous labels.'
-                    .format(frame_num))
-                skip = True
-                        
-    return skip, frame_num, monitor
-
 # zerorpc class.
 class DetectRPC(object):
     def __init__(self):
         logger.debug('Starting tf sess.')
         self.sess = tf.compat.v1.Session(config=config, graph=detection_graph)
+        # Latency and throughput metrics.
+        self.metrics = Metrics('objects')
+        # Last inferred frame of each monitor.
+        self.monitor_states = MonitorStates(ttl=FRAME_STATE_TTL)
+        # Results of earlier requests. The model files are only hashed
+        # for the id of the results if they are cached.
+        self.result_cache = ResultCache(db_path=RESULT_CACHE_PATH, table='objects',
+            model=model_id([PATH_TO_MODEL, PATH_TO_LABEL_MAP],
+                {'minScore': MIN_SCORE_THRESH, 'cropImageWidth': CROP_IMAGE_WIDTH,
+                'cropImageHeight': CROP_IMAGE_HEIGHT, 'reducedDecode': REDUCED_DECODE})
+                if RESULT_CACHE_MB else None,
+            max_bytes=RESULT_CACHE_MB * 1024 * 1024)
 
     def close_sess(self):
         logger.debug('Closing tf sess.')
         self.sess.close()
 
-    def detect_objects(self, test_image_paths):
-        objects_in_image = [] # holds all objects found in image
-        labels = [] # labels of detected objects
-        frame_num = 0 # ZoneMinder current alarm frame number
-        monitor = '' # ZoneMinder current monitor name
+    def _detect_objects(self, test_image_paths):
+        """
+        Find objects in images.
+
+        Yields the (index, result) of each image as soon as it is done, in
+        the order the images are processed.
+        """
         (img_width, img_height) = (CROP_IMAGE_WIDTH, CROP_IMAGE_HEIGHT)
 
-        for image_path in test_image_paths:
+        # Process images ordered by monitor, event and frame number so that
+        # consecutive frame skipping works no matter how the client orders them.
+        image_infos = [parse_image_path(image_path) for image_path in test_image_paths]
+        order = sorted(range(len(test_image_paths)),
+            key=lambda i: image_infos[i] or ('', '', 0))
+
+        for i in order:
+            image_path = test_image_paths[i]
             logger.debug('**********Find object(s) for {}'.format(image_path))
+            if image_infos[i] is None:
+                logger.error('Could not derive information from image path.')
+                self.metrics.count('errors')
+                monitor = state = None
+            else:
+                monitor = image_infos[i][0]
+                state = self.monitor_states.get(monitor)
 
             # If consecutive frames then repeat last label and skip inference.
             # This behavior controlled by CON_IMG_SKIP.
-            skip, frame_num, monitor = skip_inference(frame_num, monitor,
-                labels, image_path, objects_in_image)
-            if skip is True:
+            if state is not None and skip_inference(image_infos[i],
+                (state['event'], state['frame_num']), CON_IMG_SKIP):
+                logger.debug('Consecutive frame {}, skipping detect and copying previous labels.'
+                    .format(image_path))
+                self.metrics.count('skips')
+                yield i, {'image': image_path, 'labels': state['labels']}
+                continue
+
+            # Read image file from disk.
+            try:
+                with self.metrics.timer('read'), open(image_path, 'rb') as f:
+                    buf = f.read()
+            except OSError:
+                buf = b''
+            if not buf:
+                # Bad image was read.
+                logger.error('Bad image was read.')
+                self.metrics.count('errors')
+                yield i, {'image': image_path, 'labels': []}
                 continue
 
-            # Read image from disk. 
-            img = cv2.imread(image_path)
+            # Use the labels found for this image by an earlier request.
+            digest = hashlib.sha1(buf).hexdigest() if self.result_cache.enabled else None
+            labels = self.result_cache.get(digest)
+            if labels is not None:
+                self.metrics.count('cache_hits')
+                if monitor is not None:
+                    (_, event, frame_num) = image_infos[i]
+                    self.monitor_states.update(monitor, event=event, frame_num=frame_num,
+                        labels=labels, signature=None)
+                yield i, {'image': image_path, 'labels': labels}
+                continue
+
+            # Decode image.
+            # The image is resized to the crop size anyway so it can be
+            # decoded at a reduced resolution that is still at least that large.
+            with self.metrics.timer('decode'):
+                if REDUCED_DECODE:
+                    (img, img_size) = imdecode_scaled(buf, img_width, img_height)
+                else:
+                    img = cv2.imdecode(np.frombuffer(buf, dtype=np.uint8), cv2.IMREAD_COLOR)
+                    img_size = None if img is None else img.shape[:2]
             #cv2.imwrite('./img.jpg', img)
             if img is None:
                 # Bad image was read.
                 logger.error('Bad image was read.')
-                objects_in_image.append({'image': image_path, 'labels': []})
+                self.metrics.count('errors')
+                yield i, {'image': image_path, 'labels': []}
                 continue
 
             # Resize to minimize tf processing.
             # Note: resize will slightly lower accuracy. 640 x 480 seems like a good balance.
-            res = cv2.resize(img, dsize=(img_width, img_height), interpolation=cv2.INTER_AREA)
+            with self.metrics.timer('resize'):
+                res = cv2.resize(img, dsize=(img_width, img_height), interpolation=cv2.INTER_AREA)
             #cv2.imwrite('./res.jpg', res)
+
+            # If the scene hasn't materially changed since the last inferred
+            # frame from this monitor then repeat its labels and skip inference.
+            # This behavior controlled by DEDUP_THRESHOLD.
+            if DEDUP_THRESHOLD > 0:
+                signature = frame_signature(res)
+                distance = (None if state is None or state['signature'] is None
+                    else signature_distance(signature, state['signature']))
+                dedup = {'distance': distance,
+                    'reused': distance is not None and distance < DEDUP_THRESHOLD}
+                logger.debug('Scene change distance {} reused labels {}.'
+                    .format(distance, dedup['reused']))
+                if dedup['reused']:
+                    self.metrics.count('skips')
+                    yield i, {'image': image_path, 'labels': state['labels'], 'dedup': dedup}
+                    continue
+            else:
+                signature = None
+
             # Format np array for tf use. 
             image_tf = res.astype(np.uint8)
             # Expand dimensions since the model expects images to have shape: [1, None, None, 3]
@@ -177,13 +258,15 @@ class DetectRPC(object):
             num_detections = detection_graph.get_tensor_by_name('num_detections:0')
 
             # Actual detection.
-            (boxes, scores, classes, num_detections) = self.sess.run(
-                [boxes, scores, classes, num_detections],
-                feed_dict={image_tensor: image_tf_expanded})
+            with self.metrics.timer('inference'):
+                (boxes, scores, classes, num_detections) = self.sess.run(
+                    [boxes, scores, classes, num_detections],
+                    feed_dict={image_tensor: image_tf_expanded})
 
             # Get labels and scores of detected objects.
+            start = time.monotonic()
             labels = [] # new detection, clear labels list.
-            (h, w) = img.shape[:2] # use original image size for box coords
+            (h, w) = img_size # use original image size for box coords
             for index, value in enumerate(classes[0]):
                 if scores[0, index] > MIN_SCORE_THRESH:
                     object_dict = {}
@@ -193,21 +276,62 @@ class DetectRPC(object):
                     (ymin, xmin, ymax, xmax) = boxes[0, index] * np.array([h, w, h, w])
                     object_dict['box'] = {'ymin': ymin, 'xmin': xmin, 'ymax': ymax, 'xmax': xmax}
                     labels.append(object_dict)
-
-            objects_in_image.append({'image': image_path, 'labels': labels})
-
-        return json.dumps(objects_in_image)
+            self.metrics.observe('postprocess', time.monotonic() - start)
+
+            self.result_cache.put(digest, labels)
+
+            # Remember this frame for skipping frames of this monitor
+            # in this and later requests.
+            if monitor is not None:
+                (_, event, frame_num) = image_infos[i]
+                self.monitor_states.update(monitor, event=event, frame_num=frame_num,
+                    labels=labels, signature=signature)
+
+            result = {'image': image_path, 'labels': labels}
+            if DEDUP_THRESHOLD > 0:
+                result['dedup'] = dedup
+            yield i, result
+
+        logger.debug('result cache stats {}'.format(self.result_cache.stats()))
+
+    def detect_objects(self, test_image_paths, result_format='json'):
+        # Results in the same order as the image paths.
+        objects_in_image = [None] * len(test_image_paths)
+        for (i, result) in self._detect_objects(test_image_paths):
+            objects_in_image[i] = result
+            self.metrics.count('frames')
+        # Encode results in requested format and return data.
+        with self.metrics.timer('serialize'):
+            return encode_results(objects_in_image, result_format)
+
+    @zerorpc.stream
+    def detect_objects_stream(self, test_image_paths, result_format='json'):
+        # Stream the result of each image as soon as it is done.
+        for (_, result) in self._detect_objects(test_image_paths):
+            self.metrics.count('frames')
+            with self.metrics.timer('serialize'):
+                data = encode_result(result, result_format)
+            yield data
+
+    def get_stats(self):
+        # Return the latency and throughput metrics of the server and its result cache.
+        return dict(self.metrics.stats(), resultCache=self.result_cache.stats())
 
 # Create zerorpc object. 
 zerorpc_obj = DetectRPC()
 # Create and bind zerorpc server. 
 s = zerorpc.Server(zerorpc_obj, heartbeat=ZRPC_HEARTBEAT)
 s.bind(ZRPC_PIPE)
+# Serve metrics to Prometheus.
+if METRICS_PORT:
+    serve_prometheus(METRICS_PORT, [zerorpc_obj.metrics])
 # Register graceful ways to stop server. 
 gevent.signal(signal.SIGINT, s.stop) # Ctrl-C
 gevent.signal(signal.SIGTERM, s.stop) # termination
 # Start server.
 # This will block until a gevent signal is caught
 s.run()
+# Write the results still waiting to be cached.
+zerorpc_obj.result_cache.flush()
 # After server is stopped then close the tf session. 
 zerorpc_obj.close_sess()
\ No newline at end of file
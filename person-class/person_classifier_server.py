@@ -11,13 +11,23 @@ Copyright (c) 2019, 2020 Lindo St. Angel
 """
 
 import numpy as np
-import tensorflow as tf
 import cv2
 import json
 import zerorpc
 import logging
 import gevent
 import signal
+import time
+import os
+import sys
+from gevent.event import Event
+
+# Modules shared with the other servers.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
+from metrics import Metrics, serve_prometheus
+from model_watch import ModelWatcher
+from result_encoding import encode_result, encode_results
 
 logging.basicConfig(
     format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
@@ -35,8 +45,8 @@ PATH_TO_MODEL = config['savedModel']
 # Model input size.
 MODEL_INPUT_SIZE = tuple(config['modelInputSize'])
 
-# Model preprocessor function.
-PREPROCESSOR = eval(config['preprocessor'])
+# Model preprocessor function, evaluated once tensorflow is imported.
+PREPROCESSOR = config['preprocessor']
 
 # Minimum score for valid TF person detection. 
 MIN_PROBA = config['minProba']
@@ -52,48 +62,182 @@ ZRPC_PIPE = config['zerorpcPipe']
 # Get tf label map. 
 LABEL_MAP = config['labelMap']
 
-# Limit GPU memory growth.
-gpus = tf.config.experimental.list_physical_devices('GPU')
-if gpus:
-    try:
-        for gpu in gpus:
-            tf.config.experimental.set_memory_growth(gpu, True)
-        logical_gpus = tf.config.experimental.list_logical_devices('GPU')
-        logger.debug(f'{len(gpus)} Physical GPUs, {len(logical_gpus)} Logical GPUs')
-    except RuntimeError as e:
-        # Memory growth must be set before GPUs have been initialized
-        logger.debug(e)
-
-# Load model and prepare for inference.
-# See: https://www.tensorflow.org/guide/saved_model
-loaded = tf.saved_model.load(PATH_TO_MODEL)
-infer = loaded.signatures['serving_default']
-logger.debug('Model output info {}:'.format(infer.structured_outputs))
-output = list(infer.structured_outputs.keys())[0]
+# Port of the Prometheus metrics endpoint. Set to 0 to disable it.
+METRICS_PORT = config['metricsPort']
+
+# Seconds between checks for a changed saved model, which is then
+# reloaded. Set to 0 to only reload it with reload_models.
+MODEL_WATCH_INTERVAL = config['modelWatchInterval']
+
+# TensorFlow is imported along with the model in the background
+# by DetectRPC.load_models() so the server starts right away.
+tf = None
 
 # zerorpc class.
 class DetectRPC(object):
     def __init__(self):
         logger.debug('Starting server for person classification.')
-        # add optional init statements
+        # Latency and throughput metrics.
+        self.metrics = Metrics('persons')
+        # Model warm up state, 'loading', 'ready' or 'failed'.
+        self.state = 'loading'
+        self.error = None
+        self.load_time = None
+        self.reloads = 0
+        # Model in use as returned by load_models(), set once loaded.
+        self.models = None
+        self._loading = False
+        # Reloads the model when the saved model files change.
+        self._watcher = ModelWatcher('persons',
+            [os.path.join(PATH_TO_MODEL, 'saved_model.pb'),
+            os.path.join(PATH_TO_MODEL, 'variables', 'variables.index')],
+            self._reload_changed)
+        self._loaded = Event()
+        gevent.spawn(self._warm_up)
+        if MODEL_WATCH_INTERVAL:
+            gevent.spawn(self._watcher.watch, MODEL_WATCH_INTERVAL)
+
+    def load_models(self):
+        # Import tensorflow, load the model and warm it up and return it
+        # in a dict, run on a native thread.
+        global tf
+        import tensorflow as tf
+
+        # Limit GPU memory growth.
+        gpus = tf.config.experimental.list_physical_devices('GPU')
+        if gpus:
+            try:
+                for gpu in gpus:
+                    tf.config.experimental.set_memory_growth(gpu, True)
+                logical_gpus = tf.config.experimental.list_logical_devices('GPU')
+                logger.debug(f'{len(gpus)} Physical GPUs, {len(logical_gpus)} Logical GPUs')
+            except RuntimeError as e:
+                # Memory growth must be set before GPUs have been initialized
+                logger.debug(e)
+
+        # Load model and prepare for inference.
+        # See: https://www.tensorflow.org/guide/saved_model
+        preprocessor = eval(PREPROCESSOR)
+        loaded = tf.saved_model.load(PATH_TO_MODEL)
+        infer = loaded.signatures['serving_default']
+        logger.debug('Model output info {}:'.format(infer.structured_outputs))
+        output = list(infer.structured_outputs.keys())[0]
+
+        # The first inference is much slower than the rest.
+        dummy = np.zeros((1,) + MODEL_INPUT_SIZE[::-1] + (3,), dtype=np.float32)
+        infer(tf.constant(preprocessor(dummy)))[output].numpy()
+        # The signature needs the loaded model, which is kept along with it.
+        return {'model': loaded, 'preprocessor': preprocessor, 'infer': infer,
+            'output': output}
+
+    def _warm_up(self):
+        # Load the model on the hub's thread pool so the server answers
+        # meanwhile, then swap it in. Requests that are already running
+        # finish on the old model, which is freed once they are done.
+        # The old model is kept if the new one fails to load.
+        self._loading = True
+        self._watcher.update()
+        start = time.monotonic()
+        try:
+            models = gevent.get_hub().threadpool.apply(self.load_models)
+        except Exception as e:
+            logger.exception('Loading the model failed.')
+            self.error = str(e)
+            if self.models is None:
+                self.state = 'failed'
+        else:
+            if self.models is not None:
+                self.reloads += 1
+            self.models = models
+            self.state = 'ready'
+            self.error = None
+        self.load_time = round(time.monotonic() - start, 3)
+        logger.info('Model {} after {} s.'.format(
+            'ready' if self.error is None else 'failed', self.load_time))
+        self._loading = False
+        self._loaded.set()
+
+    def _reload_changed(self):
+        # Reload the model after its files changed, unless it is
+        # already being loaded.
+        if self._loading:
+            return False
+        self._warm_up()
+
+    def reload_models(self):
+        """
+        Reload the model in the background, e.g. after retraining with train.py.
+
+        Returns False if the model is already being loaded.
+        """
+        if self._loading:
+            return False
+        self._loading = True
+        gevent.spawn(self._warm_up)
+        return True
+
+    def wait_ready(self, timeout=None):
+        """
+        Wait up to timeout seconds, forever if None, for the model to be ready.
+
+        Returns True if it is ready.
+        """
+        self._loaded.wait(timeout)
+        return self.state == 'ready'
+
+    def ready(self):
+        # Return True once the model is loaded and warmed up.
+        return self.state == 'ready'
+
+    def health(self):
+        # Return the warm up state of the model.
+        return {
+            'name': 'persons',
+            'state': self.state,
+            'ready': self.state == 'ready',
+            'loadTime': self.load_time,
+            'reloads': self.reloads,
+            'error': self.error
+        }
+
+    def _imread(self, image_path):
+        # Read and decode an image like cv2.imread, timing each step.
+        try:
+            with self.metrics.timer('read'), open(image_path, 'rb') as f:
+                buf = f.read()
+        except OSError:
+            return None
+        if not buf:
+            return None
+        with self.metrics.timer('decode'):
+            return cv2.imdecode(np.frombuffer(buf, dtype=np.uint8), cv2.IMREAD_COLOR)
 
     def close_server(self):
         logger.debug('Closing server for person classification.')
         # add optional close statements
 
-    def detect_faces(self, test_image_paths):
-        # List that will hold all images with any person classifications. 
-        objects_classified_persons = []
+    def _classify_persons(self, test_image_paths):
+        # Classify the persons of each image and yield it when done.
+        # Wait for the model to be loaded.
+        if not self.wait_ready():
+            raise RuntimeError('The model failed to load: {}'.format(self.error))
+        models = self.models
+
         for obj in test_image_paths:
             logger.debug('**********Classify person for {}'.format(obj['image']))
+            # Read image from disk only once and only if it has a person in it.
+            # All person rois in the image are carved out of this single decode.
+            img = None
+            if any(label['name'] == 'person' for label in obj['labels']):
+                img = self._imread(obj['image'])
+                if img is None:
+                    logger.error('Bad image was read.')
+                    self.metrics.count('errors')
             for label in obj['labels']:
                 # If the object detected is a person then try to identify face. 
                 if label['name'] == 'person':
-                    # Read image from disk. 
-                    img = cv2.imread(obj['image'])
                     if img is None:
                         # Bad image was read.
-                        logging.error('Bad image was read.')
                         label['face'] = None
                         continue
 
@@ -110,22 +254,26 @@ class DetectRPC(object):
                     if roi.size == 0:
                         # Bad object roi...move on to next image.
                         logger.error('Bad object roi.')
+                        self.metrics.count('errors')
                         label['face'] = None
                         continue
 
                     # Format image to what the model expects for input.
-                    # Resize.
-                    roi = cv2.resize(roi, dsize=MODEL_INPUT_SIZE,
-                        interpolation=cv2.INTER_AREA)
-                    # Expand dimensions.
-                    roi = np.expand_dims(roi, axis=0)
-                    # Preprocess.
-                    roi = PREPROCESSOR(roi.astype('float32'))
+                    with self.metrics.timer('resize'):
+                        # Resize.
+                        roi = cv2.resize(roi, dsize=MODEL_INPUT_SIZE,
+                            interpolation=cv2.INTER_AREA)
+                        # Expand dimensions.
+                        roi = np.expand_dims(roi, axis=0)
+                        # Preprocess.
+                        roi = models['preprocessor'](roi.astype('float32'))
 
                     # Actual predictions per class.
-                    predictions = infer(tf.constant(roi))[output]
+                    with self.metrics.timer('inference'):
+                        predictions = models['infer'](tf.constant(roi))[models['output']].numpy()
 
                     # Find most likely prediction.
+                    start = time.monotonic()
                     proba = np.amax(predictions)
                     j = np.argmax(predictions)
                     person = LABEL_MAP[j]
@@ -144,18 +292,39 @@ class DetectRPC(object):
                     # Add face confidence to label metadata.
                     # (First convert NumPy value to native Python type for json serialization.)
                     label['faceProba'] = proba.item()
+                    self.metrics.observe('postprocess', time.monotonic() - start)
+
+            self.metrics.count('frames')
+            yield obj
+
+    def detect_faces(self, test_image_paths, result_format='json'):
+        # List that will hold all images with any person classifications. 
+        objects_classified_persons = list(self._classify_persons(test_image_paths))
+
+        # Encode results in requested format and return data.
+        with self.metrics.timer('serialize'):
+            return encode_results(objects_classified_persons, result_format)
 
-                    # Add processed image to output list. 
-            objects_classified_persons.append(obj)
+    @zerorpc.stream
+    def detect_faces_stream(self, test_image_paths, result_format='json'):
+        # Stream the result of each image as soon as it is done.
+        for obj in self._classify_persons(test_image_paths):
+            with self.metrics.timer('serialize'):
+                data = encode_result(obj, result_format)
+            yield data
 
-        # Convert json to string and return data. 
-        return(json.dumps(objects_classified_persons))
+    def get_stats(self):
+        # Return the latency and throughput metrics of the server.
+        return dict(self.metrics.stats(), state=self.state)
 
 # Create zerorpc object. 
 zerorpc_obj = DetectRPC()
 # Create and bind zerorpc server. 
 s = zerorpc.Server(zerorpc_obj, heartbeat=ZRPC_HEARTBEAT)
 s.bind(ZRPC_PIPE)
+# Serve metrics to Prometheus.
+if METRICS_PORT:
+    serve_prometheus(METRICS_PORT, [zerorpc_obj.metrics])
 # Register graceful ways to stop server. 
 gevent.signal(signal.SIGINT, s.stop) # Ctrl-C
 gevent.signal(signal.SIGTERM, s.stop) # termination
@@ -0,0 +1,112 @@
+'''
+Benchmark the nearest neighbour face recognizer against the number of known faces.
+
+Builds face indexes of --sizes known faces of --persons persons with
+random face encodings clustered by person and reports the per face
+latency of recognizing --batch faces per call and one face per call,
+like the servers do, and the time to enroll faces of a person. Compares
+with matching each face on its own with a Python loop over the matches
+like view-mongo-images.py does with face_recognition.compare_faces.
+
+Must be run from this directory since it uses config.json like
+detect_servers_tpu.py. The servers are not started.
+
+Copyright (c) 2020 Lindo St. Angel
+'''
+
+import argparse
+import logging
+import time
+import numpy as np
+
+import detect_servers_tpu as servers
+from face_index import FaceIndex
+
+logger = logging.getLogger(__name__)
+
+def known_faces(rng, size, persons, dim=128):
+    # Return size random face encodings of persons clustered persons and their names.
+    centers = rng.randn(persons, dim)
+    centers *= 0.6 / np.linalg.norm(centers, axis=1)[:, None]
+    labels = rng.randint(persons, size=size)
+    encodings = centers[labels] + 0.2 / np.sqrt(dim) * rng.randn(size, dim)
+    return (encodings, ['person{}'.format(label) for label in labels])
+
+def compare_faces_classifier(encodings, names, encoding, tolerance):
+    # Match a face like view-mongo-images.py, names of the matches counted in Python.
+    matches = list(np.linalg.norm(np.array(encodings) - encoding, axis=1) <= tolerance)
+    counts = {}
+    for (i, match) in enumerate(matches):
+        if match:
+            counts[names[i]] = counts.get(names[i], 0) + 1
+    return max(counts, key=counts.get) if counts else None
+
+def per_face_latency(func, faces, batch, repeat=3):
+    # Return the best per face latency in seconds of func(batch of faces).
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for i in range(0, len(faces), batch):
+            func(faces[i:i + batch])
+        elapsed = (time.perf_counter() - start) / len(faces)
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--sizes',
+        type=int,
+        nargs='+',
+        default=[1000, 5000, 10000, 50000],
+        help='numbers of known faces to benchmark')
+    ap.add_argument('--persons',
+        type=int,
+        default=20,
+        help='number of known persons')
+    ap.add_argument('--faces',
+        type=int,
+        default=64,
+        help='number of faces to recognize')
+    ap.add_argument('--batch',
+        type=int,
+        default=16,
+        help='number of faces per call of the batched benchmark')
+    ap.add_argument('--enroll',
+        type=int,
+        default=8,
+        help='number of faces of a person to enroll')
+    args = vars(ap.parse_args())
+
+    logging.basicConfig(format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
+        level=logging.INFO)
+
+    rng = np.random.RandomState(0)
+    for size in args['sizes']:
+        (encodings, names) = known_faces(rng, size + args['faces'], args['persons'])
+        (faces, encodings, names) = (encodings[:args['faces']], encodings[args['faces']:],
+            names[args['faces']:])
+        start = time.perf_counter()
+        index = FaceIndex(encodings, names, k=servers.FACE_KNN_NEIGHBORS,
+            tolerance=servers.FACE_KNN_TOLERANCE)
+        build_time = time.perf_counter() - start
+        known = list(encodings)
+        results = [('compare_faces loop', per_face_latency(lambda x:
+                [compare_faces_classifier(known, names, face, servers.FACE_KNN_TOLERANCE)
+                for face in x], faces, 1)),
+            ('index, 1 face per call', per_face_latency(lambda x:
+                servers.face_classifier(index, index, x, servers.FACE_MIN_PROBA), faces, 1)),
+            ('index, {} faces per call'.format(args['batch']), per_face_latency(lambda x:
+                servers.face_classifier(index, index, x, servers.FACE_MIN_PROBA), faces,
+                args['batch']))]
+        (enroll, _) = known_faces(rng, args['enroll'], 1)
+        start = time.perf_counter()
+        index.add(['enrolled'] * args['enroll'], enroll)
+        enroll_time = time.perf_counter() - start
+        logger.info('{} known faces: build {:.1f} ms, enroll {} faces {:.2f} ms.'.format(size,
+            build_time * 1000, args['enroll'], enroll_time * 1000))
+        for (name, latency) in results:
+            logger.info('  {:32s} {:8.1f} us per face  ({:.1f}x)'.format(name, latency * 1e6,
+                results[0][1] / latency))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+'''
+Benchmark the tpu servers' pipeline on a corpus of ZoneMinder alarm frames.
+
+Runs object detection requests followed by face / person recognition
+requests on the frames in-process, the servers are not started, and
+writes the p50 / p95 / p99 latency of each processing stage and of whole
+requests plus the frames/s of each server to a json file so runs with
+different code or config.json settings can be compared.
+
+The corpus is a ZoneMinder style event tree under --root, i.e.
+<root>/nvr/zoneminder/events/<monitor>/yy/mm/dd/hh/mm/ss/NNNNN-capture.jpg,
+which is either an existing one (e.g. a copy of real alarms) or generated
+with --generate from synthetic frames with --persons person-like figures
+in them, one --resolutions size per monitor.
+
+The models are run by the backend in config.json or --backend. The mock
+backend runs no models, its engines just return --persons persons per
+frame after --latency ms, so the rest of the pipeline can be measured on
+any host. The config.json settings (frame skipping, workers, queue etc.)
+are used as is, except that the result cache is disabled unless
+--result-cache is given since otherwise repeated runs only hit the cache.
+
+Must be run from this directory since it uses config.json like
+detect_servers_tpu.py.
+
+Copyright (c) 2020 Lindo St. Angel
+'''
+
+import argparse
+import json
+import logging
+import os
+import time
+import cv2
+import numpy as np
+from datetime import datetime, timedelta
+
+import detect_servers_tpu as servers
+from inference_backend import Detection, load_backend
+
+logger = logging.getLogger(__name__)
+
+def person_boxes(num_persons):
+    # Relative [[xmin, ymin], [xmax, ymax]] boxes of persons side by side in a frame.
+    width = 1. / max(1, num_persons)
+    return [np.array([[(i + 0.2) * width, 0.2], [(i + 0.8) * width, 0.9]])
+        for i in range(num_persons)]
+
+def generate_corpus(root, monitors, events, frames, resolutions, num_persons):
+    """
+    Write a synthetic ZoneMinder event tree of alarm frames under root.
+
+    Each monitor has its own resolution and events of consecutive frames.
+    Returns the image paths relative to root.
+    """
+    rng = np.random.RandomState(0)
+    image_paths = []
+    start = datetime(2020, 1, 1)
+    for m in range(monitors):
+        (w, h) = resolutions[m % len(resolutions)]
+        for e in range(events):
+            event_time = start + timedelta(hours=m, minutes=e)
+            event_dir = '/nvr/zoneminder/events/Monitor{}/{}'.format(m,
+                event_time.strftime('%y/%m/%d/%H/%M/%S'))
+            os.makedirs(root + event_dir, exist_ok=True)
+            for f in range(1, frames + 1):
+                img = rng.randint(64, 192, (h, w, 3), dtype=np.uint8)
+                # Person-like figures that move a bit from frame to frame.
+                shift = int(w * 0.01 * f)
+                for ((xmin, ymin), (xmax, ymax)) in person_boxes(num_persons):
+                    (x1, y1, x2, y2) = (int(xmin * w) + shift, int(ymin * h),
+                        int(xmax * w) + shift, int(ymax * h))
+                    cv2.rectangle(img, (x1, (y1 + y2) // 3), (x2, y2), (40, 40, 120), -1)
+                    cv2.circle(img, ((x1 + x2) // 2, y1 + (y2 - y1) // 6),
+                        max(1, (x2 - x1) // 3), (150, 170, 210), -1)
+                image_path = '{}/{:05d}-capture.jpg'.format(event_dir, f)
+                cv2.imwrite(root + image_path, img)
+                image_paths.append(image_path)
+    return image_paths
+
+def find_corpus(root):
+    # Return the alarm frame paths of an event tree under root, relative to root.
+    image_paths = []
+    for (dirpath, _, filenames) in os.walk(root):
+        for filename in filenames:
+            if filename.endswith('-capture.jpg'):
+                image_paths.append(os.path.join(dirpath, filename)[len(root):])
+    return sorted(image_paths)
+
+class MockDetectionEngine(object):
+    # Detection engine that finds num_persons persons in every frame.
+    def __init__(self, latency, num_persons):
+        self.latency = latency
+        self.detections = [Detection(label_id=0, score=0.9, bounding_box=box)
+            for box in person_boxes(num_persons)]
+
+    def detect_with_input_tensor(self, input_tensor, threshold=0.1, top_k=3):
+        time.sleep(self.latency)
+        return self.detections[:top_k]
+
+class MockInterpreter(object):
+    # Person classifier interpreter that says every roi is the first known person.
+    def __init__(self, latency, num_classes, input_size=224):
+        self.latency = latency
+        self.num_classes = num_classes
+        self.input_shape = [1, input_size, input_size, 3]
+
+    def get_input_details(self):
+        return [{'index': 0, 'shape': np.array(self.input_shape), 'dtype': np.uint8}]
+
+    def get_output_details(self):
+        return [{'index': 1, 'shape': np.array([self.input_shape[0], self.num_classes]),
+            'dtype': np.uint8}]
+
+    def resize_tensor_input(self, index, shape):
+        self.input_shape = list(shape)
+
+    def allocate_tensors(self):
+        self.tensors = {0: np.zeros(self.input_shape, dtype=np.uint8),
+            1: np.zeros((self.input_shape[0], self.num_classes), dtype=np.uint8)}
+
+    def set_tensor(self, index, value):
+        np.copyto(self.tensors[index], value)
+
+    def tensor(self, index):
+        return lambda: self.tensors[index]
+
+    def invoke(self):
+        time.sleep(self.latency)
+        self.tensors[1][:] = 0
+        self.tensors[1][:, min(1, self.num_classes - 1)] = 255
+
+class MockBackend(object):
+    name = 'mock'
+
+    def __init__(self, latency, num_persons):
+        self.latency = latency
+        self.num_persons = num_persons
+
+    def model_path(self, tpu_path, cpu_path):
+        # No model is loaded, this script stands in for it in result cache ids.
+        return os.path.abspath(__file__)
+
+    def detection_engine(self, model_path, device=None):
+        return MockDetectionEngine(self.latency, self.num_persons)
+
+    def interpreter(self, model_path, device=None):
+        return MockInterpreter(self.latency, len(servers.PERSON_LABEL_MAP))
+
+def percentiles(latencies):
+    # Return the p50, p95 and p99 of a list of latencies in seconds.
+    if not latencies:
+        return None
+    (p50, p95, p99) = np.percentile(latencies, [50, 95, 99])
+    return {'p50': round(p50, 6), 'p95': round(p95, 6), 'p99': round(p99, 6)}
+
+def run_server(name, rpc, func, requests, warmup):
+    """
+    Run requests on a server and return its benchmark results.
+
+    The first warmup requests are not measured. Returns the results of
+    the requests and the stats of the server.
+    """
+    if not rpc.wait_ready():
+        raise RuntimeError('The {} models failed to load.'.format(name))
+    outputs = [json.loads(func(request)) for request in requests[:warmup]]
+    rpc.metrics.reset()
+
+    latencies = []
+    start = time.monotonic()
+    for request in requests[warmup:]:
+        request_start = time.monotonic()
+        outputs.append(json.loads(func(request)))
+        latencies.append(time.monotonic() - request_start)
+    elapsed = time.monotonic() - start
+
+    stats = rpc.get_stats()
+    frames = sum(len(request) for request in requests[warmup:])
+    logger.info('{}: {} frames in {:.2f} s, {:.1f} frames/s'.format(name, frames, elapsed,
+        frames / elapsed if elapsed > 0 else 0.))
+    for (stage, stage_stats) in sorted(stats['stages'].items()):
+        logger.info('  {:12s} p50 {:8.2f} ms  p95 {:8.2f} ms  p99 {:8.2f} ms'.format(stage,
+            stage_stats['p50'] * 1000, stage_stats['p95'] * 1000, stage_stats['p99'] * 1000))
+
+    return outputs, {
+        'frames': frames,
+        'seconds': round(elapsed, 3),
+        'framesPerSecond': round(frames / elapsed, 3) if elapsed > 0 else 0.,
+        'requests': percentiles(latencies),
+        'stages': stats['stages'],
+        'counters': stats['counters']
+    }
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--root',
+        default='./benchmark-corpus',
+        help='directory of the ZoneMinder event tree (the mount point)')
+    ap.add_argument('--generate',
+        action='store_true',
+        help='generate a synthetic event tree under root first')
+    ap.add_argument('--monitors',
+        type=int,
+        default=4,
+        help='number of monitors to generate')
+    ap.add_argument('--events',
+        type=int,
+        default=2,
+        help='number of events per monitor to generate')
+    ap.add_argument('--frames',
+        type=int,
+        default=25,
+        help='number of alarm frames per event to generate')
+    ap.add_argument('--resolutions',
+        nargs='+',
+        default=['1280x720', '1920x1080'],
+        help='frame sizes (WxH) to generate, one per monitor in turn')
+    ap.add_argument('--persons',
+        type=int,
+        default=1,
+        help='persons per generated frame and found by the mock engines')
+    ap.add_argument('--backend',
+        default=None,
+        help='inference backend (tpu, cpu, auto or mock) overriding the one in config.json')
+    ap.add_argument('--latency',
+        type=float,
+        default=10.,
+        help='inference latency in ms of the mock backend')
+    ap.add_argument('--batch',
+        type=int,
+        default=8,
+        help='number of frames per request')
+    ap.add_argument('--warmup',
+        type=int,
+        default=1,
+        help='number of requests not measured')
+    ap.add_argument('--result-cache',
+        action='store_true',
+        help='use the result cache as set in config.json')
+    ap.add_argument('--output',
+        default='./benchmark-results.json',
+        help='json file to write the results to')
+    args = vars(ap.parse_args())
+
+    logging.basicConfig(format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
+        level=logging.INFO)
+
+    root = os.path.abspath(args['root'])
+    if args['generate']:
+        resolutions = [tuple(int(x) for x in r.split('x')) for r in args['resolutions']]
+        image_paths = generate_corpus(root, args['monitors'], args['events'],
+            args['frames'], resolutions, args['persons'])
+        logger.info('Generated {} frames in {}.'.format(len(image_paths), root))
+    else:
+        image_paths = find_corpus(root)
+    if not image_paths:
+        logger.error('No alarm frames found in {}.'.format(root))
+        return
+
+    if args['backend'] == 'mock':
+        servers.backend = MockBackend(latency=args['latency'] / 1000.,
+            num_persons=args['persons'])
+    elif args['backend'] is not None:
+        servers.backend = load_backend(args['backend'], num_threads=servers.CPU_NUM_THREADS)
+    if not args['result_cache']:
+        servers.RESULT_CACHE_MB = 0
+    servers.MOUNT_POINT = root
+
+    # Requests of consecutive frames, like the Alarm Uploader sends.
+    batch = args['batch']
+    requests = [image_paths[i:i + batch] for i in range(0, len(image_paths), batch)]
+    if len(requests) <= args['warmup']:
+        logger.error('Need more than {} requests of {} frames.'.format(args['warmup'], batch))
+        return
+
+    obj_rpc = servers.ObjDetectRPC()
+    (objects, obj_results) = run_server('objects', obj_rpc, obj_rpc.detect_objects,
+        requests, args['warmup'])
+
+    if servers.RECOGNIZE_MODE == 'face':
+        (name, recognizer_rpc) = ('faces', servers.FaceDetectRPC())
+    else:
+        (name, recognizer_rpc) = ('persons', servers.PersonClassRPC())
+    (_, recognizer_results) = run_server(name, recognizer_rpc, recognizer_rpc.detect_faces,
+        objects, args['warmup'])
+
+    with open(args['output'], 'w') as fp:
+        json.dump({
+            'time': datetime.now().isoformat(),
+            'backend': servers.get_backend().name,
+            'args': args,
+            'config': servers.config,
+            'corpus': {'frames': len(image_paths), 'requests': len(requests)},
+            'objects': obj_results,
+            name: recognizer_results
+        }, fp, indent=2)
+    logger.info('Wrote results to {}.'.format(args['output']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+'''
+Benchmark buffer allocations of the tpu servers' preprocessing path.
+
+Runs object detection and person classification requests in-process on
+a set of images and reports per request the image buffers that had to be
+allocated for model inputs and the peak heap memory used, which includes
+the decoded frames. Use --no-pool to compare with allocating a new buffer
+for every frame.
+
+Must be run from this directory since it uses config.json like
+detect_servers_tpu.py. The servers are not started.
+
+Copyright (c) 2020 Lindo St. Angel
+'''
+
+import argparse
+import logging
+import tracemalloc
+import time
+from glob import glob
+from os import path
+
+import detect_servers_tpu as servers
+from frame_cache import FrameCache
+from inference_backend import load_backend
+
+logger = logging.getLogger(__name__)
+
+def person_objects(image_paths):
+    # Fake object detector results with one person in the middle of each image.
+    objects = []
+    for image_path in image_paths:
+        (h, w) = servers.frame_cache.imread(image_path).shape[:2]
+        objects.append({'image': image_path, 'labels': [{'id': 0, 'name': 'person',
+            'score': 1.0, 'box': {'xmin': w / 4, 'ymin': h / 4,
+            'xmax': 3 * w / 4, 'ymax': 3 * h / 4}}]})
+    return objects
+
+def run_requests(name, func, requests):
+    # Run requests and log their buffer allocations, peak memory and time.
+    for i, request in enumerate(requests):
+        allocations = servers.buffer_pool.allocations
+        tracemalloc.start()
+        start = time.time()
+        func(request)
+        elapsed = time.time() - start
+        (_, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        logger.info('{} request {}: {} images, {} buffer allocations, '
+            'peak heap {:.2f} MB, {:.1f} ms'.format(name, i, len(request),
+            servers.buffer_pool.allocations - allocations, peak / 2**20, elapsed * 1000))
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--images',
+        default='./test-images',
+        help='directory of jpeg images to run requests on')
+    ap.add_argument('--batch',
+        type=int,
+        default=8,
+        help='number of images per request')
+    ap.add_argument('--requests',
+        type=int,
+        default=5,
+        help='number of requests')
+    ap.add_argument('--backend',
+        default=None,
+        help='inference backend overriding the one in config.json')
+    ap.add_argument('--no-pool',
+        action='store_true',
+        help='allocate a new buffer for every frame')
+    args = vars(ap.parse_args())
+
+    logging.basicConfig(format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
+        level=logging.INFO)
+
+    if args['backend'] is not None:
+        servers.backend = load_backend(args['backend'], num_threads=servers.CPU_NUM_THREADS)
+    if args['no_pool']:
+        servers.buffer_pool = servers.BufferPool(max_free=0)
+    # Every request reads, decodes and infers its images.
+    servers.RESULT_CACHE_MB = 0
+    servers.OBJ_CON_IMG_SKIP = 0
+    servers.OBJ_DEDUP_THRESHOLD = 0
+    servers.MOUNT_POINT = ''
+
+    image_paths = sorted(glob(path.join(path.abspath(args['images']), '*.jpg')))
+    if not image_paths:
+        logger.error('No images found in {}.'.format(args['images']))
+        return
+    requests = [[image_paths[(r * args['batch'] + i) % len(image_paths)]
+        for i in range(args['batch'])] for r in range(args['requests'])]
+
+    obj_rpc = servers.ObjDetectRPC()
+    person_rpc = servers.PersonClassRPC()
+    if not (obj_rpc.wait_ready() and person_rpc.wait_ready()):
+        logger.error('The models failed to load.')
+        return
+
+    # Each request decodes its images again.
+    servers.frame_cache = FrameCache(max_bytes=0)
+    run_requests('objects', obj_rpc.detect_objects, requests)
+    run_requests('persons', person_rpc.detect_faces,
+        [person_objects(request) for request in requests])
+
+if __name__ == '__main__':
+    main()
@@ -17,11 +17,35 @@ import pickle
 import cv2
 import logging
 import gevent
-import face_recognition
+import hashlib
+import os
 import sys
-import tflite_runtime.interpreter as tflite
+import time
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from gevent.event import Event
+from itertools import islice
 from signal import SIGINT, SIGTERM
-from edgetpu.detection.engine import DetectionEngine
+
+# Modules shared with the other servers.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
+from face_index import load_face_index
+from frame_cache import FrameCache
+from inference_backend import load_backend
+from jitter_policy import JitterPolicy
+from metrics import Metrics, serve_prometheus
+from model_watch import ModelWatcher
+from monitor_state import (MonitorStates, frame_signature, parse_image_path,
+    signature_distance, skip_inference)
+from numpy_svc import NumpySVC
+from request_queue import RequestQueue
+from result_cache import ResultCache, model_id
+from result_encoding import encode_result, encode_results
+from tracker import Tracker
+from worker_pool import WorkerPool, wait_result
 
 logging.basicConfig(level=logging.INFO)
 
@@ -36,11 +60,27 @@ person_config = config['personClassServer']
 ### Object detection configuration. ###
 # Tensorflow object and face detection file system paths.
 OBJ_MODEL = obj_config['objModelPath']
+# Object detection model for the cpu inference backend.
+OBJ_CPU_MODEL = obj_config['objCpuModelPath']
 OBJ_LABEL_MAP = obj_config['labelMapPath']
 # If consecutive ZoneMinder image frames are found then skip this many after the first.
 OBJ_CON_IMG_SKIP = obj_config['conseqImagesToSkip']
+# Seconds to remember the last inferred frame of a monitor across requests
+# for skipping consecutive (conseqImagesToSkip) and unchanged (dedupThreshold) frames.
+OBJ_FRAME_STATE_TTL = obj_config['frameStateTTL']
 # Minimum score for valid TF object detection. 
 OBJ_MIN_SCORE_THRESH = obj_config['minScore']
+# Number of images to read and resize ahead of the one being inferred.
+# Set to 0 to read and resize each image just before its inference.
+OBJ_PREFETCH_DEPTH = obj_config['prefetchDepth']
+# Decode jpegs at reduced resolution when much larger than the detector input.
+OBJ_REDUCED_DECODE = obj_config['reducedDecode']
+# Reuse the labels of the last inferred frame from the same monitor if no region
+# of the scene has changed by this much (mean gray level, 0 ~ 255) since then.
+# Set to 0 to always run inference.
+OBJ_DEDUP_THRESHOLD = obj_config['dedupThreshold']
+# Number of workers, each with its own detection engine, inferring images in parallel.
+OBJ_NUM_WORKERS = obj_config['numWorkers']
 # IPC (or TCP) socket for zerorpc.
 # This must match the zerorpc client config.
 OBJ_ZRPC_PIPE = obj_config['zerorpcPipe']
@@ -48,31 +88,63 @@ OBJ_ZRPC_PIPE = obj_config['zerorpcPipe']
 ### Face detection configuration. ###
 # Tensorflow face detection model path.
 FACE_DET_MODEL = face_config['faceDetModelPath']
+# Face detection model for the cpu inference backend.
+FACE_DET_CPU_MODEL = face_config['faceDetCpuModelPath']
 # py torch face embeddings model path (if used).
 FACE_EMB_MODEL = face_config['faceEmbModelPath']
 # IPC (or TCP) socket for zerorpc.
 # This must match the zerorpc client config.
 FACE_ZRPC_PIPE = face_config['zerorpcPipe']
 # Settings for face classifier.
-# The model and label encoder needs to be generated by 'train.py' first. 
+# The model and label encoder needs to be generated by 'train.py' first.
+# A .npz model exported by export_face_classifier.py has its labels and
+# doesn't need scikit-learn.
 FACE_CLASS_MODEL = face_config['modelPath']
 FACE_LABEL_MAP = face_config['labelPath']
 FACE_MIN_PROBA = face_config['minProba']
+# Face recognizer, 'svm' for the face classifier or 'knn' for the nearest
+# known faces, which can be added to by the enroll_face RPC.
+FACE_RECOGNIZER = face_config['recognizer']
+# Known face encodings used by the knn recognizer.
+# The pickle file needs to be generated by 'encode_faces.py' first.
+FACE_ENCODINGS = face_config['encodingsPath']
+# Number of nearest known faces that vote for the name of a face.
+FACE_KNN_NEIGHBORS = face_config['knnNeighbors']
+# Known faces further than this distance from a face don't vote.
+# See https://github.com/ageitgey/face_recognition/wiki/Face-Recognition-Accuracy-Problems.
+FACE_KNN_TOLERANCE = face_config['knnTolerance']
 # Images with Variance of Laplacian less than this are declared blurry. 
 FACE_FOCUS_MEASURE_THRESHOLD = face_config['focusMeasureThreshold']
 # Faces with width or height less than this are too small for recognition.
 # In pixels.
 FACE_MIN = face_config['minFace']
-# Number of times to resample for dlib face encoder.
+# Margin around a face, as a fraction of its size, in the crop given to the
+# dlib face encoder. Its face chips are taken with a margin of 0.25.
+FACE_CROP_MARGIN = face_config['faceCropMargin']
+# Max number of times to resample for dlib face encoder.
 FACE_NUM_JITTERS = face_config['numJitters']
+# Min number of times to resample when busy.
+FACE_MIN_JITTERS = face_config['minJitters']
+# Request latency in ms to adapt the number of resamples to, between the
+# min and max. Set to 0 to always resample numJitters times.
+FACE_JITTER_TARGET = face_config['jitterLatencyTarget']
+# Number of workers, each with its own face detection engine, recognizing faces in parallel.
+FACE_NUM_WORKERS = face_config['numWorkers']
 
 ### Person classifier configuration. ###
 # TFLite model path. 
 PERSON_CLASS_MODEL = person_config['personClassModelPath']
+# TFLite model path for the cpu inference backend.
+PERSON_CLASS_CPU_MODEL = person_config['personClassCpuModelPath']
 # Label map path.
 PERSON_LABEL_MAP = person_config['labelMap']
 # Classification threshold.
 PERSON_MIN_PROBA = person_config['minProba']
+# Max number of person rois classified per invoke if the model supports batches.
+# Set to 1 to classify one roi per invoke.
+PERSON_MAX_BATCH = person_config['maxBatchSize']
+# Number of workers, each with its own interpreter, classifying batches in parallel.
+PERSON_NUM_WORKERS = person_config['numWorkers']
 # IPC (or TCP) socket for zerorpc.
 # This must match the zerorpc client config.
 PERSON_ZRPC_PIPE = person_config['zerorpcPipe']
@@ -85,6 +157,68 @@ MOUNT_POINT = config['mountPoint']
 # Heartbeat interval for zerorpc client in ms.
 # This must match the zerorpc client config. 
 ZRPC_HEARTBEAT = config['zerorpcHeartBeat']
+# Run models on the edge tpu ('tpu'), the cpu ('cpu') or on the
+# edge tpu if one is found and else on the cpu ('auto').
+INFERENCE_BACKEND = config['inferenceBackend']
+# Number of threads used per model by the cpu inference backend.
+CPU_NUM_THREADS = config['cpuNumThreads']
+# Memory budget of the decoded frame cache shared by the servers in MB.
+# Set to 0 to disable caching.
+FRAME_CACHE_MB = config['frameCacheMBytes']
+# Path of the sqlite database that caches detection results across requests
+# and restarts, keyed by image contents.
+RESULT_CACHE_PATH = config['resultCachePath']
+# Size budget of the result cache in MB. Set to 0 to disable caching.
+RESULT_CACHE_MB = config['resultCacheMBytes']
+# Max number of images of concurrent requests inferred together.
+QUEUE_MAX_BATCH = config['queueMaxBatchSize']
+# Max time in ms an image waits in the queue for a micro-batch to fill.
+QUEUE_MAX_WAIT = config['queueMaxWait']
+# Max number of requests queued per server.
+QUEUE_MAX_REQUESTS = config['queueMaxRequests']
+# Time in ms a request waits for room in a full queue before it's rejected.
+QUEUE_TIMEOUT = config['queueTimeout']
+# Port of the Prometheus metrics endpoint. Set to 0 to disable it.
+METRICS_PORT = config['metricsPort']
+# Recognize a tracked person again after this many frames, in between its
+# identity is carried over from earlier frames. Set to 0 to disable tracking.
+TRACKER_REFRESH = config['trackerRefresh']
+# Min overlap (IoU) of a person's box with a track in the previous frame to continue it.
+TRACKER_MIN_IOU = config['trackerMinIoU']
+# A track ends if its person isn't seen for more than this many frames.
+TRACKER_MAX_GAP = config['trackerMaxGap']
+# Recognize a tracked person again if its box has grown by this factor.
+TRACKER_SIZE_GAIN = config['trackerSizeGain']
+# Seconds to keep the tracks of an event after its last frame.
+TRACKER_TTL = config['trackerTTL']
+# Seconds between checks of the model files for changes, which are then reloaded.
+# Set to 0 to only reload models with the reload_models RPC.
+MODEL_WATCH_INTERVAL = config['modelWatchInterval']
+
+# Backend the models are run on, the one in config.json is loaded by the first
+# server unless a benchmark or test has set another one.
+backend = None
+
+def get_backend():
+    # Return the inference backend, loading the one in config.json if none is set.
+    global backend
+    if backend is None:
+        backend = load_backend(INFERENCE_BACKEND, num_threads=CPU_NUM_THREADS)
+        logging.info('Using the {} inference backend.'.format(backend.name))
+    return backend
+
+def make_tracker():
+    # Return a tracker of the persons in events or None if tracking is disabled.
+    if TRACKER_REFRESH == 0:
+        return None
+    return Tracker(min_iou=TRACKER_MIN_IOU, max_gap=TRACKER_MAX_GAP,
+        refresh=TRACKER_REFRESH, size_gain=TRACKER_SIZE_GAIN, ttl=TRACKER_TTL)
+
+# Decoded frames shared between the object and face / person servers.
+frame_cache = FrameCache(max_bytes=FRAME_CACHE_MB * 1024 * 1024)
+
+# Threads that read and resize images while the TPU is busy.
+prefetch_pool = ThreadPoolExecutor(max_workers=max(1, OBJ_PREFETCH_DEPTH))
 
 def ReadLabelFile(file_path):
     # Function to read labels from text files.
@@ -96,365 +230,1506 @@ def ReadLabelFile(file_path):
         ret[int(pair[0])] = pair[1].strip()
     return ret
 
-def face_classifier(recognizer, le, encoding, min_proba):
-    # perform classification to recognize the face based on 128D encoding
-    # note: reshape(1,-1) converts 1D array into 2D
-    preds = recognizer.predict_proba(encoding.reshape(1, -1))[0]
-    j = np.argmax(preds)
-    proba = preds[j]
-    logging.debug('face classifier proba {} name {}'.format(proba, le.classes_[j]))
-    if proba >= min_proba:
-        name = le.classes_[j]
-        logging.debug('face classifier says this is {}'.format(name))
-    else:
-        name = None # prob too low to recog face
-        logging.debug('face classifier cannot recognize face')
-    return name, proba
+def load_face_classifier(model_path, label_path):
+    # Load the face classifier and its label encoder. An exported .npz
+    # classifier has the class names itself, like a label encoder.
+    if model_path.endswith('.npz'):
+        recognizer = NumpySVC(model_path)
+        return recognizer, recognizer
+    with open(model_path, 'rb') as fp:
+        recognizer = pickle.load(fp)
+    with open(label_path, 'rb') as fp:
+        le = pickle.load(fp)
+    return recognizer, le
+
+def face_classifier(recognizer, le, encodings, min_proba):
+    # perform classification to recognize the faces based on 128D encodings,
+    # one per row, all in one call
+    preds = recognizer.predict_proba(encodings)
+    j = np.argmax(preds, axis=1)
+    probas = preds[np.arange(len(j)), j]
+    names = []
+    for (k, proba) in zip(j, probas):
+        logging.debug('face classifier proba {} name {}'.format(proba, le.classes_[k]))
+        if proba >= min_proba:
+            names.append(le.classes_[k])
+            logging.debug('face classifier says this is {}'.format(names[-1]))
+        else:
+            names.append(None) # prob too low to recog face
+            logging.debug('face classifier cannot recognize face')
+    return names, probas
 
-def skip_inference(frame_num, monitor, labels, image_path, objects_in_image):
+class FaceEncoder(object):
     """
-    If consecutive frames then repeat last label and skip a new inference.
-    
-    Image paths must be in the form of:
-    '/nvr/zoneminder/events/BackPorch/18/06/20/19/20/04/00224-capture.jpg'.
+    dlib face encoder of a worker, like face_recognition.face_encodings.
+
+    dlib's models aren't thread safe, so each worker has its own and the
+    workers encode faces in parallel.
     """
+    def __init__(self):
+        # Import here so dlib and its models are only loaded in face mode.
+        import dlib
+        import face_recognition_models
+        self._rectangle = dlib.rectangle
+        self.pose_predictor = dlib.shape_predictor(
+            face_recognition_models.pose_predictor_five_point_model_location())
+        self.face_encoder = dlib.face_recognition_model_v1(
+            face_recognition_models.face_recognition_model_location())
+
+    def encode(self, rgb, box, num_jitters):
+        # Return the 128D encoding of the face at the (top, right, bottom, left)
+        # box of an rgb image, resampled num_jitters times.
+        (top, right, bottom, left) = box
+        landmarks = self.pose_predictor(rgb, self._rectangle(left, top, right, bottom))
+        return np.array(self.face_encoder.compute_face_descriptor(rgb, landmarks, num_jitters))
 
-    old_frame_num = frame_num
-    old_monitor = monitor
-    skip = False
-
-    if OBJ_CON_IMG_SKIP == 0: return skip, frame_num, monitor
-
-    try:
-        frame_num = int((image_path.split('/')[-1]).split('-')[0])
-        monitor = image_path.split('/')[4]
-    except (ValueError, IndexError):
-        logging.error('Could not derive information from image path.')
-        objects_in_image.append({'image': image_path, 'labels': []})
-        skip = True
-        return skip, frame_num, monitor
-                    
-    # Only apply skip logic if frames are from the same monitor. 
-    if monitor == old_monitor:
-        # Only apply skip logic if alarm frames are from the same event.
-        # Intra-event frames are monotonically increasing.
-        frame_diff = frame_num - old_frame_num
-        if frame_diff > 0:
-            # Skip CON_IMG_SKIP frames after the first one. 
-            if frame_diff <= OBJ_CON_IMG_SKIP:
-                objects_in_image.append({'image': image_path, 'labels': labels})
-                logging.debug('monitor {} old_monitor {} frame_num {} old_frame_num {}'
-                    .format(monitor,old_monitor,frame_num,old_frame_num))
-                logging.debug('Consecutive frame {}, skipping detect and copying previous labels.'
-                    .format(frame_num))
-                skip = True
-                        
-    return skip, frame_num, monitor
-
-def resize_to_square(img, size, keep_aspect_ratio=False, interpolation=cv2.INTER_AREA):
-    # Resize image to square shape.
+class BufferPool(object):
+    """
+    Reusable image buffers keyed by shape and dtype.
+
+    Buffers are taken with get() and given back with put() once they are
+    no longer used, so images of the same size don't need a new allocation
+    each time. At most max_free unused buffers of each shape are kept.
+    """
+    def __init__(self, max_free=8):
+        self.max_free = max_free
+        # Number of buffers that had to be allocated.
+        self.allocations = 0
+        self._free = {}
+        self._lock = threading.Lock()
+
+    def get(self, shape, dtype=np.uint8):
+        # Return an uninitialized buffer.
+        key = (tuple(shape), np.dtype(dtype).str)
+        with self._lock:
+            free = self._free.get(key)
+            if free:
+                return free.pop()
+            self.allocations += 1
+        return np.empty(shape, dtype=dtype)
+
+    def put(self, buf):
+        # Give back a buffer taken with get().
+        key = (buf.shape, buf.dtype.str)
+        with self._lock:
+            free = self._free.setdefault(key, [])
+            if len(free) < self.max_free:
+                free.append(buf)
+
+# Letterbox buffers for model inputs.
+buffer_pool = BufferPool()
+
+def resize_to_square(img, size, keep_aspect_ratio=False, interpolation=cv2.INTER_AREA,
+    dst=None):
+    # Resize image to square shape, into dst if given.
     # If keep_aspect_ratio=True, then:
     #   If the original image is lanscape, add black pixels on the bottom-side only.
     #   If the original image is portrait, add black pixels on the right-side only.
     (h, w) = img.shape[:2]
 
-    if h == w or keep_aspect_ratio == False:
-        return cv2.resize(img, (size, size), interpolation)
+    if dst is None:
+        dst = np.empty((size, size) + img.shape[2:], dtype=img.dtype)
 
-    # Check if image is color. 
-    chan = None if len(img.shape) < 3 else img.shape[2]
+    if h == w or keep_aspect_ratio == False:
+        return cv2.resize(img, (size, size), dst=dst, interpolation=interpolation)
 
-    # Determine size of black mask.
+    # Scale the longest side to size and fill the rest with black
+    # instead of resizing a black mask of the longest side squared.
     mask_size = h if h > w else w
+    res_h = max(1, round(h * size / mask_size))
+    res_w = max(1, round(w * size / mask_size))
+    cv2.resize(img, (res_w, res_h), dst=dst[:res_h, :res_w], interpolation=interpolation)
+    dst[res_h:] = 0
+    dst[:res_h, res_w:] = 0
+
+    return dst
+
+def run_off_hub(func, *args):
+    # Run func(*args) on a native thread of the hub's thread pool,
+    # letting other greenlets run meanwhile.
+    return gevent.get_hub().threadpool.apply(func, args)
+
+def prefetch(func, items, depth):
+    """
+    Apply func to items on the prefetch thread pool.
+    
+    Up to depth calls are kept in flight ahead of the consumer and
+    results are yielded in the same order as items. With a depth of 0
+    each call is only made once its result is needed.
+    """
+    if depth == 0:
+        for item in items:
+            yield wait_result(prefetch_pool.submit(func, item))
+        return
+
+    items = iter(items)
+    futures = deque(prefetch_pool.submit(func, item) for item in islice(items, depth))
+    while futures:
+        future = futures.popleft()
+        # Keep the pipeline full before waiting on the oldest result.
+        for item in islice(items, 1):
+            futures.append(prefetch_pool.submit(func, item))
+        yield wait_result(future)
+
+def resolve_labels(labels):
+    # Return labels, waiting for them first if they are still being inferred.
+    return wait_result(labels) if isinstance(labels, Future) else labels
+
+def track_persons(tracker, obj):
+    """
+    Match the persons in an image to the tracks of its ZoneMinder event.
+
+    Returns the frame number of the image, the (label, track) of each
+    person to recognize and the (label, track, source label, wait) of each
+    person whose identity is carried over from the label it was recognized
+    in, once wait is done. Persons are labeled with their track id. Tracks
+    are None if tracking is disabled or the image path can't be parsed.
+    """
+    persons = [label for label in obj['labels'] if label['name'] == 'person']
+    info = None if tracker is None else parse_image_path(obj['image'])
+    if info is None:
+        return None, [(label, None) for label in persons], []
+
+    (monitor, event, frame_num) = info
+    tracks = tracker.update(monitor, event, frame_num, [label['box'] for label in persons])
+    (recognize, carried) = ([], [])
+    for (label, track) in zip(persons, tracks):
+        label['track'] = track['id']
+        if tracker.needs_recognition(track, frame_num):
+            recognize.append((label, track))
+        else:
+            carried.append((label, track, track['label'], track['wait']))
+    return frame_num, recognize, carried
+
+def encoded_face(obj):
+    # Check if the face of any person in an image was encoded, not cached or carried over.
+    return any('numJitters' in label for label in obj['labels'])
+
+def carry_identities(carried, wait):
+    """
+    Copy the identity of tracked persons from the labels it was recognized
+    in, calling wait() on what each is waiting for first.
 
-    if chan is None:
-        mask = np.zeros((mask_size, mask_size), dtype=img.dtype)
-        mask[:h, :w] = img[:h, :w]
+    Only confident identities are carried over. Returns the (label, track)
+    of the other persons to recognize them again, track is None if it has
+    been recognized in another label since.
+    """
+    retry = []
+    for (label, track, source, pending) in carried:
+        try:
+            wait(pending)
+        except Exception:
+            pass
+        if source.get('face') is None:
+            # No face, not confident or recognition failed.
+            retry.append((label, track if track['label'] is source else None))
+            continue
+        label['face'] = source['face']
+        if 'faceProba' in source:
+            label['faceProba'] = source['faceProba']
+    return retry
+
+def frame_digest(image_path, result_cache, metrics):
+    # Return a digest of an image's file contents to find its results in
+    # result_cache, '' if the cache is disabled, or None if it can't be read.
+    if not result_cache.enabled:
+        return ''
+    buf = frame_cache.read(MOUNT_POINT + image_path, metrics)
+    return hashlib.sha1(buf).hexdigest() if buf else None
+
+def roi_key(digest, box):
+    # Result cache key of a person roi in an image.
+    return '{}:{}:{}:{}:{}'.format(digest, int(box['xmin']), int(box['ymin']),
+        int(box['xmax']), int(box['ymax']))
+
+def load_obj_input(image_path, result_cache, metrics):
+    """
+    Read an image and resize it for the object detector.
+
+    Returns a dict with the labels of the image if they are in the result
+    cache ('labels') or else its original (full resolution) size ('size'),
+    the resized image ('input') and its signature ('signature', if dedup is
+    enabled). The digest of the image file is returned as 'digest'.
+    Returns None if the image could not be read.
+    """
+    # Look for the results of an earlier request for the same image.
+    digest = frame_digest(image_path, result_cache, metrics)
+    if digest is None:
+        return None
+    labels = result_cache.get(digest)
+    if labels is not None:
+        return {'digest': digest, 'labels': labels}
+
+    # Read image from disk or from frame cache.
+    # The tpu obj det requires (300, 300) so the image can be decoded at
+    # a reduced resolution that is still at least that large.
+    if OBJ_REDUCED_DECODE:
+        (img, img_size) = frame_cache.imread_scaled(MOUNT_POINT + image_path, size=300,
+            metrics=metrics)
     else:
-        mask = np.zeros((mask_size, mask_size, chan), dtype=img.dtype)
-        mask[:h, :w, :] = img[:h, :w, :]
+        img = frame_cache.imread(MOUNT_POINT + image_path, metrics=metrics)
+        img_size = None if img is None else img.shape[:2]
+    #cv2.imwrite('./obj_img.jpg', img)
+    if img is None:
+        return None
+
+    # Resize into a pooled buffer, given back once inferred.
+    with metrics.timer('resize'):
+        res = resize_to_square(img=img, size=300, keep_aspect_ratio=True,
+            interpolation=cv2.INTER_AREA, dst=buffer_pool.get((300, 300, 3)))
+        #cv2.imwrite('./obj_res.jpg', res)
 
-    return cv2.resize(mask, (size, size), interpolation)
+        signature = frame_signature(res) if OBJ_DEDUP_THRESHOLD > 0 else None
+
+    # Original image size is used for box coords.
+    return {'digest': digest, 'size': img_size, 'input': res, 'signature': signature}
+
+class ModelServer(object):
+    """
+    Base of the zerorpc servers, which load their models in the background.
+
+    The models are loaded and warmed up with dummy inputs by load_models()
+    on the gevent hub's thread pool, so a server can be bound and answer
+    heartbeats and health checks while it starts. Requests wait until the
+    models are ready.
+
+    Models are reloaded the same way when their files change or on a
+    reload_models call, and then swapped in as a whole. Requests that are
+    already running finish on the old models, whose workers are released
+    once the last of them is done.
+    """
+    def __init__(self, name, model_paths, settings):
+        self.name = name
+        # Files and settings the models are made of, as for model_id().
+        self.model_paths = model_paths
+        self.settings = settings
+        # 'loading', 'ready' or 'failed'.
+        self.state = 'loading'
+        self.error = None
+        # Time in seconds it took to load and warm up the models.
+        self.load_time = None
+        self.reloads = 0
+        # Models in use as returned by load_models(), set once loaded.
+        self.models = None
+        self._loading = False
+        # Reloads the models when their files change.
+        self._watcher = ModelWatcher(name, model_paths, self._reload_changed)
+        self._loaded = Event()
+        gevent.spawn(self._load)
+        if MODEL_WATCH_INTERVAL:
+            gevent.spawn(self._watcher.watch, MODEL_WATCH_INTERVAL)
+
+    def load_models(self):
+        # Load and warm up the models and return them in a dict with the
+        # worker pool under 'pool', run on a native thread.
+        raise NotImplementedError
+
+    def _build(self):
+        # Load the models and the id of their results, run on a native thread.
+        # The model files are only hashed for the id if results are cached.
+        models = self.load_models()
+        models['model_id'] = (model_id(self.model_paths, self.settings)
+            if self.result_cache.enabled else None)
+        # Number of requests running on the models.
+        models['users'] = 0
+        return models
+
+    def _load(self):
+        # Load new models and swap them in once they are warmed up.
+        self._loading = True
+        self._watcher.update()
+        start = time.monotonic()
+        try:
+            models = gevent.get_hub().threadpool.apply(self._build)
+        except Exception as e:
+            logging.exception('Loading the {} models failed.'.format(self.name))
+            self.error = str(e)
+            # Keep serving on the old models if there are any.
+            if self.models is None:
+                self.state = 'failed'
+        else:
+            self._swap(models)
+            self.state = 'ready'
+            self.error = None
+        self.load_time = round(time.monotonic() - start, 3)
+        logging.info('{} models {} after {} s.'.format(self.name,
+            'ready' if self.error is None else 'failed', self.load_time))
+        self._loading = False
+        self._loaded.set()
+
+    def _swap(self, models):
+        (old_models, self.models) = (self.models, models)
+        self.result_cache.set_model(models['model_id'])
+        if old_models is not None:
+            self.reloads += 1
+            if old_models['users'] == 0:
+                self._release(old_models)
+
+    def _release(self, models):
+        # Release the workers of replaced models on a native thread.
+        logging.info('Releasing the replaced {} models.'.format(self.name))
+        gevent.get_hub().threadpool.spawn(models['pool'].close)
+
+    def _reload_changed(self):
+        # Reload the models after their files changed, unless they are
+        # already being loaded.
+        if self._loading:
+            return False
+        self._load()
+
+    def wait_ready(self, timeout=None):
+        """
+        Wait up to timeout seconds, forever if None, for the models to be ready.
+
+        Returns True if they are ready.
+        """
+        self._loaded.wait(timeout)
+        return self.state == 'ready'
+
+    @contextmanager
+    def _use_models(self):
+        # Wait for the models and hold on to them while a request uses them.
+        # Raises an error if they could not be loaded.
+        if not self.wait_ready():
+            raise RuntimeError('The {} models failed to load: {}'.format(self.name, self.error))
+        models = self.models
+        models['users'] += 1
+        try:
+            yield models
+        finally:
+            models['users'] -= 1
+            if models['users'] == 0 and models is not self.models:
+                self._release(models)
+
+    def _with_models(self, process):
+        # Wrap process(models, items) to run micro-batches on the current models.
+        def run(items):
+            with self._use_models() as models:
+                yield from process(models, items)
+        return run
+
+    def reload_models(self):
+        """
+        Reload the models in the background, e.g. after retraining.
+
+        Returns False if the models are already being loaded.
+        """
+        if self._loading:
+            return False
+        self._loading = True
+        gevent.spawn(self._load)
+        return True
+
+    def ready(self):
+        # Return True once the models are loaded and warmed up.
+        return self.state == 'ready'
+
+    def health(self):
+        # Return the load state of the models.
+        return {
+            'name': self.name,
+            'state': self.state,
+            'ready': self.state == 'ready',
+            'loading': self._loading,
+            'loadTime': self.load_time,
+            'reloads': self.reloads,
+            'error': self.error
+        }
+
+    def _worker_stats(self):
+        # Return the stats of the workers of the current models.
+        return self.models['pool'].stats() if self.models is not None else []
 
 # zerorpc obj det server.
-class ObjDetectRPC(object):
+class ObjDetectRPC(ModelServer):
     def __init__(self):
-        self.obj_engine = DetectionEngine(OBJ_MODEL)
-        self.labels_map = ReadLabelFile(OBJ_LABEL_MAP)
-
-    def detect_objects(self, test_image_paths):
-        objects_in_image = [] # holds all objects found in image
-        labels = [] # labels of detected objects
-        frame_num = 0 # ZoneMinder current alarm frame number
-        monitor = '' # ZoneMinder current monitor name
-
-        for image_path in test_image_paths:
-            logging.debug('**********Find object(s) for {}'.format(image_path))
-
-            # If consecutive frames then repeat last label and skip inference.
-            # This behavior controlled by CON_IMG_SKIP.
-            skip, frame_num, monitor = skip_inference(frame_num, monitor,
-                labels, image_path, objects_in_image)
-            if skip is True:
-                continue
+        self.obj_model = get_backend().model_path(OBJ_MODEL, OBJ_CPU_MODEL)
+        self.metrics = Metrics('objects')
+        model_paths = [self.obj_model, OBJ_LABEL_MAP]
+        settings = {'minScore': OBJ_MIN_SCORE_THRESH}
+        # Last inferred frame of each monitor.
+        self.monitor_states = MonitorStates(ttl=OBJ_FRAME_STATE_TTL)
+        # Results of earlier requests, of the models once they are loaded.
+        self.result_cache = ResultCache(db_path=RESULT_CACHE_PATH, table='objects',
+            model=None, max_bytes=RESULT_CACHE_MB * 1024 * 1024)
+        # Queue of concurrent requests.
+        self.request_queue = RequestQueue('objects', self._with_models(self._detect_objects),
+            max_batch=QUEUE_MAX_BATCH, max_wait=QUEUE_MAX_WAIT / 1000.,
+            max_requests=QUEUE_MAX_REQUESTS, timeout=QUEUE_TIMEOUT / 1000.,
+            key=parse_image_path)
+        super().__init__('objects', model_paths, settings)
 
-            # Read image from disk. 
-            img = cv2.imread(MOUNT_POINT + image_path)
-            #cv2.imwrite('./obj_img.jpg', img)
-            if img is None:
-                # Bad image was read.
-                logging.error('Bad image was read.')
-                objects_in_image.append({'image': image_path, 'labels': []})
+    def load_models(self):
+        # Object detection engines, one per worker.
+        obj_pool = WorkerPool('objects',
+            lambda i: get_backend().detection_engine(self.obj_model, device=i), OBJ_NUM_WORKERS)
+        # The first inference of an engine is much slower than the rest.
+        obj_pool.map(lambda obj_engine, _: obj_engine.detect_with_input_tensor(
+            np.zeros(300 * 300 * 3, dtype=np.uint8), threshold=0.05, top_k=3),
+            range(OBJ_NUM_WORKERS))
+        return {'pool': obj_pool, 'labels_map': ReadLabelFile(OBJ_LABEL_MAP)}
+
+    def detect(self, obj_engine, labels_map, obj_input):
+        # Run object inference on a prefetched image and return its labels.
+        # NB: reshape(-1) of the contiguous input is a view, not a copy.
+        try:
+            with self.metrics.timer('inference'):
+                detection = obj_engine.detect_with_input_tensor(obj_input['input'].reshape(-1),
+                    threshold=0.05, top_k=3)
+        finally:
+            buffer_pool.put(obj_input['input'])
+
+        # Get labels and scores of detected objects.
+        start = time.monotonic()
+        labels = [] # new detection, clear labels list. 
+        (h, w) = obj_input['size'] # use original image size for box coords
+        for obj in detection:
+            logging.debug('id: {} name: {} score: {}'
+                .format(obj.label_id, labels_map[obj.label_id], obj.score))
+            if obj.score > OBJ_MIN_SCORE_THRESH:
+                object_dict = {}
+                object_dict['id'] = obj.label_id
+                object_dict['name'] = labels_map[obj.label_id]
+                object_dict['score'] = float(obj.score)
+                (xmin, ymin, xmax, ymax) = (obj.bounding_box.flatten().tolist()) * np.array([w, h, w, h])
+                object_dict['box'] = {'ymin': ymin, 'xmin': xmin, 'ymax': ymax, 'xmax': xmax}
+                labels.append(object_dict)
+        self.metrics.observe('postprocess', time.monotonic() - start)
+        return labels
+
+    def _pop_done(self, models, pending, inferred, wait=False):
+        """
+        Pop and yield the (index, result) at the head of pending while their labels are known.
+
+        With wait, the workers are waited for until pending is empty.
+        The labels of inferred images are cached for later requests.
+        """
+        while pending:
+            (i, result) = pending[0]
+            labels = result['labels']
+            if not wait and isinstance(labels, Future) and not labels.done():
+                return
+            pending.popleft()
+            try:
+                result['labels'] = resolve_labels(labels)
+            except Exception:
+                self.metrics.count('errors')
+                raise
+            if i in inferred:
+                self.result_cache.put(inferred.pop(i), result['labels'],
+                    model=models['model_id'])
+            yield i, result
+
+    def _detect_objects(self, models, test_image_paths):
+        """
+        Find objects in images.
+
+        Yields the (index, result) of each image as soon as its labels are
+        known, in the order the images are processed.
+        """
+        # Process images ordered by monitor, event and frame number so that
+        # consecutive frame skipping works no matter how the client orders them.
+        image_infos = [parse_image_path(image_path) for image_path in test_image_paths]
+        order = sorted(range(len(test_image_paths)),
+            key=lambda i: image_infos[i] or ('', '', 0))
+
+        # Find the images that will not be skipped and start reading and
+        # resizing them in the background so that this overlaps inference.
+        # If consecutive frames then repeat last label and skip inference.
+        # This behavior controlled by OBJ_CON_IMG_SKIP.
+        last_inferred = {} # (event, frame number) of last inferred frame per monitor
+        skips = [False] * len(test_image_paths)
+        for i in order:
+            if image_infos[i] is None:
+                logging.error('Could not derive information from image path.')
+                self.metrics.count('errors')
                 continue
+            (monitor, event, frame_num) = image_infos[i]
+            if monitor not in last_inferred:
+                state = self.monitor_states.get(monitor)
+                last_inferred[monitor] = (None if state is None
+                    else (state['event'], state['frame_num']))
+            skips[i] = skip_inference(image_infos[i], last_inferred[monitor],
+                OBJ_CON_IMG_SKIP)
+            if skips[i] is False:
+                last_inferred[monitor] = (event, frame_num)
+        infer_paths = [test_image_paths[i] for i in order if skips[i] is False]
+        obj_inputs = prefetch(
+            lambda image_path: load_obj_input(image_path, self.result_cache, self.metrics),
+            infer_paths, OBJ_PREFETCH_DEPTH)
+        # Digests of the images given to the workers by index.
+        inferred = {}
+        # Results in processing order not yet yielded. Until an image's
+        # labels are inferred they are a future of the labels.
+        pending = deque()
+
+        try:
+            for i in order:
+                # Yield the results that are done so far.
+                yield from self._pop_done(models, pending, inferred)
+
+                image_path = test_image_paths[i]
+                logging.debug('**********Find object(s) for {}'.format(image_path))
+                monitor = None if image_infos[i] is None else image_infos[i][0]
+                state = None if monitor is None else self.monitor_states.get(monitor)
+
+                if skips[i] is True:
+                    logging.debug('Consecutive frame {}, skipping detect and copying previous labels.'
+                        .format(image_path))
+                    self.metrics.count('skips')
+                    pending.append((i, {'image': image_path,
+                        'labels': [] if state is None else state['labels']}))
+                    continue
+
+                # Get the prefetched image size, resized image and signature.
+                obj_input = next(obj_inputs)
+                if obj_input is None:
+                    # Bad image was read.
+                    logging.error('Bad image was read.')
+                    self.metrics.count('errors')
+                    pending.append((i, {'image': image_path, 'labels': []}))
+                    continue
+                signature = obj_input.get('signature')
+
+                # Use the labels found for this image by an earlier request.
+                if 'labels' in obj_input:
+                    labels = obj_input['labels']
+                    self.metrics.count('cache_hits')
+                    pending.append((i, {'image': image_path, 'labels': labels}))
+                    if monitor is not None:
+                        (_, event, frame_num) = image_infos[i]
+                        self.monitor_states.update(monitor, event=event, frame_num=frame_num,
+                            labels=labels, signature=None)
+                    continue
+
+                # If the scene hasn't materially changed since the last inferred
+                # frame from this monitor then repeat its labels and skip inference.
+                # This behavior controlled by OBJ_DEDUP_THRESHOLD.
+                if OBJ_DEDUP_THRESHOLD > 0:
+                    distance = (None if state is None or state['signature'] is None
+                        else signature_distance(signature, state['signature']))
+                    dedup = {'distance': distance,
+                        'reused': distance is not None and distance < OBJ_DEDUP_THRESHOLD}
+                    logging.debug('Scene change distance {} reused labels {}.'
+                        .format(distance, dedup['reused']))
+                    if dedup['reused']:
+                        buffer_pool.put(obj_input['input'])
+                        self.metrics.count('skips')
+                        pending.append((i, {'image': image_path,
+                            'labels': state['labels'], 'dedup': dedup}))
+                        continue
+
+                # Run object inference on the next idle worker.
+                labels = models['pool'].submit(self.detect, models['labels_map'], obj_input)
+                inferred[i] = obj_input['digest']
 
-            # Resize. The tpu obj det requires (300, 300).
-            res = resize_to_square(img=img, size=300, keep_aspect_ratio=True,
-                interpolation=cv2.INTER_AREA)
-            #cv2.imwrite('./obj_res.jpg', res)
-
-            # Run object inference.
-            detection = self.obj_engine.detect_with_input_tensor(res.reshape(-1),
-                threshold=0.05, top_k=3)
-
-            # Get labels and scores of detected objects.
-            labels = [] # new detection, clear labels list. 
-            (h, w) = img.shape[:2] # use original image size for box coords
-            for obj in detection:
-                logging.debug('id: {} name: {} score: {}'
-                    .format(obj.label_id, self.labels_map[obj.label_id], obj.score))
-                if obj.score > OBJ_MIN_SCORE_THRESH:
-                    object_dict = {}
-                    object_dict['id'] = obj.label_id
-                    object_dict['name'] = self.labels_map[obj.label_id]
-                    object_dict['score'] = float(obj.score)
-                    (xmin, ymin, xmax, ymax) = (obj.bounding_box.flatten().tolist()) * np.array([w, h, w, h])
-                    object_dict['box'] = {'ymin': ymin, 'xmin': xmin, 'ymax': ymax, 'xmax': xmax}
-                    labels.append(object_dict)
-
-            objects_in_image.append({'image': image_path, 'labels': labels})
-        return json.dumps(objects_in_image)
+                result = {'image': image_path, 'labels': labels}
+                if OBJ_DEDUP_THRESHOLD > 0:
+                    result['dedup'] = dedup
+                pending.append((i, result))
+
+                # Remember this frame for skipping frames of this monitor
+                # in this and later requests.
+                if monitor is not None:
+                    (_, event, frame_num) = image_infos[i]
+                    self.monitor_states.update(monitor, event=event, frame_num=frame_num,
+                        labels=labels, signature=signature)
+
+            # Wait for the workers to yield the rest.
+            yield from self._pop_done(models, pending, inferred, wait=True)
+        finally:
+            # Only keep monitor states with inferred labels for later requests.
+            for monitor in {info[0] for info in image_infos if info is not None}:
+                state = self.monitor_states.get(monitor)
+                if state is None or not isinstance(state['labels'], Future):
+                    continue
+                try:
+                    state['labels'] = wait_result(state['labels'])
+                except Exception:
+                    self.monitor_states.discard(monitor)
+
+        logging.debug('object worker stats {}'.format(models['pool'].stats()))
+        logging.debug('frame cache stats {}'.format(frame_cache.stats()))
+        logging.debug('result cache stats {}'.format(self.result_cache.stats()))
+
+    def detect_objects(self, test_image_paths, result_format='json'):
+        # Results in the same order as the image paths.
+        objects_in_image = [None] * len(test_image_paths)
+        for (i, result) in self.request_queue.run(test_image_paths):
+            objects_in_image[i] = result
+        # Only frames of requests that succeed are counted.
+        self.metrics.count('frames', len(test_image_paths))
+        # Encode results in requested format and return data.
+        with self.metrics.timer('serialize'):
+            return encode_results(objects_in_image, result_format)
+
+    @zerorpc.stream
+    def detect_objects_stream(self, test_image_paths, result_format='json'):
+        # Stream the result of each image as soon as it is done.
+        for (_, result) in self.request_queue.run(test_image_paths):
+            with self.metrics.timer('serialize'):
+                data = encode_result(result, result_format)
+            yield data
+        self.metrics.count('frames', len(test_image_paths))
+
+    def get_stats(self):
+        # Return the latency and throughput metrics of the server and its caches.
+        return dict(self.metrics.stats(), state=self.state,
+            workers=self._worker_stats(),
+            queue=self.request_queue.stats(), frameCache=frame_cache.stats(),
+            resultCache=self.result_cache.stats())
 
 # zerorpc face detection server.
-class FaceDetectRPC(object):
+class FaceDetectRPC(ModelServer):
     def __init__(self):
-        # Init TPU engine.
-        self.face_engine = DetectionEngine(FACE_DET_MODEL)
+        self.face_det_model = get_backend().model_path(FACE_DET_MODEL, FACE_DET_CPU_MODEL)
+        self.metrics = Metrics('faces')
+        if FACE_RECOGNIZER == 'knn':
+            model_paths = [self.face_det_model, FACE_ENCODINGS]
+        else:
+            model_paths = [self.face_det_model, FACE_CLASS_MODEL]
+            if not FACE_CLASS_MODEL.endswith('.npz'):
+                model_paths.append(FACE_LABEL_MAP)
+        settings = {'recognizer': FACE_RECOGNIZER, 'knnNeighbors': FACE_KNN_NEIGHBORS,
+            'knnTolerance': FACE_KNN_TOLERANCE, 'minProba': FACE_MIN_PROBA, 'minFace': FACE_MIN,
+            'focusMeasureThreshold': FACE_FOCUS_MEASURE_THRESHOLD,
+            'numJitters': FACE_NUM_JITTERS, 'faceCropMargin': FACE_CROP_MARGIN}
+        # Tracks of the persons in events.
+        self.tracker = make_tracker()
+        # Number of face encoder resamples adapted to the load.
+        self.jitter_policy = JitterPolicy(min_jitters=FACE_MIN_JITTERS,
+            max_jitters=FACE_NUM_JITTERS, target=FACE_JITTER_TARGET / 1000.)
 
+        # Results of earlier requests, of the models once they are loaded.
+        self.result_cache = ResultCache(db_path=RESULT_CACHE_PATH, table='faces',
+            model=None, max_bytes=RESULT_CACHE_MB * 1024 * 1024)
+        # Queue of concurrent requests.
+        self.request_queue = RequestQueue('faces', self._with_models(
+            lambda models, objects: enumerate(self._detect_faces(models, objects))),
+            max_batch=QUEUE_MAX_BATCH, max_wait=QUEUE_MAX_WAIT / 1000.,
+            max_requests=QUEUE_MAX_REQUESTS, timeout=QUEUE_TIMEOUT / 1000.,
+            key=lambda obj: parse_image_path(obj['image']))
+        super().__init__('faces', model_paths, settings)
+
+    def load_models(self):
         # Load face recognition model and the label encoder.
-        with open(FACE_CLASS_MODEL, 'rb') as fp:
-            self.recognizer = pickle.load(fp)
-        with open(FACE_LABEL_MAP, 'rb') as fp:
-            self.le = pickle.load(fp)
+        if FACE_RECOGNIZER == 'knn':
+            recognizer = le = load_face_index(FACE_ENCODINGS, k=FACE_KNN_NEIGHBORS,
+                tolerance=FACE_KNN_TOLERANCE)
+        else:
+            (recognizer, le) = load_face_classifier(FACE_CLASS_MODEL, FACE_LABEL_MAP)
 
-    def detect_faces(self, test_image_paths):
-        # List that will hold all images with any face detection information. 
-        objects_detected_faces = []
+        # Face detection engines and face encoders, one of each per worker.
+        face_pool = WorkerPool('faces',
+            lambda i: (get_backend().detection_engine(self.face_det_model, device=i),
+                FaceEncoder()),
+            FACE_NUM_WORKERS)
+        # The first inference of an engine and of dlib is much slower than the rest.
+        def warm_up(worker, _):
+            (face_engine, face_encoder) = worker
+            face_engine.detect_with_input_tensor(np.zeros(320 * 320 * 3, dtype=np.uint8),
+                threshold=0.05, top_k=1)
+            return face_encoder.encode(np.zeros((150, 150, 3), dtype=np.uint8),
+                (0, 150, 150, 0), 1)
+        encoding = face_pool.map(warm_up, range(FACE_NUM_WORKERS))[0]
+        face_classifier(recognizer, le, encoding.reshape(1, -1), FACE_MIN_PROBA)
+        return {'pool': face_pool, 'recognizer': recognizer, 'le': le}
+
+    def encode(self, worker, models, roi, num_jitters):
+        """
+        Detect and encode the face in a person roi on a worker.
+
+        Returns the 128D face encoding, resampled num_jitters times by the
+        face encoder, or None if no face could be encoded.
+        """
+        (face_engine, face_encoder) = worker
+        # Need roi shape for later conversion of face coords.
+        (h, w) = roi.shape[:2]
+        # Resize roi for face detection into a pooled buffer.
+        # The tpu face det model used requires (320, 320).
+        with self.metrics.timer('resize'):
+            res = resize_to_square(img=roi, size=320, keep_aspect_ratio=True,
+                interpolation=cv2.INTER_AREA, dst=buffer_pool.get((320, 320, 3)))
+        #cv2.imwrite('./res.jpg', res)
+
+        # Detect the (x, y)-coordinates of the bounding boxes corresponding
+        # to a face in the input image using the TPU engine.
+        # Its assumed that only one face is in the image. 
+        # NB: reshape(-1) converts the np img array into 1-d without a copy. 
+        try:
+            with self.metrics.timer('inference'):
+                detection = face_engine.detect_with_input_tensor(res.reshape(-1),
+                    threshold=0.05, top_k=1)
+        finally:
+            buffer_pool.put(res)
+        if not detection:
+            # No face detected...move on to next image.
+            logging.debug('No face detected.')
+            return None
+
+        # Convert coords, clipped to the person roi.
+        start = time.monotonic()
+        box = (detection[0].bounding_box.flatten().tolist()) * np.array([w, h, w, h])
+        (face_left, face_top, face_right, face_bottom) = np.clip(box.astype('int'),
+            0, [w, h, w, h])
+        (f_h, f_w) = (face_bottom - face_top, face_right - face_left)
+        # If face width or height are not sufficiently large then skip.
+        if f_h < FACE_MIN or f_w < FACE_MIN:
+            logging.debug('Face too small to recognize.')
+            self.metrics.observe('postprocess', time.monotonic() - start)
+            return None
 
+        # Carve out the face with a margin, the rest of the person roi
+        # (mostly body and background) isn't needed for the encoding.
+        (m_y, m_x) = (int(f_h * FACE_CROP_MARGIN), int(f_w * FACE_CROP_MARGIN))
+        (crop_left, crop_top) = (max(0, face_left - m_x), max(0, face_top - m_y))
+        crop = roi[crop_top:min(h, face_bottom + m_y), crop_left:min(w, face_right + m_x), :]
+        # Face coords within the crop.
+        (face_left, face_right) = (face_left - crop_left, face_right - crop_left)
+        (face_top, face_bottom) = (face_top - crop_top, face_bottom - crop_top)
+        face_roi = crop[face_top:face_bottom, face_left:face_right, :]
+        #cv2.imwrite('./face_roi.jpg', face_roi)
+
+        # Compute the focus measure of the face
+        # using the Variance of Laplacian method.
+        # See https://www.pyimagesearch.com/2015/09/07/blur-detection-with-opencv/
+        gray = cv2.cvtColor(face_roi, cv2.COLOR_BGR2GRAY)
+        fm = cv2.Laplacian(gray, cv2.CV_64F).var()
+        self.metrics.observe('postprocess', time.monotonic() - start)
+        # If fm below a threshold then face probably isn't clear enough
+        # for face recognition to work, so skip it. 
+        if fm < FACE_FOCUS_MEASURE_THRESHOLD:
+            logging.debug('Face too blurry to recognize.')
+            return None
+
+        # Find the 128-dimension face encoding for face in image.
+        # Convert face crop from BGR (OpenCV ordering) to dlib ordering (RGB).
+        rgb = cv2.cvtColor(crop, cv2.COLOR_BGR2RGB)
+        # Convert face bbox into dlib format.
+        box = (face_top, face_right, face_bottom, face_left)
+        # Generate the encoding, only one face is assumed.
+        with self.metrics.timer('encode'):
+            encoding = face_encoder.encode(rgb, box, num_jitters)
+        logging.debug('face encoding {}'.format(encoding))
+        return encoding
+
+    def _classify(self, models, faces):
+        """
+        Classify the encoded faces of persons in one batch.
+
+        faces are (label, digest, num_jitters, future, recognized) of persons
+        whose future is done and yields their face encoding. Adds the face
+        name and confidence to their labels, caches them for later requests
+        and then sets their recognized future.
+        """
+        encoded = []
+        for face in faces:
+            (label, digest, num_jitters, future, recognized) = face
+            if future.exception() is not None:
+                recognized.set_exception(future.exception())
+            elif future.result() is None:
+                label['face'] = None
+                self.result_cache.put(roi_key(digest, label['box']), {'face': None},
+                    model=models['model_id'])
+                recognized.set_result(None)
+            else:
+                encoded.append(face)
+        if not encoded:
+            return
+
+        # Perform svm classification on the encodings to recognize the faces.
+        try:
+            with self.metrics.timer('classify'):
+                (names, probas) = run_off_hub(face_classifier, models['recognizer'],
+                    models['le'], np.array([future.result() for (_, _, _, future, _) in encoded]),
+                    FACE_MIN_PROBA)
+        except Exception as e:
+            for (_, _, _, _, recognized) in encoded:
+                recognized.set_exception(e)
+            raise
+        for ((label, digest, num_jitters, _, recognized), name, proba) in zip(encoded, names, probas):
+            # Add face name and confidence and the number of times the face
+            # encoder resampled the face to label metadata.
+            # (First convert NumPy value to native Python type for json serialization.)
+            label.update(face=name, faceProba=proba.item(), numJitters=num_jitters)
+            self.result_cache.put(roi_key(digest, label['box']),
+                {'face': name, 'faceProba': label['faceProba']}, model=models['model_id'])
+            recognized.set_result(None)
+
+    def _wait(self, faces, carried):
+        """
+        Wait for the face recognitions of an image and carry over the
+        identities of its tracked persons.
+
+        Returns the (label, track) of the persons whose identity couldn't
+        be carried over, to recognize them again.
+        """
+        try:
+            for (_, _, _, _, recognized) in faces:
+                wait_result(recognized)
+        except Exception:
+            self.metrics.count('errors')
+            raise
+        retry = carry_identities(carried, lambda future: future is None or wait_result(future))
+        self.metrics.count('tracked', len(carried) - len(retry))
+        return retry
+
+    def _detect_faces(self, models, test_image_paths):
+        """
+        Recognize the faces of the persons in images.
+
+        Yields each image with any face detection information as soon as
+        all its faces are recognized, in the order of the images.
+        """
+        # Images not yet yielded as [image, frame number, faces of its persons
+        # being recognized, persons whose identity is carried over from their track].
+        pending = deque()
+        # Faces being encoded, classified together once they are.
+        unclassified = []
+
+        def done(entry):
+            (_, _, faces, carried) = entry
+            return (all(future.done() for (_, _, _, future, _) in faces) and
+                all(wait is None or wait.done() for (_, _, _, wait) in carried))
+
+        def finish(entry):
+            # Wait for an image to be done. Returns False if persons whose
+            # identity couldn't be carried over are being recognized instead.
+            (obj, frame_num, faces, carried) = entry
+            retry = self._wait(faces, carried)
+            if retry:
+                entry[2:] = [self._start_faces(models, obj, frame_num, retry, unclassified), []]
+                return False
+            return True
+
+        def classify(wait):
+            # Classify the faces that are encoded so far in one batch, or
+            # all of them after waiting for their encodings if wait.
+            if wait:
+                for (_, _, _, future, _) in unclassified:
+                    try:
+                        wait_result(future)
+                    except Exception:
+                        pass
+            ready = []
+            rest = []
+            for face in unclassified:
+                (ready if face[3].done() else rest).append(face)
+            unclassified[:] = rest
+            self._classify(models, ready)
+
+        try:
+            for entry in self._track_faces(models, test_image_paths, unclassified):
+                # Yield the images that are done so far.
+                while pending and done(pending[0]):
+                    classify(wait=False)
+                    if finish(pending[0]):
+                        yield pending.popleft()[0]
+                pending.append(entry)
+
+            # Wait for the workers to yield the rest.
+            while pending:
+                classify(wait=True)
+                if finish(pending[0]):
+                    yield pending.popleft()[0]
+        finally:
+            # Persons tracked in other requests mustn't wait for faces that
+            # won't be classified.
+            for (_, _, _, _, recognized) in unclassified:
+                if not recognized.done():
+                    recognized.set_exception(RuntimeError('Face recognition was cancelled.'))
+
+        logging.debug('face worker stats {}'.format(models['pool'].stats()))
+        logging.debug('frame cache stats {}'.format(frame_cache.stats()))
+        logging.debug('result cache stats {}'.format(self.result_cache.stats()))
+
+    def _track_faces(self, models, test_image_paths, unclassified):
+        """
+        Start the face encodings of the persons in images.
+
+        Yields each image as [image, frame number, faces of its persons being
+        encoded, which are also added to unclassified, persons whose identity
+        is carried over from their track].
+        """
         # Loop over the images paths provided. 
         for obj in test_image_paths:
             logging.debug('**********Find Face(s) for {}'.format(obj['image']))
-            for label in obj['labels']:
-                # If the object detected is a person then try to identify face. 
-                if label['name'] == 'person':
-                    # Read image from disk. 
-                    img = cv2.imread(MOUNT_POINT + obj['image'])
-                    if img is None:
-                        # Bad image was read.
-                        logging.error('Bad image was read.')
-                        label['face'] = None
-                        continue
+            (frame_num, persons, carried) = track_persons(self.tracker, obj)
+            yield [obj, frame_num, self._start_faces(models, obj, frame_num, persons,
+                unclassified), carried]
+
+    def _start_faces(self, models, obj, frame_num, persons, unclassified):
+        """
+        Start the face encodings of the (label, track) persons of an image.
+
+        Returns the faces being encoded, which are also added to unclassified.
+        Persons found in the result cache or whose roi is bad are done at once.
+        """
+        # Faces of the persons in this image being encoded.
+        faces = []
+        # Digest of the image used to find results of earlier requests, '' if
+        # the result cache is disabled.
+        digest = None if self.result_cache.enabled else ''
+        if persons and self.result_cache.enabled:
+            digest = run_off_hub(frame_digest, obj['image'], self.result_cache, self.metrics)
+            if digest is None:
+                logging.error('Bad image was read.')
+                self.metrics.count('errors')
+        # Read image only once and only if it has an uncached person in it.
+        # The frame is normally already in the cache from object detection.
+        # All person rois in the image are carved out of this single decode.
+        img = None
+        # Try to identify the face of each person that isn't tracked.
+        for (label, track) in persons:
+            if digest is None:
+                # Bad image was read.
+                label['face'] = None
+                continue
+
+            # Use the result found for this person by an earlier request.
+            cached = self.result_cache.get(roi_key(digest, label['box']))
+            if cached is not None:
+                label.update(cached)
+                self.metrics.count('cache_hits')
+                if track is not None:
+                    self.tracker.recognize(track, frame_num, label)
+                continue
+
+            if img is None:
+                img = run_off_hub(frame_cache.imread, MOUNT_POINT + obj['image'],
+                    cv2.IMREAD_COLOR, self.metrics)
+                if img is None:
+                    # Bad image was read, the rest of its persons too.
+                    logging.error('Bad image was read.')
+                    self.metrics.count('errors')
+                    label['face'] = None
+                    digest = None
+                    continue
+
+            # First bound the roi using the coord info passed in.
+            # The roi is area around person(s) detected in image.
+            # (x1, y1) are the top left roi coordinates.
+            # (x2, y2) are the bottom right roi coordinates.
+            y2 = int(label['box']['ymin'])
+            x1 = int(label['box']['xmin'])
+            y1 = int(label['box']['ymax'])
+            x2 = int(label['box']['xmax'])
+            roi = img[y2:y1, x1:x2, :]
+            #cv2.imwrite('./roi.jpg', roi)
+            if roi.size == 0:
+                # Bad object roi...move on to next image.
+                logging.error('Bad object roi.')
+                self.metrics.count('errors')
+                label['face'] = None
+                self.result_cache.put(roi_key(digest, label['box']), {'face': None},
+                    model=models['model_id'])
+                continue
+
+            # Encode the face on the next idle worker.
+            # Fewer resamples if other requests are waiting.
+            num_jitters = self.jitter_policy.choose(self.request_queue.stats()['requests'] - 1)
+            future = models['pool'].submit(self.encode, models, roi, num_jitters)
+            # Set once the face is classified.
+            recognized = Future()
+            faces.append((label, digest, num_jitters, future, recognized))
+            unclassified.append(faces[-1])
+            if track is not None:
+                self.tracker.recognize(track, frame_num, label, recognized)
+        return faces
+
+    def _observe_latency(self, start, encoded):
+        # Adapt the face encoder resamples to the latency of a request that encoded faces.
+        if encoded:
+            self.jitter_policy.observe(time.monotonic() - start)
+
+    def detect_faces(self, test_image_paths, result_format='json'):
+        start = time.monotonic()
+        # List that will hold all images with any face detection information. 
+        objects_detected_faces = [None] * len(test_image_paths)
+        for (i, obj) in self.request_queue.run(test_image_paths):
+            objects_detected_faces[i] = obj
+        # Only frames of requests that succeed are counted.
+        self.metrics.count('frames', len(test_image_paths))
+        self._observe_latency(start, any(encoded_face(obj) for obj in objects_detected_faces))
+        # Encode results in requested format and return data.
+        with self.metrics.timer('serialize'):
+            return encode_results(objects_detected_faces, result_format)
+
+    @zerorpc.stream
+    def detect_faces_stream(self, test_image_paths, result_format='json'):
+        # Stream each image with any face detection information as soon as it is done.
+        start = time.monotonic()
+        encoded = False
+        for (_, obj) in self.request_queue.run(test_image_paths):
+            encoded = encoded or encoded_face(obj)
+            with self.metrics.timer('serialize'):
+                data = encode_result(obj, result_format)
+            yield data
+        self.metrics.count('frames', len(test_image_paths))
+        self._observe_latency(start, encoded)
+
+    def enroll_face(self, name, test_image_paths):
+        """
+        Add the faces of the persons in images to the known faces of name.
 
-                    # First bound the roi using the coord info passed in.
-                    # The roi is area around person(s) detected in image.
-                    # (x1, y1) are the top left roi coordinates.
-                    # (x2, y2) are the bottom right roi coordinates.
-                    y2 = int(label['box']['ymin'])
-                    x1 = int(label['box']['xmin'])
-                    y1 = int(label['box']['ymax'])
-                    x2 = int(label['box']['xmax'])
-                    roi = img[y2:y1, x1:x2, :]
-                    #cv2.imwrite('./roi.jpg', roi)
+        test_image_paths are images with person labels like for detect_faces,
+        e.g. the results of detect_objects. Needs the knn face recognizer.
+        The faces are recognized by the next requests without retraining and
+        saved to the known face encodings. Returns the number of faces added.
+        """
+        if FACE_RECOGNIZER != 'knn':
+            raise RuntimeError('Enrolling faces needs the knn face recognizer.')
+        with self._use_models() as models:
+            futures = []
+            for obj in test_image_paths:
+                persons = [label for label in obj['labels'] if label['name'] == 'person']
+                if not persons:
+                    continue
+                img = run_off_hub(frame_cache.imread, MOUNT_POINT + obj['image'],
+                    cv2.IMREAD_COLOR, self.metrics)
+                if img is None:
+                    logging.error('Bad image was read.')
+                    self.metrics.count('errors')
+                    continue
+                for label in persons:
+                    roi = img[int(label['box']['ymin']):int(label['box']['ymax']),
+                        int(label['box']['xmin']):int(label['box']['xmax']), :]
                     if roi.size == 0:
-                        # Bad object roi...move on to next image.
                         logging.error('Bad object roi.')
-                        label['face'] = None
-                        continue
-
-                    # Need roi shape for later conversion of face coords.
-                    (h, w) = roi.shape[:2]
-                    # Resize roi for face detection.
-                    # The tpu face det model used requires (320, 320).
-                    res = resize_to_square(img=roi, size=320, keep_aspect_ratio=True,
-                        interpolation=cv2.INTER_AREA)
-                    #cv2.imwrite('./res.jpg', res)
-
-                    # Detect the (x, y)-coordinates of the bounding boxes corresponding
-                    # to a face in the input image using the TPU engine.
-                    # Its assumed that only one face is in the image. 
-                    # NB: reshape(-1) converts the np img array into 1-d. 
-                    detection = self.face_engine.detect_with_input_tensor(res.reshape(-1),
-                        threshold=0.05, top_k=1)
-                    if not detection:
-                        # No face detected...move on to next image.
-                        logging.debug('No face detected.')
-                        label['face'] = None
-                        continue
-                        
-                    # Convert coords and carve out face roi.
-                    box = (detection[0].bounding_box.flatten().tolist()) * np.array([w, h, w, h])
-                    (face_left, face_top, face_right, face_bottom) = box.astype('int')
-                    face_roi = roi[face_top:face_bottom, face_left:face_right, :]
-                    #cv2.imwrite('./face_roi.jpg', face_roi)
-                    (f_h, f_w) = face_roi.shape[:2]
-                    # If face width or height are not sufficiently large then skip.
-                    if f_h < FACE_MIN or f_w < FACE_MIN:
-                        logging.debug('Face too small to recognize.')
-                        label['face'] = None
+                        self.metrics.count('errors')
                         continue
+                    # Encode the faces as well as possible.
+                    futures.append(models['pool'].submit(self.encode, models, roi,
+                        FACE_NUM_JITTERS))
+            encodings = [encoding for encoding in map(wait_result, futures)
+                if encoding is not None]
+            if encodings:
+                index = models['recognizer']
+                index.add([name] * len(encodings), encodings)
+                run_off_hub(index.save, FACE_ENCODINGS)
+                # The file was changed by this server, no need to reload it, but
+                # results cached for earlier requests may be wrong now.
+                self._watcher.update()
+                if self.result_cache.enabled:
+                    models['model_id'] = run_off_hub(model_id, self.model_paths,
+                        self.settings)
+                    self.result_cache.set_model(models['model_id'])
+        logging.info('Enrolled {} faces of {}.'.format(len(encodings), name))
+        return len(encodings)
 
-                    # Compute the focus measure of the face
-                    # using the Variance of Laplacian method.
-                    # See https://www.pyimagesearch.com/2015/09/07/blur-detection-with-opencv/
-                    gray = cv2.cvtColor(face_roi, cv2.COLOR_BGR2GRAY)
-                    fm = cv2.Laplacian(gray, cv2.CV_64F).var()
-                    # If fm below a threshold then face probably isn't clear enough
-                    # for face recognition to work, so skip it. 
-                    if fm < FACE_FOCUS_MEASURE_THRESHOLD:
-                        logging.debug('Face too blurry to recognize.')
-                        label['face'] = None
-                        continue
+    def get_stats(self):
+        # Return the latency and throughput metrics of the server and its caches.
+        return dict(self.metrics.stats(), state=self.state,
+            workers=self._worker_stats(),
+            queue=self.request_queue.stats(), frameCache=frame_cache.stats(),
+            resultCache=self.result_cache.stats(),
+            jitters=self.jitter_policy.stats(),
+            knownFaces=self.models['recognizer'].stats()
+                if FACE_RECOGNIZER == 'knn' and self.models is not None else None,
+            tracker=self.tracker.stats() if self.tracker is not None else None)
 
-                    # Find the 128-dimension face encoding for face in image.
-                    # Convert image roi from BGR (OpenCV ordering) to dlib ordering (RGB).
-                    rgb = cv2.cvtColor(roi, cv2.COLOR_BGR2RGB)
-                    # Convert face bbox into dlib format.
-                    boxes = [(face_top, face_right, face_bottom, face_left)]
-                    # Generate encodings. Only one face is assumed so take the 1st element. 
-                    encoding = face_recognition.face_encodings(face_image=rgb,
-                        known_face_locations=boxes, num_jitters=FACE_NUM_JITTERS)[0]
-                    logging.debug('face encoding {}'.format(encoding))
-                    # Perform svm classification on the encodings to recognize the face.
-                    (name, proba) = face_classifier(
-                        recognizer=self.recognizer,
-                        le=self.le,
-                        encoding=encoding,
-                        min_proba=FACE_MIN_PROBA)
-
-                    # Add face name to label metadata.
-                    label['face'] = name
-                    # Add face confidence to label metadata.
-                    # (First convert NumPy value to native Python type for json serialization.)
-                    label['faceProba'] = proba.item()
-            # Add processed image to output list. 
-            objects_detected_faces.append(obj)
-        # Convert json to string and return data. 
-        return(json.dumps(objects_detected_faces))
 
-# zerorpc person classifier server
-class PersonClassRPC(object):
-    def __init__(self):
-        # Load TFLite model and allocate tensors.
-        self.interpreter = tflite.Interpreter(model_path=PERSON_CLASS_MODEL,
-            experimental_delegates=[tflite.load_delegate('libedgetpu.so.1')])
+# Person classifier worker.
+class PersonClassifier(object):
+    def __init__(self, make_interpreter, metrics):
+        self.metrics = metrics
+        # Allocate tensors of the TFLite model, one roi per invoke.
+        self.interpreter = make_interpreter()
         self.interpreter.allocate_tensors()
 
         # Get input and output tensors.
         self.input_details = self.interpreter.get_input_details()
         self.output_details = self.interpreter.get_output_details()
 
-    def detect_faces(self, test_image_paths):
-        # List that will hold all images with any person classification information. 
-        objects_classified_persons = []
+        # A second interpreter of the model with its input sized once for
+        # batches of up to batch_size rois, since resizing reallocates the
+        # tensors. An invoke runs the whole batch however many rois are in
+        # it, so batches of fewer than min_batch rois are classified one
+        # roi at a time instead.
+        self.batch_interpreter = None
+        self.batch_size = 1
+        self.min_batch = 1
+        # Check if the model can classify a batch of rois per invoke.
+        if PERSON_MAX_BATCH > 1:
+            self.batch_interpreter = self._batch_interpreter(make_interpreter(), PERSON_MAX_BATCH)
+        self.batched = self.batch_interpreter is not None
+        if self.batched:
+            self.batch_size = PERSON_MAX_BATCH
+        else:
+            logging.info('Person classifier model does not support batches.')
 
-        # Loop over the images paths provided. 
-        for obj in test_image_paths:
-            logging.debug('**********Classify person for {}'.format(obj['image']))
-            for label in obj['labels']:
-                # If the object detected is a person then try to identify face. 
-                if label['name'] == 'person':
-                    # Read image from disk. 
-                    img = cv2.imread(MOUNT_POINT + obj['image'])
+    def _batch_interpreter(self, interpreter, batch_size):
+        """
+        Resize the input of interpreter to take batch_size rois.
+
+        Returns the interpreter or None if the model can't be resized.
+        """
+        input_index = self.input_details[0]['index']
+        (_, h, w, c) = self.input_details[0]['shape']
+        try:
+            interpreter.resize_tensor_input(input_index, [batch_size, h, w, c])
+            interpreter.allocate_tensors()
+            # Some delegates only fail at invoke time so check that too.
+            interpreter.set_tensor(input_index,
+                np.zeros((batch_size, h, w, c), dtype=self.input_details[0]['dtype']))
+            interpreter.invoke()
+        except (ValueError, RuntimeError) as e:
+            logging.debug('Cannot resize person classifier input: {}'.format(e))
+            return None
+        return interpreter
+
+    def warm_up(self):
+        """
+        Run the first inferences, which are much slower than the rest.
+
+        Times an invoke of each interpreter afterwards to find the smallest
+        batch that is faster to classify in one invoke than one roi at a time.
+        """
+        interpreters = [self.interpreter]
+        if self.batched:
+            interpreters.append(self.batch_interpreter)
+        times = []
+        for interpreter in interpreters:
+            interpreter.invoke()
+            # Best of a few invokes.
+            best = None
+            for _ in range(3):
+                start = time.monotonic()
+                interpreter.invoke()
+                elapsed = time.monotonic() - start
+                best = elapsed if best is None else min(best, elapsed)
+            times.append(best)
+        if self.batched and times[0] > 0:
+            self.min_batch = max(1, min(self.batch_size, int(-(-times[1] // times[0]))))
+            logging.debug('Person classifier batches of {} or more rois run in one invoke.'
+                .format(self.min_batch))
+
+    def _invoke(self, interpreter, rois):
+        # Resize rois straight into the interpreter's input tensor, run the
+        # model and return the (class id, score) of each roi's most likely class.
+        (_, h, w, _) = self.input_details[0]['shape']
+        with self.metrics.timer('resize'):
+            input_tensor = interpreter.tensor(self.input_details[0]['index'])()
+            for i, roi in enumerate(rois):
+                cv2.resize(roi, (w, h), dst=input_tensor[i])
+                #cv2.imwrite('./roi.jpg', input_tensor[i])
+            # The interpreter won't run while views of its tensors are held.
+            del input_tensor
+        with self.metrics.timer('inference'):
+            interpreter.invoke()
+
+        # Read the scores through a view of the output tensor.
+        start = time.monotonic()
+        output = interpreter.tensor(self.output_details[0]['index'])()
+        results = []
+        for i in range(len(rois)):
+            class_id = int(np.argmax(output[i]))
+            results.append((class_id, output[i, class_id].item()))
+        del output
+        self.metrics.observe('postprocess', time.monotonic() - start)
+        return results
+
+    def classify(self, rois):
+        """
+        Classify person rois.
+
+        Returns the (class id, score) of the most likely class of each roi.
+        """
+        results = []
+        for i in range(0, len(rois), self.batch_size):
+            batch = rois[i:i + self.batch_size]
+            if self.batched and len(batch) >= self.min_batch:
+                results.extend(self._invoke(self.batch_interpreter, batch))
+            else:
+                # One roi per invoke if the model doesn't support batches
+                # or there are too few rois to fill a batch.
+                for roi in batch:
+                    results.extend(self._invoke(self.interpreter, [roi]))
+        return results
+
+# zerorpc person classifier server
+class PersonClassRPC(ModelServer):
+    def __init__(self):
+        self.person_class_model = get_backend().model_path(PERSON_CLASS_MODEL,
+            PERSON_CLASS_CPU_MODEL)
+        self.metrics = Metrics('persons')
+        model_paths = [self.person_class_model]
+        settings = {'labelMap': PERSON_LABEL_MAP, 'minProba': PERSON_MIN_PROBA}
+        # Tracks of the persons in events.
+        self.tracker = make_tracker()
+
+        # Results of earlier requests, of the models once they are loaded.
+        self.result_cache = ResultCache(db_path=RESULT_CACHE_PATH, table='persons',
+            model=None, max_bytes=RESULT_CACHE_MB * 1024 * 1024)
+        # Queue of concurrent requests.
+        self.request_queue = RequestQueue('persons', self._with_models(
+            lambda models, objects: enumerate(self._detect_faces(models, objects))),
+            max_batch=QUEUE_MAX_BATCH, max_wait=QUEUE_MAX_WAIT / 1000.,
+            max_requests=QUEUE_MAX_REQUESTS, timeout=QUEUE_TIMEOUT / 1000.,
+            key=lambda obj: parse_image_path(obj['image']))
+        super().__init__('persons', model_paths, settings)
+
+    def load_models(self):
+        # Load TFLite model, one interpreter per worker.
+        person_pool = WorkerPool('persons',
+            lambda i: PersonClassifier(
+                lambda: get_backend().interpreter(self.person_class_model, device=i),
+                self.metrics), PERSON_NUM_WORKERS)
+        # The first inference of an interpreter is much slower than the rest.
+        # Its input tensor is still zeroed.
+        person_pool.map(lambda person_classifier, _: person_classifier.warm_up(),
+            range(PERSON_NUM_WORKERS))
+        return {'pool': person_pool,
+            'batched': all(worker.batched for worker in person_pool.workers)}
+
+    def _classify(self, person_classifier, model, person_labels, rois):
+        # Classify rois on a worker and add the results to their person labels.
+        # Its assumed that only one person is in each roi.
+        classifications = person_classifier.classify(rois)
+        for (digest, label), (class_id, score) in zip(person_labels, classifications):
+            # Most likely prediction.
+            proba = score / 256. # probas range from 1 to 256
+            person = PERSON_LABEL_MAP[class_id]
+            logging.debug('person classifier proba {} name {}'.format(proba, person))
+            if proba >= PERSON_MIN_PROBA:
+                name = person
+                logging.debug('person classifier says this is {}'.format(name))
+            else:
+                name = None # prob too low to recog face
+                logging.debug('person classifier cannot recognize person')
+
+            # Add face name to label metadata.
+            label['face'] = name
+            # Add face confidence to label metadata.
+            label['faceProba'] = proba
+
+            # Cache result for later requests.
+            self.result_cache.put(roi_key(digest, label['box']),
+                {'face': label['face'], 'faceProba': label['faceProba']}, model=model)
+
+    def _submit(self, models, batch):
+        # Classify a batch of person rois on the next idle worker.
+        batch['future'] = models['pool'].submit(self._classify,
+            models['model_id'], batch['labels'], batch['rois'])
+
+    def _wait(self, batches, carried):
+        """
+        Wait for the batches the persons of an image are in and carry over
+        the identities of its tracked persons.
+
+        Returns the (label, track) of the persons whose identity couldn't
+        be carried over, to classify them again.
+        """
+        try:
+            for b in batches:
+                wait_result(b['future'])
+        except Exception:
+            self.metrics.count('errors')
+            raise
+        retry = carry_identities(carried, lambda b: b is None or wait_result(b['future']))
+        self.metrics.count('tracked', len(carried) - len(retry))
+        return retry
+
+    def _detect_faces(self, models, test_image_paths):
+        """
+        Classify the persons in images.
+
+        Yields each image with any person classification information as
+        soon as all its persons are classified, in the order of the images.
+        """
+        # Classify persons using the TPU engine, up to PERSON_MAX_BATCH rois at a time.
+        # The rois are split over the workers so they all get a share of them.
+        num_persons = sum(label['name'] == 'person'
+            for obj in test_image_paths for label in obj['labels'])
+        max_batch = PERSON_MAX_BATCH if models['batched'] else 1
+        chunk = max(1, min(max_batch, -(-num_persons // PERSON_NUM_WORKERS)))
+        # Person labels and rois of the next batch to classify.
+        batch = {'labels': [], 'rois': [], 'future': None}
+        # Images not yet yielded as [image, frame number, batches its persons
+        # are in, persons whose identity is carried over from their track].
+        pending = deque()
+
+        def submit():
+            nonlocal batch
+            self._submit(models, batch)
+            batch = {'labels': [], 'rois': [], 'future': None}
+
+        def done(entry):
+            (_, _, batches, carried) = entry
+            return all(b['future'] is not None and b['future'].done() for b in batches +
+                [b for (_, _, _, b) in carried if b is not None])
+
+        def finish(entry):
+            # Wait for an image to be done. Returns False if persons whose
+            # identity couldn't be carried over are being classified instead.
+            (obj, frame_num, batches, carried) = entry
+            retry = self._wait(batches, carried)
+            if retry:
+                entry[2:] = [start(obj, frame_num, retry), []]
+                # Don't wait for the batch to fill up.
+                if batch['rois']:
+                    submit()
+                return False
+            return True
+
+        def start(obj, frame_num, persons):
+            # Add the rois of the (label, track) persons of an image to the
+            # batches to classify and return the batches they are in.
+            # Persons found in the result cache or whose roi is bad are done at once.
+            batches = []
+            # Digest of the image used to find results of earlier requests, '' if
+            # the result cache is disabled.
+            digest = None if self.result_cache.enabled else ''
+            if persons and self.result_cache.enabled:
+                digest = run_off_hub(frame_digest, obj['image'], self.result_cache,
+                    self.metrics)
+                if digest is None:
+                    logging.error('Bad image was read.')
+                    self.metrics.count('errors')
+            # Read image only once and only if it has an uncached person in it.
+            # The frame is normally already in the cache from object detection.
+            # All person rois in the image are carved out of this single decode.
+            img = None
+            # Try to classify each person that isn't tracked.
+            for (label, track) in persons:
+                if digest is None:
+                    # Bad image was read.
+                    label['face'] = None
+                    continue
+
+                # Use the result found for this person by an earlier request.
+                cached = self.result_cache.get(roi_key(digest, label['box']))
+                if cached is not None:
+                    label.update(cached)
+                    self.metrics.count('cache_hits')
+                    if track is not None:
+                        self.tracker.recognize(track, frame_num, label)
+                    continue
+
+                if img is None:
+                    img = run_off_hub(frame_cache.imread, MOUNT_POINT + obj['image'],
+                        cv2.IMREAD_COLOR, self.metrics)
                     if img is None:
-                        # Bad image was read.
+                        # Bad image was read, the rest of its persons too.
                         logging.error('Bad image was read.')
+                        self.metrics.count('errors')
                         label['face'] = None
+                        digest = None
                         continue
 
-                    # First bound the roi using the coord info passed in.
-                    # The roi is area around person(s) detected in image.
-                    # (x1, y1) are the top left roi coordinates.
-                    # (x2, y2) are the bottom right roi coordinates.
-                    y2 = int(label['box']['ymin'])
-                    x1 = int(label['box']['xmin'])
-                    y1 = int(label['box']['ymax'])
-                    x2 = int(label['box']['xmax'])
-                    roi = img[y2:y1, x1:x2, :]
-                    if roi.size == 0:
-                        # Bad object roi...move on to next image.
-                        logging.error('Bad object roi.')
-                        label['face'] = None
-                        continue
+                # First bound the roi using the coord info passed in.
+                # The roi is area around person(s) detected in image.
+                # (x1, y1) are the top left roi coordinates.
+                # (x2, y2) are the bottom right roi coordinates.
+                y2 = int(label['box']['ymin'])
+                x1 = int(label['box']['xmin'])
+                y1 = int(label['box']['ymax'])
+                x2 = int(label['box']['xmax'])
+                roi = img[y2:y1, x1:x2, :]
+                if roi.size == 0:
+                    # Bad object roi...move on to next image.
+                    logging.error('Bad object roi.')
+                    self.metrics.count('errors')
+                    label['face'] = None
+                    continue
+
+                # Classify along with other rois once the batch is full.
+                batch['labels'].append((digest, label))
+                batch['rois'].append(roi)
+                if not batches or batches[-1] is not batch:
+                    batches.append(batch)
+                if track is not None:
+                    self.tracker.recognize(track, frame_num, label, batch)
+                if len(batch['rois']) == chunk:
+                    submit()
+            return batches
+
+        # Loop over the images paths provided. 
+        for obj in test_image_paths:
+            # Yield the images that are done so far.
+            while pending and done(pending[0]):
+                if finish(pending[0]):
+                    yield pending.popleft()[0]
+
+            logging.debug('**********Classify person for {}'.format(obj['image']))
+            (frame_num, persons, carried) = track_persons(self.tracker, obj)
+            pending.append([obj, frame_num, start(obj, frame_num, persons), carried])
+
+        # Classify the last partial batch and wait for the workers.
+        if batch['rois']:
+            submit()
+        while pending:
+            if finish(pending[0]):
+                yield pending.popleft()[0]
+
+        logging.debug('person worker stats {}'.format(models['pool'].stats()))
+        logging.debug('frame cache stats {}'.format(frame_cache.stats()))
+        logging.debug('result cache stats {}'.format(self.result_cache.stats()))
+
+    def detect_faces(self, test_image_paths, result_format='json'):
+        # List that will hold all images with any person classification information. 
+        objects_classified_persons = [None] * len(test_image_paths)
+        for (i, obj) in self.request_queue.run(test_image_paths):
+            objects_classified_persons[i] = obj
+        # Only frames of requests that succeed are counted.
+        self.metrics.count('frames', len(test_image_paths))
+        # Encode results in requested format and return data.
+        with self.metrics.timer('serialize'):
+            return encode_results(objects_classified_persons, result_format)
+
+    @zerorpc.stream
+    def detect_faces_stream(self, test_image_paths, result_format='json'):
+        # Stream each image with any person classification information as soon as it is done.
+        for (_, obj) in self.request_queue.run(test_image_paths):
+            with self.metrics.timer('serialize'):
+                data = encode_result(obj, result_format)
+            yield data
+        self.metrics.count('frames', len(test_image_paths))
+
+    def get_stats(self):
+        # Return the latency and throughput metrics of the server and its caches.
+        return dict(self.metrics.stats(), state=self.state,
+            workers=self._worker_stats(),
+            queue=self.request_queue.stats(), frameCache=frame_cache.stats(),
+            resultCache=self.result_cache.stats(),
+            tracker=self.tracker.stats() if self.tracker is not None else None)
+
+def main():
+    # Setup face detection or person classifier server.
+    if RECOGNIZE_MODE == 'person':
+        zerorpc_obj = PersonClassRPC()
+        zerorpc_pipe = PERSON_ZRPC_PIPE
+    elif RECOGNIZE_MODE == 'face':
+        zerorpc_obj = FaceDetectRPC()
+        zerorpc_pipe = FACE_ZRPC_PIPE
+    else:
+        logging.error('Unknown recognizer mode.')
+        sys.exit()
+    face_s = zerorpc.Server(zerorpc_obj, heartbeat=ZRPC_HEARTBEAT)
+    face_s.bind(zerorpc_pipe)
+    # Register graceful ways to stop server. 
+    gevent.signal(SIGINT, face_s.stop) # Ctrl-C
+    gevent.signal(SIGTERM, face_s.stop) # termination
+
+    # Setup object detection server.
+    obj_rpc = ObjDetectRPC()
+    obj_s = zerorpc.Server(obj_rpc, heartbeat=ZRPC_HEARTBEAT)
+    obj_s.bind(OBJ_ZRPC_PIPE)
+    # Register graceful ways to stop server. 
+    gevent.signal(SIGINT, obj_s.stop) # Ctrl-C
+    gevent.signal(SIGTERM, obj_s.stop) # termination
+
+    # Serve the metrics of both servers to Prometheus.
+    if METRICS_PORT:
+        serve_prometheus(METRICS_PORT, [obj_rpc.metrics, zerorpc_obj.metrics])
+        logging.info('Serving Prometheus metrics on port {}.'.format(METRICS_PORT))
+
+    # Startup both servers, their models are loaded and warmed up in the background.
+    # This will block until a gevent SIGINT or SIGTERM signal is caught.
+    gevent.joinall([gevent.spawn(face_s.run), gevent.spawn(obj_s.run)])
+    # Write the results still waiting to be cached.
+    obj_rpc.result_cache.flush()
+    zerorpc_obj.result_cache.flush()
 
-                    # Resize roi for person classification model.
-                    input_shape = self.input_details[0]['shape']
-                    input_size = tuple(input_shape[1:3])
-                    roi = cv2.resize(roi, input_size) # uint8
-                    #cv2.imwrite('./roi.jpg', roi)
-
-                    # Expand dimensions. 
-                    roi = np.expand_dims(roi, axis=0)
-
-                    # Classify person using the TPU engine.
-                    # Its assumed that only one person is in the image. 
-                    self.interpreter.set_tensor(self.input_details[0]['index'], roi)
-                    self.interpreter.invoke()
-                    classification = self.interpreter.get_tensor(self.output_details[0]['index'])[0]
-                    
-                    # Find most likely prediction.
-                    class_id = np.argmax(classification)
-                    proba = classification[class_id] / 256. # probas range from 1 to 256
-                    person = PERSON_LABEL_MAP[class_id]
-                    logging.debug('person classifier proba {} name {}'.format(proba, person))
-                    if proba >= PERSON_MIN_PROBA:
-                        name = person
-                        logging.debug('person classifier says this is {}'.format(name))
-                    else:
-                        name = None # prob too low to recog face
-                        logging.debug('person classifier cannot recognize person')
-
-                    # Add face name to label metadata.
-                    label['face'] = name
-                    # Add face confidence to label metadata.
-                    # (First convert NumPy value to native Python type for json serialization.)
-                    label['faceProba'] = proba.item()
-            # Add processed image to output list. 
-            objects_classified_persons.append(obj)
-        # Convert json to string and return data. 
-        return(json.dumps(objects_classified_persons))
-
-# Setup face detection or person classifier server.
-if RECOGNIZE_MODE == 'person':
-    zerorpc_obj = PersonClassRPC()
-    zerorpc_pipe = PERSON_ZRPC_PIPE
-elif RECOGNIZE_MODE == 'face':
-    zerorpc_obj = FaceDetectRPC()
-    zerorpc_pipe = FACE_ZRPC_PIPE
-else:
-    logging.error('Unknown recognizer mode.')
-    sys.exit()
-face_s = zerorpc.Server(zerorpc_obj, heartbeat=ZRPC_HEARTBEAT)
-face_s.bind(zerorpc_pipe)
-# Register graceful ways to stop server. 
-gevent.signal(SIGINT, face_s.stop) # Ctrl-C
-gevent.signal(SIGTERM, face_s.stop) # termination
-
-# Setup object detection server.
-obj_s = zerorpc.Server(ObjDetectRPC(), heartbeat=ZRPC_HEARTBEAT)
-obj_s.bind(OBJ_ZRPC_PIPE)
-# Register graceful ways to stop server. 
-gevent.signal(SIGINT, obj_s.stop) # Ctrl-C
-gevent.signal(SIGTERM, obj_s.stop) # termination
-
-# Startup both servers.
-# This will block until a gevent SIGINT or SIGTERM signal is caught.
-gevent.joinall([gevent.spawn(face_s.run), gevent.spawn(obj_s.run)])
\ No newline at end of file
+if __name__ == '__main__':
+    main()
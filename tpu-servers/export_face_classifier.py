@@ -0,0 +1,122 @@
+'''
+Export the face classifier to a .npz file that the servers evaluate with NumPy.
+
+Writes the pickled scikit-learn SVC and label encoder made by
+face-det-rec/train.py to a .npz file (see numpy_svc.py), checks that its
+probabilities match scikit-learn's on a set of face encodings and
+benchmarks both. Reports the model load times and the per face latency
+of classifying one face per call, like the servers used to, and of
+classifying --batch faces per call. Set the face server's modelPath in
+config.json to the .npz file to use it, scikit-learn isn't needed then.
+
+The encodings are the ones made by face-det-rec/encode_faces.py if
+given, otherwise the support vectors with some noise added.
+
+Must be run from this directory since it uses config.json like
+detect_servers_tpu.py for the default paths. Only needs NumPy and
+scikit-learn, not the servers' dependencies.
+
+Copyright (c) 2020 Lindo St. Angel
+'''
+
+import argparse
+import json
+import logging
+import os
+import pickle
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
+from numpy_svc import NumpySVC, export_svc
+
+logger = logging.getLogger(__name__)
+
+def per_face_latency(func, encodings, batch, repeat=5):
+    # Return the best per face latency in seconds of func(batch of encodings).
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for i in range(0, len(encodings), batch):
+            func(encodings[i:i + batch])
+        elapsed = (time.perf_counter() - start) / len(encodings)
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    with open('./config.json') as fp:
+        face_config = json.load(fp)['faceDetServer']
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--model',
+        default=face_config['modelPath'],
+        help='pickled scikit-learn SVC made by train.py')
+    ap.add_argument('--labels',
+        default=face_config['labelPath'],
+        help='pickled label encoder made by train.py')
+    ap.add_argument('--output',
+        default=None,
+        help='.npz file to write, the model path with a .npz extension by default')
+    ap.add_argument('--encodings',
+        default=None,
+        help='face encodings pickle made by encode_faces.py to check and benchmark on')
+    ap.add_argument('--batch',
+        type=int,
+        default=16,
+        help='number of faces per call of the batched benchmark')
+    ap.add_argument('--tolerance',
+        type=float,
+        default=1e-6,
+        help='max difference of the probabilities from scikit-learn')
+    args = vars(ap.parse_args())
+
+    logging.basicConfig(format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
+        level=logging.INFO)
+
+    start = time.perf_counter()
+    with open(args['model'], 'rb') as fp:
+        svc = pickle.load(fp)
+    with open(args['labels'], 'rb') as fp:
+        le = pickle.load(fp)
+    pickle_load_time = time.perf_counter() - start
+    output = args['output'] or args['model'].rsplit('.', 1)[0] + '.npz'
+    export_svc(svc, le.classes_, output)
+    start = time.perf_counter()
+    numpy_svc = NumpySVC(output)
+    npz_load_time = time.perf_counter() - start
+    logger.info('Wrote {} with {} support vectors of {} classes.'.format(output,
+        len(numpy_svc.support_vectors), len(numpy_svc.classes_)))
+    logger.info('Load time: pickle {:.1f} ms, npz {:.1f} ms.'.format(
+        pickle_load_time * 1000, npz_load_time * 1000))
+
+    if args['encodings'] is not None:
+        with open(args['encodings'], 'rb') as fp:
+            encodings = np.array(pickle.load(fp)['encodings'])
+    else:
+        rng = np.random.RandomState(0)
+        encodings = svc.support_vectors_ + 0.05 * rng.randn(*svc.support_vectors_.shape)
+
+    difference = np.max(np.abs(svc.predict_proba(encodings) - numpy_svc.predict_proba(encodings)))
+    logger.info('Max probability difference on {} encodings: {:.2e}'.format(len(encodings),
+        difference))
+    if difference > args['tolerance']:
+        logger.error('The exported classifier differs from scikit-learn by more than {}.'
+            .format(args['tolerance']))
+        return
+
+    # Per face latency of the classifiers' probabilities.
+    results = [('scikit-learn, 1 face per call', per_face_latency(svc.predict_proba,
+            encodings, 1)),
+        ('scikit-learn, {} faces per call'.format(args['batch']), per_face_latency(
+            svc.predict_proba, encodings, args['batch'])),
+        ('numpy, 1 face per call', per_face_latency(numpy_svc.predict_proba, encodings, 1)),
+        ('numpy, {} faces per call'.format(args['batch']), per_face_latency(
+            numpy_svc.predict_proba, encodings, args['batch']))]
+    for (name, latency) in results:
+        logger.info('  {:32s} {:8.1f} us per face  ({:.1f}x)'.format(name, latency * 1e6,
+            results[0][1] / latency))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""
+Bounded LRU cache of alarm frames.
+
+The object detector and the face / person recognizer run in the same
+process and are called back to back on the same alarm frames. This cache
+lets the recognizer reuse the frames read and decoded by the object
+detector instead of reading them from the mount point and decoding them
+again.
+
+Both the encoded (jpeg) file contents and decoded images are cached, so
+a frame decoded at reduced resolution for the object detector can later
+be decoded at full resolution for the recognizer without a disk read.
+
+Entries are keyed by image path plus its mtime and size so a frame that
+changes on disk is never served stale.
+
+Given the metrics of a server, the file reads and decodes that miss the
+cache are timed as its 'read' and 'decode' stages.
+
+This is part of the smart-zoneminder project.
+See https://github.com/goruck/smart-zoneminder
+
+Copyright (c) 2018 ~ 2020 Lindo St. Angel
+"""
+
+import os
+import time
+import cv2
+import numpy as np
+import threading
+from collections import OrderedDict
+
+# In ../common, which the servers add to their module search path.
+from jpeg_decode import jpeg_size, scaled_flags
+
+class FrameCache(object):
+    def __init__(self, max_bytes):
+        # Memory budget in bytes. Zero disables the cache.
+        self.max_bytes = max_bytes
+        self.cur_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        # Return a cached entry or None.
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def _put(self, key, entry, nbytes):
+        # Add an entry then evict least recently used ones until under budget.
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = (entry, nbytes)
+            self.cur_bytes += nbytes
+            while self.cur_bytes > self.max_bytes:
+                _, (_, old_nbytes) = self._entries.popitem(last=False)
+                self.cur_bytes -= old_nbytes
+                self.evictions += 1
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def _read(self, path, key, metrics):
+        # Return the encoded file contents, from the cache if possible.
+        entry = self._get(key + ('encoded',))
+        if entry is not None:
+            return entry[0]
+        start = time.monotonic()
+        try:
+            with open(path, 'rb') as f:
+                buf = f.read()
+        except OSError:
+            return None
+        if metrics is not None:
+            metrics.observe('read', time.monotonic() - start)
+        self._put(key + ('encoded',), buf, len(buf))
+        return buf
+
+    def _decode(self, buf, flags, metrics):
+        # Decode encoded file contents like cv2.imread.
+        start = time.monotonic()
+        img = cv2.imdecode(np.frombuffer(buf, dtype=np.uint8), flags)
+        if metrics is not None:
+            metrics.observe('decode', time.monotonic() - start)
+        return img
+
+    def read(self, path, metrics=None):
+        """
+        Return the encoded file contents of path, from the cache if possible.
+
+        Returns None if the file could not be read.
+        """
+        key = self._key(path)
+        if key is None:
+            return None
+        return self._read(path, key, metrics)
+
+    def _key(self, path):
+        # Cache key base for path, None if path doesn't exist.
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (path, st.st_mtime_ns, st.st_size)
+
+    def imread(self, path, flags=cv2.IMREAD_COLOR, metrics=None):
+        """
+        Return the decoded image at path, from the cache if possible.
+
+        Returns None if the image could not be read, just like cv2.imread.
+        Cached arrays are shared between callers and must not be modified.
+        """
+        key = self._key(path)
+        if key is None:
+            return None
+
+        entry = self._get(key + (flags,))
+        self._count(hit=entry is not None)
+        if entry is not None:
+            return entry[0]
+
+        buf = self._read(path, key, metrics)
+        if not buf:
+            return None
+        img = self._decode(buf, flags, metrics)
+        if img is not None:
+            self._put(key + (flags,), img, img.nbytes)
+        return img
+
+    def imread_scaled(self, path, size, metrics=None):
+        """
+        Return a color image decoded at reduced resolution and its original (h, w).
+
+        The largest jpeg DCT scaling (1/2, 1/4 or 1/8) that keeps the longest
+        side of the decoded image at least size pixels is used. Images that
+        aren't jpegs are fully decoded. Returns (None, None) if the image
+        could not be read. Cached arrays must not be modified.
+        """
+        key = self._key(path)
+        if key is None:
+            return None, None
+
+        entry = self._get(key + ('scaled', size))
+        self._count(hit=entry is not None)
+        if entry is not None:
+            return entry[0]
+
+        buf = self._read(path, key, metrics)
+        if not buf:
+            return None, None
+
+        orig_size = jpeg_size(buf)
+        flags = scaled_flags(orig_size, size, size, keep_aspect_ratio=True)
+        img = self._decode(buf, flags, metrics)
+        if img is None:
+            return None, None
+        if orig_size is None:
+            orig_size = img.shape[:2]
+
+        self._put(key + ('scaled', size), (img, orig_size), img.nbytes)
+        return img, orig_size
+
+    def stats(self):
+        # Return cache counters.
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self.cur_bytes
+            }
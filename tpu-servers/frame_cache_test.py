@@ -0,0 +1,74 @@
+"""
+Tests of the frame cache, run with pytest from this directory.
+
+This is part of the smart-zoneminder project.
+See https://github.com/goruck/smart-zoneminder
+
+Copyright (c) 2018 ~ 2020 Lindo St. Angel
+"""
+
+import os
+import sys
+import cv2
+import numpy as np
+
+# Modules shared with the other servers.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+
+from frame_cache import FrameCache
+
+def write_jpeg(path, h=480, w=640, progressive=False, truncate=None):
+    img = np.random.RandomState(0).randint(0, 255, (h, w, 3), dtype=np.uint8)
+    (_, buf) = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_PROGRESSIVE, int(progressive)])
+    buf = buf.tobytes()
+    with open(path, 'wb') as f:
+        f.write(buf if truncate is None else buf[:truncate])
+    return str(path)
+
+def test_imread_scaled(tmp_path):
+    cache = FrameCache(max_bytes=16 << 20)
+    for progressive in (False, True):
+        path = write_jpeg(tmp_path / '{}.jpg'.format(progressive), progressive=progressive)
+        (img, orig_size) = cache.imread_scaled(path, size=300)
+        assert img.shape == (240, 320, 3)
+        assert orig_size == (480, 640)
+        # The full resolution decode reuses the cached file contents.
+        assert cache.imread(path).shape == (480, 640, 3)
+
+def test_imread_scaled_truncated(tmp_path):
+    cache = FrameCache(max_bytes=16 << 20)
+    for progressive in (False, True):
+        # Cut in the scan data, after the frame header.
+        path = write_jpeg(tmp_path / '{}.jpg'.format(progressive), progressive=progressive,
+            truncate=4096)
+        assert cache.imread_scaled(path, size=300) == (None, None)
+        assert cache.imread(path) is None
+    # Empty and missing files.
+    path = write_jpeg(tmp_path / 'empty.jpg', truncate=0)
+    assert cache.imread_scaled(path, size=300) == (None, None)
+    assert cache.imread(str(tmp_path / 'missing.jpg')) is None
+
+def test_hits_and_changed_files(tmp_path):
+    cache = FrameCache(max_bytes=16 << 20)
+    path = write_jpeg(tmp_path / 'frame.jpg')
+    first = cache.imread(path)
+    assert cache.imread(path) is first
+    assert cache.stats()['hits'] == 1
+    # A frame that changes on disk is read again.
+    write_jpeg(path, h=240, w=320)
+    os.utime(path, ns=(0, 0))
+    assert cache.imread(path).shape == (240, 320, 3)
+
+def test_evicts_over_budget(tmp_path):
+    # Room for about two full resolution frames.
+    cache = FrameCache(max_bytes=2 * 480 * 640 * 3 + 1024)
+    paths = [write_jpeg(tmp_path / '{}.jpg'.format(i)) for i in range(4)]
+    for path in paths:
+        cache.imread(path)
+    stats = cache.stats()
+    assert stats['bytes'] <= cache.max_bytes
+    assert stats['evictions'] > 0
+    # Disabled with a zero budget.
+    cache = FrameCache(max_bytes=0)
+    assert cache.imread(paths[0]).shape == (480, 640, 3)
+    assert cache.stats()['entries'] == 0
@@ -0,0 +1,154 @@
+"""
+Inference backends for the detection servers.
+
+The servers run their tflite models through a backend so the same code
+can run on a Coral edge TPU or on an ordinary CPU:
+
+'tpu'  runs edge TPU compiled models on the edge TPU.
+'cpu'  runs the plain (not edge TPU compiled) quantized models on the CPU
+       with the tflite_runtime interpreter using numThreads threads.
+'auto' uses the edge TPU if one can be opened and falls back to the CPU
+       otherwise, e.g. when the USB accelerator is unplugged or has dropped.
+
+Each backend provides detection engines, with the same interface as the
+edgetpu DetectionEngine, and tflite interpreters. Since edge TPU compiled
+models can't run on the CPU and vice versa, each model is given to the
+backend as a pair of paths and the backend picks the one it can run.
+Engines and interpreters can be created for a device index to spread the
+workers of a model over several edge TPUs, the cpu backend ignores it.
+The tpu backend raises a NoEdgeTPUError if no edge TPU is found.
+
+This is part of the smart-zoneminder project.
+See https://github.com/goruck/smart-zoneminder
+
+Copyright (c) 2018 ~ 2020 Lindo St. Angel
+"""
+
+import logging
+import numpy as np
+import tflite_runtime.interpreter as tflite
+from collections import namedtuple
+
+# Shared library of the edge TPU tflite delegate.
+EDGETPU_SHARED_LIB = 'libedgetpu.so.1'
+
+# A detected object, like the edgetpu DetectionCandidate.
+# bounding_box is [[xmin, ymin], [xmax, ymax]] relative to the input size.
+Detection = namedtuple('Detection', ['label_id', 'score', 'bounding_box'])
+
+class NoEdgeTPUError(RuntimeError):
+    pass
+
+class TFLiteDetectionEngine(object):
+    """
+    Detection engine for SSD models with a postprocess op on a tflite interpreter.
+
+    The model outputs are the boxes, classes, scores and number of detections,
+    like the edge TPU models from coral.ai and their CPU versions.
+    """
+    def __init__(self, interpreter):
+        self.interpreter = interpreter
+        self.interpreter.allocate_tensors()
+        self.input_details = self.interpreter.get_input_details()
+        self.output_details = self.interpreter.get_output_details()
+
+    def detect_with_input_tensor(self, input_tensor, threshold=0.1, top_k=3):
+        # Run inference on a flattened input tensor and return the top_k
+        # detections with a score above threshold, best first.
+        # Copy the input straight into the interpreter's input tensor.
+        input_detail = self.input_details[0]
+        np.copyto(self.interpreter.tensor(input_detail['index'])(),
+            input_tensor.reshape(input_detail['shape']))
+        self.interpreter.invoke()
+
+        # Read the outputs through views of the output tensors. The views
+        # must be dropped before the next invoke.
+        outputs = [self.interpreter.tensor(detail['index'])()
+            for detail in self.output_details[:4]]
+        # Models converted by TF1 and TF2 order their outputs differently.
+        if outputs[3].size == 1:
+            (boxes, classes, scores, count) = outputs
+        else:
+            (scores, boxes, count, classes) = outputs
+        detections = []
+        for i in range(min(int(count[0]), top_k)):
+            if scores[0, i] < threshold:
+                continue
+            (ymin, xmin, ymax, xmax) = np.clip(boxes[0, i], 0., 1.)
+            detections.append(Detection(label_id=int(classes[0, i]),
+                score=float(scores[0, i]),
+                bounding_box=np.array([[xmin, ymin], [xmax, ymax]])))
+        del outputs, boxes, classes, scores, count
+        return detections
+
+class EdgeTPUBackend(object):
+    name = 'tpu'
+
+    def model_path(self, tpu_path, cpu_path):
+        # Return the path of the model version this backend runs.
+        return tpu_path
+
+    def _device_paths(self):
+        # Import here so hosts without the edgetpu library can use other backends.
+        from edgetpu.basic import edgetpu_utils
+        paths = edgetpu_utils.ListEdgeTpuPaths(edgetpu_utils.EDGE_TPU_STATE_NONE)
+        if not paths:
+            raise NoEdgeTPUError('No edge TPU found, check that it is plugged in'
+                ' or set inferenceBackend to cpu or auto.')
+        return paths
+
+    def detection_engine(self, model_path, device=None):
+        from edgetpu.detection.engine import DetectionEngine
+        paths = self._device_paths()
+        if device is None:
+            return DetectionEngine(model_path)
+        # Spread devices over the edge tpus found, several engines can share one.
+        return DetectionEngine(model_path, paths[device % len(paths)])
+
+    def interpreter(self, model_path, device=None):
+        options = {}
+        paths = self._device_paths()
+        if device is not None:
+            options['device'] = ':{}'.format(device % len(paths))
+        return tflite.Interpreter(model_path=model_path,
+            experimental_delegates=[tflite.load_delegate(EDGETPU_SHARED_LIB, options)])
+
+class CPUBackend(object):
+    name = 'cpu'
+
+    def __init__(self, num_threads):
+        self.num_threads = num_threads
+
+    def model_path(self, tpu_path, cpu_path):
+        # Return the path of the model version this backend runs.
+        return cpu_path
+
+    def detection_engine(self, model_path, device=None):
+        return TFLiteDetectionEngine(self.interpreter(model_path))
+
+    def interpreter(self, model_path, device=None):
+        try:
+            return tflite.Interpreter(model_path=model_path, num_threads=self.num_threads)
+        except TypeError:
+            # tflite_runtime older than 2.3 has no num_threads.
+            logging.warning('tflite_runtime does not support num_threads, using one thread.')
+            return tflite.Interpreter(model_path=model_path)
+
+def load_backend(name, num_threads):
+    """
+    Return the inference backend called name ('tpu', 'cpu' or 'auto').
+
+    num_threads is the number of threads the cpu backend uses per model.
+    """
+    if name == 'tpu':
+        return EdgeTPUBackend()
+    elif name == 'cpu':
+        return CPUBackend(num_threads=num_threads)
+    elif name == 'auto':
+        try:
+            tflite.load_delegate(EDGETPU_SHARED_LIB)
+        except (ValueError, OSError) as e:
+            logging.warning('No edge TPU found ({}), using the CPU.'.format(e))
+            return CPUBackend(num_threads=num_threads)
+        return EdgeTPUBackend()
+    raise ValueError('Unknown inference backend {}.'.format(name))
@@ -0,0 +1,247 @@
+"""
+Queue of detection requests in front of the inference workers.
+
+zerorpc runs each call in its own greenlet, so concurrent clients (the
+Alarm Uploader, extract_faces.py, test scripts) would otherwise all drive
+the models at once with nothing shaping the load. Instead the images of
+concurrent calls are queued and a single dispatcher merges them into
+micro-batches of up to max_batch images. A micro-batch is started once it
+is full or max_wait seconds after its oldest image was queued, so a lone
+request is delayed by at most max_wait. Up to max_running micro-batches
+run at once, so the images of the next one are read and prefetched while
+the workers finish the last one.
+
+The images of a request are queued ordered by key(image), the ZoneMinder
+(monitor, event, frame number) of the image, so a request that is split
+over micro-batches is still processed in frame order. A micro-batch only
+takes the frames of a monitor from one request and never while another
+micro-batch with frames of that monitor is running, so frame skipping,
+the per-monitor state and the person tracker see each monitor's frames in
+order even though micro-batches overlap.
+
+If a micro-batch fails, its images that aren't done are run again one
+request at a time, so an error only fails the request it comes from.
+
+Images are taken from the waiting requests in turn, so a big offline job
+can't starve the small batches of live alarms: each micro-batch has about
+as many images of a live request as of the big one.
+
+At most max_requests calls can be queued. Further calls wait up to timeout
+seconds for room and then fail with a QueueFullError.
+
+This is part of the smart-zoneminder project.
+See https://github.com/goruck/smart-zoneminder
+
+Copyright (c) 2018 ~ 2020 Lindo St. Angel
+"""
+
+import time
+import logging
+import gevent
+from collections import deque
+from gevent.event import Event
+from gevent.pool import Pool
+from gevent.queue import Queue
+
+class QueueFullError(Exception):
+    pass
+
+class _Request(object):
+    def __init__(self, items, keys):
+        self.items = items
+        # Monitor of each item or None.
+        self.monitors = [None if k is None else k[0] for k in keys]
+        # Indexes of the items in the order they are batched.
+        self.order = sorted(range(len(items)), key=lambda i: keys[i] or ('', '', 0))
+        # Position in order of the next item to batch.
+        self.next = 0
+        # Time the request was queued.
+        self.time = time.monotonic()
+        # (index, result) of each item or an exception, as they are done.
+        self.results = Queue()
+
+class RequestQueue(object):
+    def __init__(self, name, process, max_batch, max_wait, max_requests, timeout,
+        max_running=2, key=None):
+        # process(items) runs a micro-batch and yields the (index, result)
+        # of each item as soon as it is done. key(item) returns the
+        # (monitor, event, frame number) of an item or None.
+        self.name = name
+        self.process = process
+        self.key = key
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_requests = max_requests
+        self.timeout = timeout
+        self.batches = 0
+        self.rejected = 0
+        # Requests with items not yet batched, oldest first.
+        self._requests = deque()
+        # Number of requests not yet done.
+        self._active = 0
+        # Set when there are requests with items not yet batched.
+        self._queued = Event()
+        # Set when items are queued.
+        self._added = Event()
+        # Set when a request is done.
+        self._room = Event()
+        # Monitors with items in the running micro-batches.
+        self._busy = set()
+        # Set when a micro-batch is done.
+        self._finished = Event()
+        # Micro-batches being run.
+        self._running = Pool(max_running)
+        gevent.spawn(self._dispatch)
+
+    def _num_queued(self):
+        return sum(len(r.items) - r.next for r in self._requests)
+
+    def _take(self):
+        # Take up to max_batch items from the queued requests in turn,
+        # skipping requests whose next item is of a monitor that is busy
+        # or taken from another request.
+        batch = []
+        taken = {}
+        skipped = []
+        while self._requests and len(batch) < self.max_batch:
+            request = self._requests.popleft()
+            i = request.order[request.next]
+            monitor = request.monitors[i]
+            if monitor is not None and (monitor in self._busy
+                or taken.setdefault(monitor, request) is not request):
+                skipped.append(request)
+                continue
+            batch.append((request, i))
+            request.next += 1
+            if request.next < len(request.items):
+                self._requests.append(request)
+        self._requests.extendleft(reversed(skipped))
+        self._busy.update(taken)
+        return batch
+
+    def _dispatch(self):
+        while True:
+            self._queued.wait()
+            # Batch the items queued meanwhile while the workers are busy.
+            self._running.wait_available()
+            if self._requests:
+                # Wait for a full micro-batch or the oldest item's deadline.
+                deadline = min(r.time for r in self._requests) + self.max_wait
+                while self._num_queued() < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._added.clear()
+                    self._added.wait(remaining)
+            batch = self._take()
+            if not self._requests:
+                self._queued.clear()
+            if not batch:
+                # The queued items are of busy monitors, wait for one to be
+                # free or for other items.
+                if self._requests:
+                    self._finished.clear()
+                    self._added.clear()
+                    gevent.wait([self._finished, self._added], count=1)
+                continue
+            self.batches += 1
+            logging.debug('{} queue micro-batch of {} images from {} requests.'
+                .format(self.name, len(batch), len({id(r) for (r, _) in batch})))
+            self._running.spawn(self._run_batch, batch)
+
+    def _process(self, batch, done):
+        # Run (request, index) items and pass on their results, adding the
+        # position in batch of each item that is done to done.
+        for (j, result) in self.process([r.items[i] for (r, i) in batch]):
+            (request, i) = batch[j]
+            done.add(j)
+            request.results.put((i, result))
+            # Let the caller pass on the result.
+            gevent.sleep(0)
+
+    def _fail(self, request, e):
+        request.results.put(e)
+        # Don't run what's left of a failed request.
+        if request in self._requests:
+            self._requests.remove(request)
+
+    def _run_batch(self, batch):
+        try:
+            self._run(batch)
+        finally:
+            self._busy.difference_update(r.monitors[i] for (r, i) in batch)
+            self._finished.set()
+
+    def _run(self, batch):
+        done = set()
+        try:
+            self._process(batch, done)
+        except Exception as e:
+            logging.exception('{} queue micro-batch failed.'.format(self.name))
+            requests = []
+            for (request, _) in batch:
+                if request not in requests:
+                    requests.append(request)
+            if len(requests) == 1:
+                self._fail(requests[0], e)
+                return
+            # Find the requests the error comes from.
+            for request in requests:
+                rest = [(r, i) for (j, (r, i)) in enumerate(batch)
+                    if r is request and j not in done]
+                try:
+                    self._process(rest, set())
+                except Exception as e:
+                    logging.error('{} queue request failed: {}'.format(self.name, e))
+                    self._fail(request, e)
+
+    def run(self, items):
+        """
+        Queue items and yield the (index, result) of each as soon as it is done.
+
+        Raises QueueFullError if the queue stays full for timeout seconds.
+        """
+        if not items:
+            return
+        deadline = time.monotonic() + self.timeout
+        while self._active >= self.max_requests:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.rejected += 1
+                raise QueueFullError('The {} queue is full ({} requests), try again later.'
+                    .format(self.name, self._active))
+            self._room.clear()
+            self._room.wait(remaining)
+
+        request = _Request(items, [self.key(item) for item in items] if self.key
+            else [None] * len(items))
+        self._active += 1
+        try:
+            self._requests.append(request)
+            self._queued.set()
+            self._added.set()
+            # Items of different micro-batches can be done out of order.
+            results = {}
+            for i in range(len(items)):
+                while i not in results:
+                    result = request.results.get()
+                    if isinstance(result, Exception):
+                        raise result
+                    results[result[0]] = result[1]
+                yield i, results.pop(i)
+        finally:
+            self._active -= 1
+            self._room.set()
+            # Drop the rest of a request whose caller went away.
+            if request in self._requests:
+                self._requests.remove(request)
+
+    def stats(self):
+        # Return queue counters.
+        return {
+            'requests': self._active,
+            'queued': self._num_queued(),
+            'batches': self.batches,
+            'running': len(self._running),
+            'rejected': self.rejected
+        }
@@ -0,0 +1,129 @@
+"""
+Tests of the request queue, run with pytest from this directory.
+
+This is part of the smart-zoneminder project.
+See https://github.com/goruck/smart-zoneminder
+
+Copyright (c) 2018 ~ 2020 Lindo St. Angel
+"""
+
+import random
+import gevent
+import pytest
+from gevent.event import Event
+
+from request_queue import QueueFullError, RequestQueue
+
+def image_path(monitor, event, frame_num):
+    return '/nvr/zoneminder/events/{}/20/10/18/10/00/{:02d}/{:05d}-capture.jpg'.format(
+        monitor, event, frame_num)
+
+def parse_image_path(image_path):
+    parts = image_path.split('/')
+    return parts[4], '/'.join(parts[5:-1]), int(parts[-1].split('-')[0])
+
+def make_queue(process, **kwargs):
+    settings = dict(max_batch=4, max_wait=0.005, max_requests=8, timeout=1)
+    settings.update(kwargs)
+    return RequestQueue('test', process, **settings)
+
+def call(queue, items):
+    # Run a request and return its results or the error it failed with.
+    try:
+        return list(queue.run(items))
+    except Exception as e:
+        return e
+
+def test_results_in_item_order():
+    def process(items):
+        # Finish the items of a micro-batch last to first.
+        for j in reversed(range(len(items))):
+            gevent.sleep(0.001)
+            yield j, items[j] * 2
+
+    queue = make_queue(process)
+    requests = [list(range(10)), list(range(100, 103)), [7]]
+    greenlets = [gevent.spawn(call, queue, items) for items in requests]
+    gevent.joinall(greenlets, raise_error=True)
+
+    for (greenlet, items) in zip(greenlets, requests):
+        assert greenlet.value == [(i, item * 2) for (i, item) in enumerate(items)]
+    assert queue.batches > 1
+
+def test_error_only_fails_its_request():
+    def process(items):
+        for (j, item) in enumerate(items):
+            gevent.sleep(0.001)
+            if item == 'bad':
+                raise ValueError('bad item')
+            yield j, item.upper()
+
+    queue = make_queue(process)
+    good = gevent.spawn(call, queue, ['a', 'b', 'c', 'd', 'e'])
+    bad = gevent.spawn(call, queue, ['x', 'bad', 'y'])
+    lone = gevent.spawn(call, queue, ['p'])
+    gevent.joinall([good, bad, lone], raise_error=True)
+
+    assert good.value == [(0, 'A'), (1, 'B'), (2, 'C'), (3, 'D'), (4, 'E')]
+    assert isinstance(bad.value, ValueError)
+    assert lone.value == [(0, 'P')]
+
+def test_queue_full():
+    release = Event()
+
+    def process(items):
+        release.wait()
+        for (j, item) in enumerate(items):
+            yield j, item
+
+    queue = make_queue(process, max_requests=1, timeout=0.05)
+    first = gevent.spawn(call, queue, ['a'])
+    gevent.sleep(0.01)
+
+    with pytest.raises(QueueFullError):
+        list(queue.run(['b']))
+    assert queue.stats()['rejected'] == 1
+
+    release.set()
+    first.join()
+    assert first.value == [(0, 'a')]
+    # There is room again once the first request is done.
+    assert call(queue, ['c']) == [(0, 'c')]
+
+def test_monitor_frames_in_order():
+    seen = []
+    running = []
+    # Monitors with frames in two running micro-batches at once.
+    overlaps = []
+
+    def process(items):
+        monitors = {parse_image_path(item)[0] for item in items}
+        overlaps.extend(monitors & set(running))
+        running.extend(monitors)
+        try:
+            for (j, item) in enumerate(items):
+                gevent.sleep(0.001)
+                seen.append(parse_image_path(item))
+                yield j, item
+        finally:
+            for monitor in monitors:
+                running.remove(monitor)
+
+    queue = make_queue(process, key=parse_image_path)
+    rand = random.Random(0)
+    requests = []
+    for (event, monitor) in enumerate(('A', 'A', 'B', 'C')):
+        frames = [image_path(monitor, event, f) for f in range(1, 21)]
+        rand.shuffle(frames)
+        requests.append(frames)
+    greenlets = [gevent.spawn(call, queue, items) for items in requests]
+    gevent.joinall(greenlets, raise_error=True)
+
+    for (greenlet, items) in zip(greenlets, requests):
+        assert greenlet.value == list(enumerate(items))
+    assert len(seen) == 80
+    assert overlaps == []
+    # Each event's frames are processed in order.
+    for key in set((m, e) for (m, e, _) in seen):
+        frames = [f for (m, e, f) in seen if (m, e) == key]
+        assert frames == sorted(frames)
@@ -0,0 +1,144 @@
+"""
+Tracker of the persons across the alarm frames of ZoneMinder events.
+
+The same person usually shows up in many consecutive frames of an event,
+and recognizing them in each frame (face detection, dlib encoding and
+classification or person classification) is the most expensive part of
+the pipeline. Instead the person boxes of a frame are matched to tracks
+of the same monitor and event by overlap (IoU) or, failing that, by how
+close their centers are, and a track's identity is carried over to the
+next frames while it is confident.
+
+A person is recognized again for new tracks, tracks without a confident
+identity, every refresh frames and when its box has grown by size_gain
+since it was last recognized, e.g. when walking up to the camera.
+
+This is part of the smart-zoneminder project.
+See https://github.com/goruck/smart-zoneminder
+
+Copyright (c) 2018 ~ 2020 Lindo St. Angel
+"""
+
+import time
+from collections import OrderedDict
+from itertools import count
+
+def box_area(box):
+    return max(0., box['xmax'] - box['xmin']) * max(0., box['ymax'] - box['ymin'])
+
+def box_iou(box1, box2):
+    # Intersection over union of two boxes.
+    w = min(box1['xmax'], box2['xmax']) - max(box1['xmin'], box2['xmin'])
+    h = min(box1['ymax'], box2['ymax']) - max(box1['ymin'], box2['ymin'])
+    if w <= 0 or h <= 0:
+        return 0.
+    inter = w * h
+    return inter / (box_area(box1) + box_area(box2) - inter)
+
+def box_center(box):
+    return ((box['xmin'] + box['xmax']) / 2., (box['ymin'] + box['ymax']) / 2.)
+
+class Tracker(object):
+    def __init__(self, min_iou, max_gap, refresh, size_gain, ttl, max_events=256):
+        # Boxes overlapping a track by at least min_iou continue it.
+        self.min_iou = min_iou
+        # A track ends if it isn't seen for more than max_gap frames.
+        self.max_gap = max_gap
+        self.refresh = refresh
+        self.size_gain = size_gain
+        # Tracks of an event are dropped ttl seconds after it was last seen
+        # and of at most max_events events are kept, oldest dropped first.
+        self.ttl = ttl
+        self.max_events = max_events
+        self._events = OrderedDict()
+        self._ids = count(1)
+        self.tracks = 0
+
+    def _event_tracks(self, monitor, event):
+        # Return the tracks of an event after dropping old events.
+        now = time.monotonic()
+        state = self._events.pop((monitor, event), None)
+        if state is None:
+            state = {'tracks': []}
+        state['time'] = now
+        self._events[(monitor, event)] = state
+        while self._events and (len(self._events) > self.max_events or
+            now - next(iter(self._events.values()))['time'] > self.ttl):
+            self._events.popitem(last=False)
+        return state
+
+    def update(self, monitor, event, frame_num, boxes):
+        """
+        Match the person boxes of a frame to the tracks of its event.
+
+        Returns the track of each box, a new one for a box that matches
+        none. A track is a dict with its 'id', last 'box' and 'frame' and
+        the 'label' its identity is recognized in, None until it is.
+        """
+        state = self._event_tracks(monitor, event)
+        state['tracks'] = tracks = [t for t in state['tracks']
+            if abs(frame_num - t['frame']) <= self.max_gap]
+
+        # Match the pairs that overlap most first, then the closest centers.
+        matches = [None] * len(boxes)
+        pairs = sorted(((box_iou(t['box'], box), i, j) for (i, t) in enumerate(tracks)
+            for (j, box) in enumerate(boxes)), reverse=True)
+        used = set()
+        for (iou, i, j) in pairs:
+            if iou < self.min_iou:
+                break
+            if i not in used and matches[j] is None:
+                matches[j] = tracks[i]
+                used.add(i)
+        for (j, box) in enumerate(boxes):
+            if matches[j] is not None:
+                continue
+            (x, y) = box_center(box)
+            best = None
+            for (i, t) in enumerate(tracks):
+                if i in used:
+                    continue
+                # The center must be within half the track's box size.
+                (tx, ty) = box_center(t['box'])
+                if (abs(x - tx) <= (t['box']['xmax'] - t['box']['xmin']) / 2. and
+                    abs(y - ty) <= (t['box']['ymax'] - t['box']['ymin']) / 2.):
+                    distance = (x - tx) ** 2 + (y - ty) ** 2
+                    if best is None or distance < best[0]:
+                        best = (distance, i)
+            if best is not None:
+                matches[j] = tracks[best[1]]
+                used.add(best[1])
+
+        for (j, box) in enumerate(boxes):
+            track = matches[j]
+            if track is None:
+                track = {'id': next(self._ids), 'label': None, 'wait': None,
+                    'recognized': None, 'area': 0.}
+                tracks.append(track)
+                self.tracks += 1
+            track['box'] = box
+            track['frame'] = frame_num
+            matches[j] = track
+        return matches
+
+    def needs_recognition(self, track, frame_num):
+        # Check if a track's identity has to be recognized in a frame.
+        label = track['label']
+        # The label has no 'face' while it's still being recognized.
+        if label is None or label.get('face', '') is None:
+            return True
+        if abs(frame_num - track['recognized']) >= self.refresh:
+            return True
+        return box_area(track['box']) >= self.size_gain * track['area']
+
+    def recognize(self, track, frame_num, label, wait=None):
+        # Set the label a track's identity is recognized in, wait is what
+        # to wait for until it is.
+        track.update(label=label, wait=wait, recognized=frame_num, area=box_area(track['box']))
+
+    def stats(self):
+        # Return tracker counters.
+        return {
+            'events': len(self._events),
+            'tracks': self.tracks
+        }
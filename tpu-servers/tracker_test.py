@@ -0,0 +1,72 @@
+"""
+Tests of the person tracker, run with pytest from this directory.
+
+This is part of the smart-zoneminder project.
+See https://github.com/goruck/smart-zoneminder
+
+Copyright (c) 2018 ~ 2020 Lindo St. Angel
+"""
+
+from tracker import Tracker
+
+def box(xmin, ymin, w=100, h=200):
+    return {'xmin': xmin, 'ymin': ymin, 'xmax': xmin + w, 'ymax': ymin + h}
+
+def make_tracker(**kwargs):
+    settings = dict(min_iou=0.3, max_gap=5, refresh=10, size_gain=1.5, ttl=300)
+    settings.update(kwargs)
+    return Tracker(**settings)
+
+def test_stable_ids():
+    tracker = make_tracker()
+    # Two persons walking, one slowly enough to overlap its last box and
+    # one too fast for that, which is matched by its center.
+    ids = None
+    for frame_num in range(1, 11):
+        tracks = tracker.update('BackPorch', 'e1', frame_num,
+            [box(10 * frame_num, 50), box(500 + 40 * frame_num, 80 * frame_num)])
+        frame_ids = [t['id'] for t in tracks]
+        assert len(set(frame_ids)) == 2
+        if ids is None:
+            ids = frame_ids
+        assert frame_ids == ids
+    assert tracker.stats()['tracks'] == 2
+
+def test_boxes_matched_in_any_order():
+    tracker = make_tracker()
+    (a, b) = tracker.update('BackPorch', 'e1', 1, [box(0, 0), box(400, 0)])
+    tracks = tracker.update('BackPorch', 'e1', 2, [box(405, 0), box(5, 0)])
+    assert [t['id'] for t in tracks] == [b['id'], a['id']]
+
+def test_events_and_monitors_have_own_tracks():
+    tracker = make_tracker()
+    (track,) = tracker.update('BackPorch', 'e1', 1, [box(0, 0)])
+    assert tracker.update('BackPorch', 'e2', 2, [box(0, 0)])[0]['id'] != track['id']
+    assert tracker.update('FrontPorch', 'e1', 2, [box(0, 0)])[0]['id'] != track['id']
+    assert tracker.update('BackPorch', 'e1', 2, [box(0, 0)])[0]['id'] == track['id']
+
+def test_track_expires_after_max_gap():
+    tracker = make_tracker(max_gap=5)
+    (track,) = tracker.update('BackPorch', 'e1', 1, [box(0, 0)])
+    # Seen again within max_gap frames it's the same track.
+    (same,) = tracker.update('BackPorch', 'e1', 6, [box(0, 0)])
+    assert same['id'] == track['id']
+    # Not seen for more than max_gap frames it has ended.
+    (new,) = tracker.update('BackPorch', 'e1', 12, [box(0, 0)])
+    assert new['id'] != track['id']
+
+def test_needs_recognition():
+    tracker = make_tracker(refresh=10, size_gain=1.5)
+    (track,) = tracker.update('BackPorch', 'e1', 1, [box(0, 0)])
+    assert tracker.needs_recognition(track, 1)
+    tracker.recognize(track, 1, {'name': 'person', 'face': 'lindo_st_angel'})
+    (track,) = tracker.update('BackPorch', 'e1', 2, [box(5, 0)])
+    assert not tracker.needs_recognition(track, 2)
+    # Every refresh frames.
+    assert tracker.needs_recognition(track, 11)
+    # When the box has grown by size_gain.
+    (track,) = tracker.update('BackPorch', 'e1', 3, [box(0, 0, 130, 260)])
+    assert tracker.needs_recognition(track, 3)
+    # While its identity is unknown.
+    tracker.recognize(track, 3, {'name': 'person', 'face': None})
+    assert tracker.needs_recognition(track, 4)
@@ -0,0 +1,102 @@
+"""
+Pool of inference workers for a model.
+
+Each worker owns its own detection engine or interpreter so several images
+can be inferred at the same time, on several edge TPUs or on several CPU
+cores. Jobs are run on threads since tflite and the edgetpu library release
+the GIL while a model runs. A job is dispatched to the worker that has been
+idle the longest and its result is returned in a future, so callers keep
+results in the order the jobs were submitted by holding on to the futures.
+Greenlets wait for the futures with wait_result() so the gevent hub keeps
+serving other requests and zerorpc heartbeats while the models run.
+
+Busy time and number of jobs of each worker are tracked to tell how well
+the workers are utilized.
+
+This is part of the smart-zoneminder project.
+See https://github.com/goruck/smart-zoneminder
+
+Copyright (c) 2018 ~ 2020 Lindo St. Angel
+"""
+
+import time
+import queue
+import threading
+import gevent
+from concurrent.futures import ThreadPoolExecutor
+from gevent.hub import Waiter
+
+def wait_result(future):
+    """
+    Return the result of a future, letting other greenlets run meanwhile.
+
+    The hub is woken up through an async watcher, which unlike most of
+    gevent can be signaled from a worker thread.
+    """
+    if not future.done():
+        watcher = gevent.get_hub().loop.async_()
+        waiter = Waiter()
+        # Start the watcher first so a future that is done right away can't be missed.
+        watcher.start(waiter.switch, None)
+        try:
+            future.add_done_callback(lambda _: watcher.send())
+            waiter.get()
+        finally:
+            watcher.close()
+    return future.result()
+
+class WorkerPool(object):
+    def __init__(self, name, make_worker, num_workers):
+        # make_worker(i) returns the engine or interpreter of the i-th worker.
+        self.name = name
+        self.workers = [make_worker(i) for i in range(num_workers)]
+        self.calls = [0] * num_workers
+        self.busy = [0.0] * num_workers
+        self.start_time = time.monotonic()
+        self._lock = threading.Lock()
+        # Indices of idle workers, longest idle first.
+        self._idle = queue.Queue()
+        for i in range(num_workers):
+            self._idle.put(i)
+        # One thread per worker so there is always an idle worker for a running job.
+        self._executor = ThreadPoolExecutor(max_workers=num_workers)
+
+    def _run(self, func, args):
+        i = self._idle.get()
+        start = time.monotonic()
+        try:
+            return func(self.workers[i], *args)
+        finally:
+            with self._lock:
+                self.calls[i] += 1
+                self.busy[i] += time.monotonic() - start
+            self._idle.put(i)
+
+    def submit(self, func, *args):
+        """
+        Run func(worker, *args) on the next idle worker.
+
+        Returns a future of the result.
+        """
+        return self._executor.submit(self._run, func, args)
+
+    def map(self, func, items):
+        # Run func(worker, item) for all items and return the results in order.
+        # Blocks the calling thread, it's meant for loading models on a native thread.
+        futures = [self.submit(func, item) for item in items]
+        return [future.result() for future in futures]
+
+    def close(self):
+        # Wait for the running jobs and release the workers.
+        self._executor.shutdown(wait=True)
+        self.workers = []
+
+    def stats(self):
+        # Return the number of jobs, busy time and utilization of each worker.
+        elapsed = time.monotonic() - self.start_time
+        with self._lock:
+            return [{
+                'calls': calls,
+                'busy': round(busy, 3),
+                'utilization': round(busy / elapsed, 3) if elapsed > 0 else 0.
+            } for (calls, busy) in zip(self.calls, self.busy)]